@@ -0,0 +1,330 @@
+import json
+import threading
+from socket import *
+from urllib.parse import urlsplit, parse_qs
+from RequestPacket import RequestPacket
+from ResponsePacket import ResponsePacket
+from CacheHandler import CacheHandler
+from CacheIndex import CacheIndex
+from CacheKey import CacheKey
+from NegativeCache import NegativeCache
+from Prefetcher import Prefetcher
+from CachePeers import CachePeers
+from Metrics import Metrics
+
+
+
+#  ██  ██       █████  ██████  ███    ███ ██ ███    ██     ██   ██  █████  ███    ██ ██████  ██      ███████ ██████
+# ████████     ██   ██ ██   ██ ████  ████ ██ ████   ██     ██   ██ ██   ██ ████   ██ ██   ██ ██      ██      ██   ██
+#  ██  ██      ███████ ██   ██ ██ ████ ██ ██ ██ ██  ██     ███████ ███████ ██ ██  ██ ██   ██ ██      █████   ██████
+# ████████     ██   ██ ██   ██ ██  ██  ██ ██ ██  ██ ██     ██   ██ ██   ██ ██  ██ ██ ██   ██ ██      ██      ██   ██
+#  ██  ██      ██   ██ ██████  ██      ██ ██ ██   ████     ██   ██ ██   ██ ██   ████ ██████  ███████ ███████ ██   ██
+
+
+
+
+class AdminHandler:
+    '''
+    local admin interface of the proxy, answers loopback clients only
+    reachable through the proxy as http://proxy.admin/..., and on 127.0.0.1:ADMIN_PORT if set
+
+        GET  /entries?prefix=P&limit=N      metadata of cached entries with key starting with P, as json,
+                                            next page with &after=K, K is 'next' of the previous page (null on last page)
+        POST /purge?url=U                   delete url U, every variant (Vary) and encoding of it
+        POST /purge?host=H                  delete every entry of host H (host:port unless port 80)
+        POST /purge?prefix=P                delete every entry with key starting with P, eg www.example.com/static/
+        POST /purge?key=K&key=K2            delete entries by exact cache key, eg variants, used by maintain_cache.py
+        GET  /prefetch                      prefetch metrics, prefetched urls used and wasted (see Prefetcher)
+        GET  /digest                        digest of the cached urls, fetched by peers (see CachePeers), 404 until built
+        GET  /metrics                       request, cache and connection metrics in Prometheus text format (see Metrics),
+                                            also served on 127.0.0.1:METRICS_PORT if set, the only path served there
+
+    cache keys are host + path, eg www.example.com/static/app.js
+    purge forgets remembered 404/ 410 responses of the urls too (see NegativeCache)
+    purge accepts PURGE as well, never GET: a page could make the browser of a local user purge the cache (eg <img src=...>),
+    purge requires header CSRF_HEADER (X-Proxy-Admin: 1), a cross-site form cannot send it,
+    and is refused if Origin/ Referer name another site, purge responses hold number of entries and bytes deleted
+    '''
+
+    ADMIN_HOST = 'proxy.admin'
+    CSRF_HEADER = ('x-proxy-admin', '1') # required by state changing requests, not a header a html form can send
+    ADMIN_PORT = None # port of the admin server, None: admin interface only reachable through ADMIN_HOST
+    METRICS_PORT = None # port serving /metrics only, None: no metrics server
+    MAX_ENTRIES = 1000 # default limit of /entries
+    serverThread = None
+    metricsServerThread = None
+
+    @staticmethod
+    def start():
+        '''
+        called by Proxy object
+        start admin server if ADMIN_PORT is set, metrics server if METRICS_PORT is set
+        '''
+        if AdminHandler.ADMIN_PORT is not None and AdminHandler.serverThread is None:
+            AdminHandler.serverThread = AdminServerThread(AdminHandler.ADMIN_PORT)
+            AdminHandler.serverThread.start()
+            print('AdminHandler:: admin server listening on 127.0.0.1:' + str(AdminHandler.ADMIN_PORT))
+        if AdminHandler.METRICS_PORT is not None and AdminHandler.metricsServerThread is None:
+            AdminHandler.metricsServerThread = AdminServerThread(AdminHandler.METRICS_PORT, paths=['/metrics'])
+            AdminHandler.metricsServerThread.start()
+            print('AdminHandler:: metrics server listening on 127.0.0.1:' + str(AdminHandler.METRICS_PORT))
+
+    @staticmethod
+    def stop():
+        '''
+        called by Proxy on exit
+        '''
+        if AdminHandler.serverThread is not None:
+            AdminHandler.serverThread.stop()
+            AdminHandler.serverThread = None
+        if AdminHandler.metricsServerThread is not None:
+            AdminHandler.metricsServerThread.stop()
+            AdminHandler.metricsServerThread = None
+
+    @staticmethod
+    def isAdminRequest(rqp):
+        '''
+        returns true if rqp is addressed to ADMIN_HOST
+        '''
+        return rqp.getMethod().lower() != 'connect' and rqp.getHostName().split(':')[0].lower() == AdminHandler.ADMIN_HOST
+
+    @staticmethod
+    def isLoopback(clientAddr):
+        '''
+        returns true if clientAddr (ip address string) is a loopback address
+        '''
+        return clientAddr.startswith('127.') or clientAddr == '::1' or clientAddr.startswith('::ffff:127.')
+
+    @staticmethod
+    def isSameSite(rqp):
+        '''
+        returns true if Origin and Referer of rqp are absent, or name the admin interface itself
+        (ADMIN_HOST, or a loopback address on ADMIN_PORT)
+        '''
+        for fieldName in ['origin', 'referer']:
+            value = rqp.getHeaderInfo(fieldName)
+            if value == 'nil':
+                continue
+            urlSplitted = urlsplit(value)
+            if urlSplitted.hostname is None: # Origin: null, eg sandboxed or file pages
+                return False
+            if urlSplitted.hostname.lower() == AdminHandler.ADMIN_HOST:
+                continue
+            try:
+                port = urlSplitted.port
+            except ValueError as e:
+                return False
+            if AdminHandler.ADMIN_PORT is not None and port == AdminHandler.ADMIN_PORT and (urlSplitted.hostname == 'localhost' or AdminHandler.isLoopback(urlSplitted.hostname)):
+                continue
+            return False
+        return True
+
+    @staticmethod
+    def respond(method, target, clientAddr, rqp):
+        '''
+        returns response packet answering admin request method target (eg '/purge?url=...') from clientAddr
+        rqp holds header fields of the request
+        '''
+        if not AdminHandler.isLoopback(clientAddr):
+            print('AdminHandler:: respond: admin request from ' + clientAddr + ' refused')
+            return AdminHandler.__createResponse('403 Forbidden', {'error' : 'admin interface is available to loopback clients only'})
+
+        targetSplitted = urlsplit(target)
+        query = parse_qs(targetSplitted.query)
+        method = method.upper()
+        if targetSplitted.path == '/metrics': # available while the index is loading
+            if method != 'GET':
+                return AdminHandler.__createResponse('405 Method Not Allowed', {'error' : 'use GET'})
+            return AdminHandler.__createResponse('200 OK', Metrics.render().encode('utf-8'), contentType='text/plain; version=0.0.4; charset=utf-8')
+        if not CacheHandler.isIndexLoaded():
+            return AdminHandler.__createResponse('503 Service Unavailable', {'error' : 'cache index is loading'})
+        print('AdminHandler:: respond: ' + method + ' ' + target)
+        try:
+            if targetSplitted.path == '/entries':
+                if method != 'GET':
+                    return AdminHandler.__createResponse('405 Method Not Allowed', {'error' : 'use GET'})
+                return AdminHandler.__listEntries(query)
+            elif targetSplitted.path == '/purge':
+                if method not in ['POST', 'PURGE']:
+                    return AdminHandler.__createResponse('405 Method Not Allowed', {'error' : 'use POST'})
+                if not AdminHandler.isSameSite(rqp):
+                    print('AdminHandler:: respond: cross-site purge refused')
+                    return AdminHandler.__createResponse('403 Forbidden', {'error' : 'cross-site request'})
+                if rqp.getHeaderInfo(AdminHandler.CSRF_HEADER[0]) != AdminHandler.CSRF_HEADER[1]:
+                    return AdminHandler.__createResponse('403 Forbidden', {'error' : 'send header ' + AdminHandler.CSRF_HEADER[0] + ': ' + AdminHandler.CSRF_HEADER[1]})
+                return AdminHandler.__purge(query)
+            elif targetSplitted.path == '/prefetch':
+                if method != 'GET':
+                    return AdminHandler.__createResponse('405 Method Not Allowed', {'error' : 'use GET'})
+                return AdminHandler.__createResponse('200 OK', Prefetcher.getMetrics())
+            elif targetSplitted.path == '/digest':
+                if method != 'GET':
+                    return AdminHandler.__createResponse('405 Method Not Allowed', {'error' : 'use GET'})
+                if CachePeers.digest is None:
+                    return AdminHandler.__createResponse('404 Not Found', {'error' : 'no digest built, peers are not configured'})
+                return AdminHandler.__createResponse('200 OK', CachePeers.digest.toBytes(), contentType='application/octet-stream')
+        except ValueError as e: # malformed parameter
+            return AdminHandler.__createResponse('400 Bad Request', {'error' : str(e)})
+        return AdminHandler.__createResponse('404 Not Found', {'error' : 'unknown path', 'paths' : ['/entries', '/purge', '/prefetch', '/digest', '/metrics']})
+
+    @staticmethod
+    def __listEntries(query):
+        '''
+        entries with key starting with prefix parameter and greater than after parameter,
+        at most limit parameter (default MAX_ENTRIES) keys are looked at
+        '''
+        prefix = query.get('prefix', [''])[0]
+        after = query.get('after', [None])[0]
+        limit = int(query.get('limit', [str(AdminHandler.MAX_ENTRIES)])[0])
+        if limit <= 0:
+            raise ValueError('limit must be positive')
+        index = CacheHandler.getIndex()
+        cacheFileNameFHs = index.getKeys(prefix, after=after, limit=limit)
+        entries = []
+        for cacheFileNameFH in cacheFileNameFHs:
+            entry = index.readEntry(cacheFileNameFH)
+            if entry is None or CacheIndex.isEmptyEntry(entry): # deleted
+                continue
+            entries.append(entry)
+        nextKey = None
+        if len(cacheFileNameFHs) == limit: # there may be more
+            nextKey = cacheFileNameFHs[-1]
+        return AdminHandler.__createResponse('200 OK', {'entries' : entries, 'next' : nextKey, 'truncated' : nextKey is not None})
+
+    @staticmethod
+    def __purge(query):
+        '''
+        purge by url, host or prefix parameter
+        '''
+        if 'url' in query:
+            url = query['url'][0]
+            if '://' not in url:
+                url = 'http://' + url
+            urlSplitted = urlsplit(url)
+            if urlSplitted.netloc == '':
+                raise ValueError('invalid url: ' + url)
+            filePath = urlSplitted.path if urlSplitted.path != '' else '/'
+            if urlSplitted.query != '':
+                filePath += '?' + urlSplitted.query
+            try:
+                requestRaw = ('GET http://' + urlSplitted.netloc + filePath + ' HTTP/1.1\r\nHost: ' + urlSplitted.netloc + '\r\n\r\n').encode('ascii')
+            except UnicodeError as e:
+                raise ValueError('url must be ascii: ' + url)
+            numEntries, numBytes = CacheHandler(rqp=RequestPacket.parsePacket(requestRaw)).purgeUrl()
+            NegativeCache.removeResponses(CacheKey.buildUrl(urlSplitted.netloc, filePath))
+
+        elif 'host' in query:
+            host = CacheKey.normalize(query['host'][0], '/')[0]
+            cacheFileNameFHs = []
+            for cacheFileNameFH in CacheHandler.getIndex().getKeys(host):
+                if len(cacheFileNameFH) == len(host) or cacheFileNameFH[len(host)] in ['/', '#']: # not another host with same prefix
+                    cacheFileNameFHs.append(cacheFileNameFH)
+            numEntries, numBytes = CacheHandler.purgeKeys(cacheFileNameFHs)
+            NegativeCache.removeResponses(host + '/')
+
+        elif 'key' in query:
+            numEntries, numBytes = CacheHandler.purgeKeys(query['key'])
+
+        elif 'prefix' in query:
+            prefix = query['prefix'][0]
+            if prefix == '':
+                raise ValueError('empty prefix, use clear_cache.sh to delete everything')
+            numEntries, numBytes = CacheHandler.purgeKeys(CacheHandler.getIndex().getKeys(prefix))
+            NegativeCache.removeResponses(prefix)
+
+        else:
+            raise ValueError('one of url, host, prefix or key is required')
+
+        print('AdminHandler:: __purge: ' + str(numEntries) + ' entries, ' + str(numBytes) + ' bytes deleted')
+        return AdminHandler.__createResponse('200 OK', {'purged' : numEntries, 'bytes' : numBytes})
+
+    @staticmethod
+    def __createResponse(status, body, contentType='application/json'):
+        '''
+        returns response packet with status and body (dict) as json, or body (bytes) as is with contentType
+        '''
+        payload = body if contentType != 'application/json' else json.dumps(body).encode('utf-8')
+        response = ResponsePacket()
+        response.setResponseLine('HTTP/1.1 ' + status)
+        response.setHeaderSplitted(['Content-Type: ' + contentType, 'Content-Length: ' + str(len(payload)), 'Cache-Control: no-store'])
+        response.setPayload(payload)
+        return response
+
+
+
+
+
+
+
+
+
+#  ██  ██       █████  ██████  ███    ███ ██ ███    ██     ███████ ███████ ██████  ██    ██ ███████ ██████      ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██   ██ ██   ██ ████  ████ ██ ████   ██     ██      ██      ██   ██ ██    ██ ██      ██   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ███████ ██   ██ ██ ████ ██ ██ ██ ██  ██     ███████ █████   ██████  ██    ██ █████   ██████         ██    ███████ ██████  █████   ███████ ██   ██
+# ████████     ██   ██ ██   ██ ██  ██  ██ ██ ██  ██ ██          ██ ██      ██   ██  ██  ██  ██      ██   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██   ██ ██████  ██      ██ ██ ██   ████     ███████ ███████ ██   ██   ████   ███████ ██   ██        ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+class AdminServerThread(threading.Thread):
+    '''
+    serve admin requests on 127.0.0.1:port, one request per connection
+    only paths listed in paths are served if given, eg the metrics server
+    '''
+
+    BUFFER_SIZE = 8192
+    TIMEOUT = 5 # seconds to receive a request
+
+    def __init__(self, port, paths=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.paths = paths
+        self.welcomeSocket = socket(AF_INET, SOCK_STREAM)
+        self.welcomeSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.welcomeSocket.bind(('127.0.0.1', port))
+        self.welcomeSocket.listen(5)
+        self.isRunning = True
+
+    def run(self):
+        while self.isRunning:
+            try:
+                clientSocket, addr = self.welcomeSocket.accept()
+            except OSError as e: # socket closed by stop()
+                break
+            try:
+                self.__handle(clientSocket, addr[0])
+            except Exception as e:
+                print('AdminServerThread:: run: failed to answer admin request: ' + str(e))
+            finally:
+                clientSocket.close()
+
+    def stop(self):
+        self.isRunning = False
+        try:
+            self.welcomeSocket.shutdown(SHUT_RDWR) # wake up accept()
+        except OSError as e:
+            pass
+        self.welcomeSocket.close()
+
+    def __handle(self, clientSocket, clientAddr):
+        '''
+        receive request header, answer it by AdminHandler
+        '''
+        clientSocket.settimeout(AdminServerThread.TIMEOUT)
+        requestRaw = b''
+        while b'\r\n\r\n' not in requestRaw:
+            data = clientSocket.recv(AdminServerThread.BUFFER_SIZE)
+            if data == b'':
+                break
+            requestRaw += data
+        requestLineSplitted = requestRaw.split(b'\r\n')[0].decode('ascii').split(' ')
+        if len(requestLineSplitted) < 2: # not a request
+            return
+        if self.paths is not None and urlsplit(requestLineSplitted[1]).path not in self.paths:
+            clientSocket.sendall(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return
+        headers = RequestPacket() # header fields only, the request line of the admin port has no host
+        headers.setHeaderSplitted(requestRaw.split(b'\r\n\r\n')[0].decode('ascii').split('\r\n')[1:])
+        rsp = AdminHandler.respond(requestLineSplitted[0], requestLineSplitted[1], clientAddr, headers)
+        clientSocket.sendall(rsp.getPacketRaw())
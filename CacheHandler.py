@@ -1,10 +1,20 @@
-import json # for cache_lookup_table
 import os # remove file os.remove(filename)
+import mmap
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
 from RequestPacket import RequestPacket
 from ResponsePacket import ResponsePacket
 from TimeComparator import TimeComparator
+from CacheIndex import CacheIndex
+from ContentCoding import ContentCoding
+from RangeHandler import RangeHandler
+from CacheShards import CacheShards
+from CacheKey import CacheKey
 import threading
 import PrimeFinder
+from ReadWriteLock import ReadWriteLock
 
 
 #  ██  ██       ██████  █████   ██████ ██   ██ ███████     ██   ██  █████  ███    ██ ██████  ██      ███████ ██████
@@ -26,35 +36,95 @@ class CacheHandler:
 
     origin = '' # initialized by proxy_main
     cacheFileDirectory = 'cache_responses/'
-    lookupTable = None
+    INDEX_BACKEND = 'json' # 'json' or 'sqlite', see CacheIndex
+    index = None
     lookupTableLock = threading.Semaphore() # require sequential read/ write, otherwise may occur corruption/ data loss
     chdirLock = threading.Semaphore()
     hashedLocks = None
     NUMSLOTS = 0
+    compactionThread = None
+    HEURISTIC_FRACTION = 0.1 # without explicit expiry, fresh for this fraction of the time since Last-Modified (RFC 9111 4.2.2)
+    HEURISTIC_MAX_AGE = 24 * 60 * 60 # upper bound (seconds) of heuristic freshness
+    AT_REST_ENCODING = 'gzip' # compressible bodies are stored compressed with this coding ('gzip', 'zstd', None: as received)
+    AT_REST_LEVEL = 6
+    AT_REST_MIN_SIZE = 256 # bytes, smaller bodies are stored as received
+    AT_REST_MAX_SIZE = 16 * 1024 * 1024 # bytes, larger bodies are stored as received, compression needs the whole body in memory
+    MAX_CACHEABLE_SIZE = 1024 * 1024 * 1024 # bytes, larger responses are never cached, only streamed to the client
+    MMAP_THRESHOLD = 1024 * 1024 # cached files larger than this (bytes) are served from a shared mmap
+    MAX_MAPPED_FILES = 256 # each mapping holds a file descriptor, least recently used mappings are dropped
+    mappedFiles = OrderedDict()
+    mappedFilesLock = threading.Semaphore()
+    MAX_HIT_COUNTS = 10000 # entries whose hits are counted, least recently hit are forgotten first
+    hitCounts = OrderedDict() # cacheFileNameFH -> number of hits since cached
+    hitCountsLock = threading.Semaphore()
 
     @staticmethod
     def initHashedLocks(numThreads):
         '''
         called by Proxy object
         based on number of Threads, create sufficient amount of locks for cache file IO
+        reader-writer locks: fetching holds the read lock, so hits on the same file run in parallel,
+        caching/ deleting holds the write lock (acquire/ release)
         '''
         CacheHandler.NUMSLOTS = PrimeFinder.findNextPrime(numThreads * 2)
         CacheHandler.hashedLocks = []
         for i in range(CacheHandler.NUMSLOTS):
-            CacheHandler.hashedLocks.append(threading.Semaphore())
+            CacheHandler.hashedLocks.append(ReadWriteLock())
+
+    @staticmethod
+    def initIndex():
+        '''
+        called by Proxy object
+        create cache index backend selected by INDEX_BACKEND,
+        start background thread loading it, then compacting it
+        requests are answered as cache misses until the index is loaded
+        '''
+        if CacheHandler.origin == '':
+            CacheHandler.origin = os.getcwd()
+        CacheHandler.index = CacheIndex.create(CacheHandler.INDEX_BACKEND, CacheHandler.origin)
+        CacheShards.startScan()
+        SpilledBody.removeLeftovers()
+        CacheHandler.compactionThread = CompactionThread()
+        CacheHandler.compactionThread.start()
+
+    @staticmethod
+    def getIndex():
+        '''
+        returns cache index backend, loaded on first access
+        '''
+        if CacheHandler.index is None: # initIndex() not called, eg used outside of Proxy
+            if CacheHandler.origin == '':
+                CacheHandler.origin = os.getcwd()
+            CacheHandler.index = CacheIndex.create(CacheHandler.INDEX_BACKEND, CacheHandler.origin)
+        CacheHandler.index.load()
+        return CacheHandler.index
+
+    @staticmethod
+    def isIndexLoaded():
+        '''
+        returns true if cache index is loaded, never blocks
+        '''
+        return CacheHandler.index is not None and CacheHandler.index.isLoaded()
 
     @staticmethod
     def exitRoutine():
         '''
         called by Proxy
-        clean up lookup table and write to file
-        delete entries with all 0s in encoding
+        finish queued cache writes, stop compaction, close the cache index
         delete directories with no files, using DFS
+
+        the lookup table is not dumped here,
+        journal records are replayed (and compacted) on next startup
         '''
-        if os.path.isdir(CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory):
-            CacheHandler.deleteUnusedPaths(CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory)
-        CacheHandler.purgeLookupTable()
-        CacheHandler.writeLookupTableToFile()
+        CacheWriter.stop()
+        print('CacheHandler:: exitRoutine: cache writer metrics: ' + str(CacheWriter.getMetrics()))
+        if CacheHandler.compactionThread is not None:
+            CacheHandler.compactionThread.stop()
+        for cacheRoot in [CacheHandler.getCacheRoot()] + CacheShards.getDirectories():
+            if os.path.isdir(cacheRoot):
+                CacheHandler.deleteUnusedPaths(cacheRoot)
+        if CacheHandler.index is not None:
+            CacheHandler.index.close()
 
     @staticmethod
     def deleteUnusedPaths(origin, releaseChdirLock=True):
@@ -63,7 +133,8 @@ class CacheHandler:
         recursively delete directories that contains 0 file
         ie the previously stored cache has already been deleted,
         so there is no need to keep that directory
-        implemented using DFS, should be replaceable by os.removedirs()
+        implemented using DFS on absolute paths, the working directory is not changed
+        see maintain_cache.py for a check of the whole cache
         '''
 
         if CacheHandler.origin == '':
@@ -73,59 +144,208 @@ class CacheHandler:
             CacheHandler.chdirLock.acquire()
 
         for d in os.listdir(origin):
-            if os.path.isdir(d):
-                os.chdir(d)
-                deleteUnusedPaths(os.getcwd(), releaseChdirLock=False)
-                os.chdir('..')
-                if len(os.listdir(d)) == 0:
-                    os.rmdir(d)
+            path = os.path.join(origin, d)
+            if os.path.isdir(path):
+                CacheHandler.deleteUnusedPaths(path, releaseChdirLock=False)
+                if len(os.listdir(path)) == 0:
+                    os.rmdir(path)
 
         if releaseChdirLock:
             CacheHandler.chdirLock.release()
 
+    @staticmethod
+    def purgeKeys(cacheFileNameFHs):
+        '''
+        called by AdminHandler
+        delete entries cacheFileNameFHs with all their files
+        returns (number of entries deleted, number of bytes removed)
+        '''
+        numEntries = 0
+        numBytes = 0
+        for cacheFileNameFH in cacheFileNameFHs:
+            entry = CacheHandler.getIndex().readEntry(cacheFileNameFH)
+            if entry is None or CacheIndex.isEmptyEntry(entry): # deleted already
+                continue
+            removedBytes = CacheHandler(rqp=None).deleteFromCache(cacheFileNameFH=cacheFileNameFH)
+            if removedBytes is not None:
+                numEntries += 1
+                numBytes += removedBytes
+        return (numEntries, numBytes)
+
+    @staticmethod
+    def canSpill(rqp, rsp):
+        '''
+        called by SocketHandler, for responses too large to be held in memory
+        returns true if response with header rsp to rqp may be cached, so its body is worth spilling to disk
+        '''
+        if rqp.getMethod().lower() != 'get' or rsp.responseCode() != '200':
+            return False
+        for option in rsp.getHeaderInfo('cache-control').lower().split(','):
+            if option.strip() == 'no-store' or option.strip() == 'private':
+                return False
+        if rsp.getHeaderInfo('vary').strip() == '*':
+            return False
+        contentLength = rsp.getHeaderInfo('content-length')
+        return contentLength == 'nil' or int(contentLength) <= CacheHandler.MAX_CACHEABLE_SIZE
+
+    @staticmethod
+    def dropExpiredEntry(entry):
+        '''
+        called by ExpirySweeper
+        delete entry with all its files, unless it was replaced or refreshed since it was read
+        returns number of bytes removed, None if nothing deleted
+        '''
+        cacher = CacheHandler(rqp=None)
+        CacheHandler.lookupTableLock.acquire()
+        cacher.holdingLookupTableLock = True
+        current = CacheHandler.getIndex().getEntry(entry['cacheFileNameFH'])
+        if current is None or current['expiry'] != entry['expiry'] or CacheIndex.countFiles(current) == 0:
+            CacheHandler.lookupTableLock.release()
+            cacher.holdingLookupTableLock = False
+            return None
+        return cacher.deleteFromCache(cacheFileNameFH=entry['cacheFileNameFH']) # releases lookupTableLock
+
+    @staticmethod
+    def getHotKeys(minHits):
+        '''
+        called by ExpirySweeper
+        returns cache keys hit at least minHits times since they were cached
+        '''
+        CacheHandler.hitCountsLock.acquire()
+        keys = [cacheFileNameFH for cacheFileNameFH, hits in CacheHandler.hitCounts.items() if hits >= minHits]
+        CacheHandler.hitCountsLock.release()
+        return keys
+
+    @staticmethod
+    def __countHit(cacheFileNameFH):
+        CacheHandler.hitCountsLock.acquire()
+        CacheHandler.hitCounts[cacheFileNameFH] = CacheHandler.hitCounts.pop(cacheFileNameFH, 0) + 1 # re-inserted as most recent
+        while len(CacheHandler.hitCounts) > CacheHandler.MAX_HIT_COUNTS:
+            CacheHandler.hitCounts.popitem(last=False)
+        CacheHandler.hitCountsLock.release()
+
+    @staticmethod
+    def __resetHits(cacheFileNameFH):
+        CacheHandler.hitCountsLock.acquire()
+        CacheHandler.hitCounts.pop(cacheFileNameFH, None)
+        CacheHandler.hitCountsLock.release()
+
     @staticmethod
     def purgeLookupTable():
         '''
-        called by exitRoutine()
+        called by writeLookupTableToFile()
         if an entry doesn't have any file stored (all entry[encoding] == 0),
         then remove the entry to save space
         '''
+        if CacheHandler.index is None: # nothing loaded yet
+            return
         CacheHandler.lookupTableLock.acquire()
-
-        if CacheHandler.lookupTable is None or len(CacheHandler.lookupTable) == 0:
+        try:
+            CacheHandler.getIndex().purge()
+        finally:
             CacheHandler.lookupTableLock.release()
+
+    @staticmethod
+    def writeLookupTableToFile():
+        '''
+        called by CompactionThread
+        compact the cache index, eg for the json backend:
+        write the lookup table to cache_lookup_table.jsonl, then drop the journal records it contains
+
+        lookupTableLock is only held while the backend prepares the compaction,
+        the snapshot itself is written without blocking cache requests
+        '''
+        if CacheHandler.index is None: # nothing loaded yet
             return
 
-        purgedTable = []
-        for entry in CacheHandler.lookupTable:
-            entryFound = False
-            for encoding in entry:
-                if encoding == 'cacheFileNameFH' or encoding == 'expiry': # this is not an encoding key-value pair, continue
-                    continue
-                elif entry[encoding] != 0:
-                    entryFound = True
-                    break
-            if entryFound:
-                purgedTable.append(entry)
-        CacheHandler.lookupTable = purgedTable
+        CacheHandler.purgeLookupTable()
 
-        CacheHandler.lookupTableLock.release()
+        CacheHandler.lookupTableLock.acquire()
+        try:
+            compaction = CacheHandler.getIndex().beginCompaction()
+        finally:
+            CacheHandler.lookupTableLock.release()
+
+        CacheHandler.getIndex().finishCompaction(compaction)
+        print('cache table written to file')
 
     @staticmethod
-    def writeLookupTableToFile():
+    def getCacheRoot(shard=None):
         '''
-        called by exitRoutine()
-        when proxy program quits, write the lookup table back to cache_lookup_table.json
+        returns absolute path of directory holding cached files,
+        shard directory (see CacheShards) or cacheFileDirectory in origin if shard is None
         '''
+        if shard is not None:
+            return shard
         if CacheHandler.origin == '':
             CacheHandler.origin = os.getcwd()
+        return CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory
 
-        CacheHandler.lookupTableLock.acquire()
-        if CacheHandler.lookupTable is not None: # directly access instead of calling __getLookupTable
-            with open(CacheHandler.origin + '/' + 'cache_lookup_table.json', 'w') as table: # write new lookup table
-                json.dump(CacheHandler.lookupTable, table, indent=4)
-        CacheHandler.lookupTableLock.release()
-        print('cache table written to file')
+    @staticmethod
+    def getCacheFilePath(cacheFileNameFH, encoding, index, shard=None):
+        '''
+        returns absolute path of cached file `${FH}, ${encoding}, ${order}`, in shard if given (entry['shard'])
+        '''
+        return CacheHandler.getCacheRoot(shard) + cacheFileNameFH + ', ' + encoding + ', ' + str(index)
+
+    @staticmethod
+    def writeCacheFile(cacheFileName, fragments):
+        '''
+        write raw fragments one after another to cacheFileName
+        written to a temporary file first, then renamed,
+        so readers (and mmap of the old file) never see a partially written file
+        a body spilled to disk (see SpilledBody) is moved, not copied
+        '''
+        tempFileName = cacheFileName + '.' + str(threading.get_ident()) + '.tmp'
+        try:
+            if len(fragments) == 1 and isinstance(fragments[0], SpilledBody):
+                fragments[0].moveTo(tempFileName)
+            else:
+                with open(tempFileName, 'wb') as cacheFile: # write as byte
+                    for fragment in fragments:
+                        cacheFile.write(fragment)
+            os.replace(tempFileName, cacheFileName)
+        except Exception as e:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+            raise e
+
+    @staticmethod
+    def getMappedFile(cacheFileName):
+        '''
+        returns read-only memoryview of cacheFileName
+
+        all readers of the same file share one mmap, so pages come from page cache instead of the heap
+        the mapping is replaced when the file is replaced (different inode/ modification time),
+        a dropped mapping stays valid until the last memoryview of it is released
+        '''
+        stat = os.stat(cacheFileName)
+        version = (stat.st_ino, stat.st_mtime_ns)
+
+        CacheHandler.mappedFilesLock.acquire()
+        try:
+            mapped = CacheHandler.mappedFiles.get(cacheFileName)
+            if mapped is None or mapped[0] != version:
+                with open(cacheFileName, 'rb') as cacheFile:
+                    mapped = (version, mmap.mmap(cacheFile.fileno(), 0, access=mmap.ACCESS_READ))
+                CacheHandler.mappedFiles[cacheFileName] = mapped
+                if len(CacheHandler.mappedFiles) > CacheHandler.MAX_MAPPED_FILES:
+                    CacheHandler.mappedFiles.popitem(last=False)
+            else:
+                CacheHandler.mappedFiles.move_to_end(cacheFileName)
+        finally:
+            CacheHandler.mappedFilesLock.release()
+
+        return memoryview(mapped[1])
+
+    @staticmethod
+    def dropMappedFile(cacheFileName):
+        '''
+        called when cacheFileName is deleted, forget its shared mmap
+        '''
+        CacheHandler.mappedFilesLock.acquire()
+        CacheHandler.mappedFiles.pop(cacheFileName, None)
+        CacheHandler.mappedFilesLock.release()
 
     def __init__(self, rqp, rsps=None):
         '''
@@ -135,16 +355,43 @@ class CacheHandler:
         cacheFileDirectory:         @static
                                     cache responses storage directory
 
-        lookupTable:                @static
+        INDEX_BACKEND:              @static
+                                    cache index backend name, see CacheIndex
+
+        index:                      @static
+                                    cache index backend
 
         lookupTableLock:            @static
 
         chdirLock:                  @static
 
         hashedLocks:                @static
+                                    striped ReadWriteLock for cache files
 
         NUMSLOTS:                   @static
 
+        HEURISTIC_FRACTION:         @static
+
+        HEURISTIC_MAX_AGE:          @static
+
+        AT_REST_ENCODING:           @static
+                                    coding of compressed-at-rest bodies, see ContentCoding
+
+        AT_REST_LEVEL:              @static
+
+        AT_REST_MIN_SIZE:           @static
+
+        AT_REST_MAX_SIZE:           @static
+
+        MMAP_THRESHOLD:             @static
+
+        MAX_MAPPED_FILES:           @static
+
+        mappedFiles:                @static
+                                    path -> ((inode, mtime), mmap), least recently used first
+
+        mappedFilesLock:            @static
+
         holdingLookupTableLock:
 
         holdingChdirLock:
@@ -154,12 +401,24 @@ class CacheHandler:
         rqp:                        request packet
 
         rsps:                       response packets
+
+        fetchedEntry:               lookup table entry found by fetchResponses(), None if not fetched
+
+        fetchedKey:                 entry name of fetchedEntry
+
+        fetchedEncoding:            encoding of responses fetched by fetchResponses()
+
+        isTranscoded:               true if fetched responses were decoded, client does not accept the stored encoding
         '''
         self.holdingLookupTableLock = False
         self.holdingChdirLock = False
         self.holdingHashedLock = -1
         self.rqp = rqp
         self.rsps = rsps
+        self.fetchedEntry = None
+        self.fetchedKey = None
+        self.fetchedEncoding = None
+        self.isTranscoded = False
 
     def cacheResponses(self):
         '''
@@ -170,6 +429,7 @@ class CacheHandler:
             write the responses to cached_responses/ directory,
             with title: `${FH}, ${encoding}, ${order}`,
             with raw response as payload
+            (order 1: first response with header, order 2: all following fragments joined)
             update lookup file correspondingly
 
         assumed request method is GET
@@ -179,6 +439,16 @@ class CacheHandler:
         if self.rsps is None:
             return
 
+        responseSize = 0
+        for rsp in self.rsps:
+            try:
+                responseSize += len(rsp.getPacketRaw())
+            except AttributeError as e:
+                responseSize += len(rsp)
+        if responseSize > CacheHandler.MAX_CACHEABLE_SIZE:
+            print('CacheHandler:: cacheResponses: ' + str(responseSize) + ' bytes, too large to cache')
+            return
+
         cacheOption = self.rsps[0].getHeaderInfo('cache-control').lower()
         cacheOptionSplitted = cacheOption.split(',')
         for i in range(len(cacheOptionSplitted)):
@@ -190,222 +460,445 @@ class CacheHandler:
             if '' in cacheFileNameSplitted or len(cacheFileNameFH) > 255:
                 return
 
+            varyHeaders = self.__getVaryHeaders()
+            if varyHeaders is None: # Vary: *, response cannot be reused for any other request
+                return
+            cacheKey = cacheFileNameFH # entry of the url, or of the variant if response varies by request headers
+            if varyHeaders != []:
+                cacheKey = self.__getVariantKey(cacheFileNameFH, varyHeaders)
+
             # starting from this point, the entry should be chacheable
             CacheHandler.lookupTableLock.acquire() # put deleteFromCache in this critical section to make sure the file is not being manipulated
             self.holdingLookupTableLock = True
-            idx = self.__entryExists(cacheFileNameFH, releaseLookupTableLock=False) # remove previous cache files
-            if idx != -1: # entry found, delete file
+            entry = self.__getEntry(cacheFileNameFH, releaseLookupTableLock=False)
+            if entry is not None and CacheIndex.countFiles(entry) > 0: # entry found, delete previous cache files
                 try:
-                    self.deleteFromCache(releaseLookupTableLock=False)
+                    self.deleteFromCache(releaseLookupTableLock=False, cacheFileNameFH=cacheFileNameFH)
                 except Exception as e:
                     raise e
+            if cacheKey != cacheFileNameFH:
+                if self.__getEntry(cacheKey, releaseLookupTableLock=False) is not None: # previous files of this variant
+                    self.deleteFromCache(releaseLookupTableLock=False, cacheFileNameFH=cacheKey)
+                if entry is None or entry.get('vary', []) != varyHeaders: # url entry only records which request headers select the variant
+                    self.__updateLookup('ADD', cacheFileNameFH, 'nil', numFiles=0, metadata={'vary' : varyHeaders}, releaseLookupTableLock=False)
             CacheHandler.lookupTableLock.release()
             self.holdingLookupTableLock = False
 
             encoding = self.rsps[0].getHeaderInfo('content-encoding')
+            compressed = self.__compressAtRest(cacheOptionSplitted) # before taking the hashed lock, compression takes a while
+            if compressed is not None:
+                encoding = compressed[0]
             expiry = self.__getExpiry(cacheOptionSplitted)
-
-            self.__createDirectories(cacheFileNameSplitted)
-
-            fileHash = self.__getFileHash(cacheFileNameFH)
+            metadata = self.__getStaleWindows(cacheOptionSplitted)
+            metadata.update(self.__getValidators()) # of the origin's response, not the stored header
+            metadata['atRest'] = encoding if compressed is not None else None # stored header transformed by the proxy
+            if cacheKey == cacheFileNameFH:
+                metadata['vary'] = [] # response no longer varies
+
+            fragments = [] # raw fragments, in order
+            for rsp in self.rsps:
+                try:
+                    fragments.append(rsp.getPacketRaw())
+                except AttributeError as e:
+                    fragments.append(rsp)
+            if compressed is not None: # header and compressed body
+                fragments = compressed[1]
+
+            shard = None # files of entries without shard are in cacheFileDirectory
+            size = 0
+            if CacheShards.isEnabled():
+                for fragment in fragments:
+                    size += len(fragment)
+                shard = CacheShards.selectShard(cacheKey, size)
+                if shard is None:
+                    print('CacheHandler:: cacheResponses: every cache shard is full, not cached: ' + cacheKey)
+                    return
+            metadata['shard'] = shard # always set, entry may keep shard of files deleted above
+
+            self.__createDirectories(cacheFileNameSplitted, shard)
+
+            fileHash = self.__getFileHash(cacheKey)
             CacheHandler.hashedLocks[fileHash].acquire()
             self.holdingHashedLock = fileHash
 
+            files = [fragments[:1]] # first file holds the header, the rest of the body goes to one file, large bodies can then be mmap-ed
+            if len(fragments) > 1:
+                files.append(fragments[1:])
+
             index = 0
-            for rsp in self.rsps: # cache each responses
+            for fileFragments in files: # cache each file
                 index += 1
-                cacheFileName = CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory + cacheFileNameFH + ', ' + encoding + ', ' + str(index)
+                cacheFileName = CacheHandler.getCacheFilePath(cacheKey, encoding, index, shard)
                 try:
-                    with open(cacheFileName, 'wb') as cacheFile: # write as byte
-                        try:
-                            cacheFile.write(rsp.getPacketRaw())
-                        except AttributeError as e:
-                            cacheFile.write(rsp)
-                        except OSError as e:
-                            print(e)
+                    CacheHandler.writeCacheFile(cacheFileName, fileFragments)
                 except Exception as e:
-                    CacheHandler.lookupTableLock.release()
-                    self.holdingLookupTableLock = False
-
                     CacheHandler.hashedLocks[fileHash].release()
                     self.holdingHashedLock = -1
 
                     raise e
 
-            CacheHandler.lookupTableLock.acquire() # add file operation, make sure lookup table is not modified
-            self.holdingLookupTableLock = True
-            try:
-                self.__updateLookup('ADD', cacheFileNameFH, encoding, numFiles=index, expiry=expiry)
-            except Exception as e:
-                CacheHandler.lookupTableLock.release()
-                self.holdingLookupTableLock = False
-                raise e
-
             CacheHandler.hashedLocks[fileHash].release()
             self.holdingHashedLock = -1
 
-    def fetchResponses(self): # fetch all related responses, return list of response packets (not raw)
+            # hashed lock released first, lookupTableLock is always taken before a hashed lock (see deleteFromCache)
+            self.__updateLookup('ADD', cacheKey, encoding, numFiles=index, expiry=expiry, metadata=metadata)
+            if shard is not None:
+                CacheShards.addUsage(shard, size)
+            CacheHandler.__resetHits(cacheKey) # hits count per freshness lifetime
+
+    def fetchResponses(self, countHit=True): # fetch all related responses, return list of response packets (not raw)
         '''
         handle fetch request
         returns list of response packets fetched and expiration time
         if nothing fetched, return (None, None)
+        countHit is false for background fetches (eg RevalidationThread), they are not hits of a client
+
+        the entry is looked up by getCacheKey(), i.e. the variant matching rqp if the url varies,
+        of the encodings stored, the one preferred by accept-encoding is fetched (see __negotiateEncoding)
         '''
-        if self.rqp.getMethod().lower() == 'get':
-            cacheFileNameFH, cacheFileNameSplitted = self.__getCacheFileNameFH() # cache response file name first half, splitted is useless here
+        if self.rqp.getMethod().lower() != 'get': # fetching from cache only applies to GET method
+            return (None, None)
+        if not CacheHandler.isIndexLoaded(): # still loading in background, don't wait for it
+            print('CacheHandler:: fetchResponses: cache index not loaded yet, treated as miss')
+            return (None, None)
 
-            CacheHandler.lookupTableLock.acquire()
-            self.holdingLookupTableLock = True
+        cacheFileNameFH = self.getCacheKey()
 
-            idx = self.__entryExists(cacheFileNameFH, releaseLookupTableLock=False) # get index of entry, -1 if none; no need to lock entire function since the index will not change until Proxy closes
-            if idx == -1: # no entry of such file exists
-                CacheHandler.lookupTableLock.release()
-                self.holdingLookupTableLock = False
-                return (None, None)
+        entry = self.__getEntry(cacheFileNameFH) # lookupTableLock is released after read
+        if entry is None: # no entry of such file exists
+            return (None, None)
 
-            entry = self.__getLookupTable()[idx]
+        encoding = self.__negotiateEncoding(entry)
+        if encoding is None: # decode a stored encoding if client accepts identity
+            encoding = self.__getDecodableEncoding(entry)
+            self.isTranscoded = encoding is not None
+        elif encoding not in ['nil', 'identity'] and ContentCoding.isAvailable(encoding) and self.__negotiateEncoding({'identity' : 1, encoding : 1}) == 'identity':
+            self.isTranscoded = True # client prefers identity, eg no accept-encoding
+        if encoding is None: # nothing stored, or no stored encoding acceptable to client
+            print('CacheHandler:: fetchResponses: no acceptable encoding cached')
+            return (None, None)
+        self.fetchedEntry = entry
+        self.fetchedKey = cacheFileNameFH
+        self.fetchedEncoding = encoding
 
-            CacheHandler.lookupTableLock.release()
-            self.holdingLookupTableLock = False
+        expiry = entry['expiry']
+        print('CacheHandler:: fetchResponses: expiry: ' + expiry + ', encoding: ' + encoding)
 
-            expiry = entry['expiry']
-            print('CacheHandler:: fetchResponses: expiry: ' + expiry)
-
-            encodings = self.rqp.getHeaderInfo('accept-encoding')
-            if encodings == 'nil':
-                encodings = ['*']
-            encodingsSplitted = encodings.split(',')
-            for i in range(len(encodingsSplitted)):
-                encodingsSplitted[i] = encodingsSplitted[i].strip()
-
-            for encoding in encodingsSplitted:
-                print('CacheHandler:: fetchResponses: in loop: ' + encoding)
-                if encoding == '*': # accept any encoding
-                    for encoding in entry: # loop through key value pairs for the entry
-                        if encoding == 'cacheFileNameFH' or encoding == 'expiry': # this is not an encoding key-value pair, continue
-                            continue
-                        if entry[encoding] != 0: # any one encoding that cached file is not 0, including 'nil'
-                            numFiles = entry[encoding]
-                            rsps = [] # list of response packets
-
-                            fileHash = self.__getFileHash(cacheFileNameFH)
-                            CacheHandler.hashedLocks[fileHash].acquire()
-                            self.holdingHashedLock = fileHash
-
-                            for i in range(1, numFiles + 1):
-                                try:
-                                    with open(CacheHandler.cacheFileDirectory + cacheFileNameFH + ', ' + encoding + ', ' + str(i), 'rb') as responseFile:
-                                        responseRaw = responseFile.read()
-                                    try:
-                                        rsps.append(ResponsePacket.parsePacket(responseRaw))
-                                    except TypeError as e:
-                                        rsps.append(responseRaw)
-                                except Exception as e:
-                                    CacheHandler.hashedLocks[fileHash].release()
-                                    self.holdingHashedLock = -1
-                                    print('could not find entry that should be present')
-                                    raise e
-
-                            CacheHandler.hashedLocks[fileHash].release()
-                            self.holdingHashedLock = -1
-
-                            return (rsps, expiry)
-                    raise Exception('could not find entry that should be present')
-
-                if entry[encoding] != 0: # encoding specified is not '*'
-                    numFiles = int(entry[encoding])
-                    rsps = []
-
-                    fileHash = self.__getFileHash(cacheFileNameFH)
-                    CacheHandler.hashedLocks[fileHash].acquire()
-                    self.holdingHashedLock = fileHash
-
-                    for i in range(1, numFiles + 1):
-                        try:
-                            with open(CacheHandler.cacheFileDirectory + cacheFileNameFH+ ', ' + encoding + ', ' + str(i), 'rb') as responseFile:
-                                responseRaw = responseFile.read()
-                            try:
-                                rsps.append(ResponsePacket.parsePacket(responseRaw))
-                            except TypeError as e:
-                                rsps.append(responseRaw)
-                        except Exception as e:
-                            CacheHandler.hashedLocks[fileHash].release()
-                            self.holdingHashedLock = -1
-                            # raise Exception('could not find entry that should be present')
-                            print('could not find entry that should be present')
-                            return (None, None)
-                            # raise e
+        fileHash = self.__getFileHash(cacheFileNameFH)
+        CacheHandler.hashedLocks[fileHash].acquireRead() # other readers of the file are not blocked
+        self.holdingHashedLock = fileHash
 
-                    CacheHandler.hashedLocks[fileHash].release()
-                    self.holdingHashedLock = -1
-                    return (rsps, expiry)
+        try:
+            rsps = self.__readCacheFiles(cacheFileNameFH, encoding, int(entry[encoding]), entry.get('shard'))
+        except FileNotFoundError as e:
+            CacheHandler.hashedLocks[fileHash].releaseRead()
+            self.holdingHashedLock = -1
+            print('could not find entry that should be present')
+            self.__dropDanglingEntry(cacheFileNameFH, entry)
             return (None, None)
-        else: # fetching from cache only applies to GET method
+        except Exception as e:
+            CacheHandler.hashedLocks[fileHash].releaseRead()
+            self.holdingHashedLock = -1
+            print('CacheHandler:: fetchResponses: failed to read ' + cacheFileNameFH + ': ' + str(e))
             return (None, None)
 
-    def deleteFromCache(self, releaseLookupTableLock=True): # get number of files cached, delete them all
+        CacheHandler.hashedLocks[fileHash].releaseRead()
+        self.holdingHashedLock = -1
+        if countHit:
+            CacheHandler.__countHit(cacheFileNameFH)
+
+        if self.isTranscoded:
+            rsps = self.__decodeResponses(rsps, encoding)
+            if rsps is None:
+                return (None, None)
+            print('CacheHandler:: fetchResponses: decoded ' + encoding + ' for client')
+        return (rsps, expiry)
+
+    def __dropDanglingEntry(self, cacheFileNameFH, entry):
         '''
-        delete all cache responses matching file url
-        update lookup file correspondingly
+        files of entry are missing (eg removed while proxy was down), delete the entry
+        files are validated lazily this way, not when the index is loaded
         '''
-        cacheFileNameFH, cacheFileNameSplitted = self.__getCacheFileNameFH() # cache response file name first half, splitted is useless here
+        CacheHandler.lookupTableLock.acquire()
+        self.holdingLookupTableLock = True
+        try:
+            if self.__getEntry(cacheFileNameFH, releaseLookupTableLock=False) == entry: # not replaced meanwhile
+                print('CacheHandler:: __dropDanglingEntry: files missing, entry deleted: ' + cacheFileNameFH)
+                self.deleteFromCache(cacheFileNameFH=cacheFileNameFH) # releases lookupTableLock before removing files
+        except Exception as e:
+            print('CacheHandler:: __dropDanglingEntry: ' + str(e))
+        finally:
+            if self.holdingLookupTableLock:
+                CacheHandler.lookupTableLock.release()
+                self.holdingLookupTableLock = False
+
+    def refreshResponses(self, cachedResponses, notModifiedResponse):
+        '''
+        handle 304 Not Modified received when revalidating responses fetched by fetchResponses()
+        header fields of notModifiedResponse replace those of the cached header (RFC 9111 4.3.4),
+        the cached header file, expiry, stale windows and validators of the entry are updated
+        a header transformed by the proxy (compressed at rest, or decoded for client) keeps its weak etag
+        and accept-encoding in vary, the entry keeps the origin's validators for revalidation
+        returns the cached responses with updated header
+        '''
+        NOT_UPDATED_FIELDS = ['content-length', 'transfer-encoding', 'content-encoding', 'content-range', 'connection', 'keep-alive']
+        updatedFields = {} # field name -> header lines of notModifiedResponse
+        for ss in notModifiedResponse.getHeaderSplitted():
+            fieldName = ss.split(':')[0].strip().lower()
+            if fieldName != '' and fieldName not in NOT_UPDATED_FIELDS:
+                updatedFields.setdefault(fieldName, []).append(ss)
+
+        headerSplitted = []
+        for ss in cachedResponses[0].getHeaderSplitted():
+            if ss.split(':')[0].strip().lower() not in updatedFields:
+                headerSplitted.append(ss)
+        for fieldName in updatedFields:
+            headerSplitted += updatedFields[fieldName]
+
+        header = ResponsePacket()
+        header.setResponseLine(cachedResponses[0].getResponseLine())
+        header.setHeaderSplitted(headerSplitted)
+        header.setPayload(cachedResponses[0].getPayload())
+        transformed = self.isTranscoded or (self.fetchedEntry is not None and self.fetchedEntry.get('atRest') == self.fetchedEncoding)
+        if transformed:
+            if header.getHeaderInfo('etag') != 'nil':
+                header.setHeader('ETag', ContentCoding.weakenETag(header.getHeaderInfo('etag')))
+            header.setHeader('Vary', ContentCoding.addVary(header.getHeaderInfo('vary'), 'Accept-Encoding'))
+        self.rsps = [header] + cachedResponses[1:]
+
+        if self.fetchedEntry is None:
+            return self.rsps
+
+        cacheOptionSplitted = header.getHeaderInfo('cache-control').lower().split(',')
+        for i in range(len(cacheOptionSplitted)):
+            cacheOptionSplitted[i] = cacheOptionSplitted[i].strip()
+        if 'no-store' in cacheOptionSplitted or 'private' in cacheOptionSplitted: # no longer cacheable, next request deletes it once expired
+            return self.rsps
+
+        metadata = self.__getStaleWindows(cacheOptionSplitted)
+        metadata.update(self.__getValidators())
+        if transformed and notModifiedResponse.getHeaderInfo('etag') == 'nil': # header holds the weakened etag
+            metadata['etag'] = self.fetchedEntry.get('etag', 'nil')
+        metadata['expiry'] = self.__getExpiry(cacheOptionSplitted)
+
+        fileHash = self.__getFileHash(self.fetchedKey)
+        CacheHandler.hashedLocks[fileHash].acquire()
+        self.holdingHashedLock = fileHash
+        refreshed = False
+        try:
+            entry = self.__getEntry(self.fetchedKey)
+            if entry is not None and entry.get(self.fetchedEncoding, 0) == self.fetchedEntry[self.fetchedEncoding]: # not replaced meanwhile
+                if not self.isTranscoded: # header of decoded responses does not describe the stored file
+                    CacheHandler.writeCacheFile(CacheHandler.getCacheFilePath(self.fetchedKey, self.fetchedEncoding, 1, self.fetchedEntry.get('shard')), [header.getPacketRaw()])
+                refreshed = True
+        except Exception as e:
+            print('CacheHandler:: refreshResponses: failed to refresh ' + self.fetchedKey + ': ' + str(e))
+        finally:
+            CacheHandler.hashedLocks[fileHash].release()
+            self.holdingHashedLock = -1
+
+        if refreshed: # hashed lock released first, deleteFromCache takes the locks in the other order
+            self.__updateLookup('REFRESH', self.fetchedKey, metadata=metadata)
+            print('CacheHandler:: refreshResponses: refreshed ' + self.fetchedKey + ', expiry: ' + metadata['expiry'])
+        return self.rsps
 
+    def deleteFromCache(self, releaseLookupTableLock=True, cacheFileNameFH=None): # get number of files cached, delete them all
+        '''
+        delete all cache responses matching file url (the variant matching rqp if the url varies)
+        or entry cacheFileNameFH if given
+        update lookup file correspondingly
+        returns number of bytes removed, None if there is no such entry
+        '''
         if not self.holdingLookupTableLock:
             CacheHandler.lookupTableLock.acquire()
             self.holdingLookupTableLock = True
             releaseLookupTableLock = True
 
-        idx = self.__entryExists(cacheFileNameFH, releaseLookupTableLock=False)
-        if idx == -1:
+        if cacheFileNameFH is None:
+            cacheFileNameFH = self.getCacheKey()
+
+        entry = self.__getEntry(cacheFileNameFH, releaseLookupTableLock=False)
+        if entry is None:
             if releaseLookupTableLock:
                 CacheHandler.lookupTableLock.release()
                 self.holdingLookupTableLock = False
-            return
-        entry = self.__getLookupTable()[idx]
-
-        if releaseLookupTableLock:
-            CacheHandler.lookupTableLock.release()
-            self.holdingLookupTableLock = False
-
-        for encoding in entry: # delete every encoding for the file name
-            if encoding == 'cacheFileNameFH' or encoding == 'expiry': # not encodings
-                continue
-            numFiles = entry[encoding] # number of files stored for this encoded file
-            if numFiles == '0':
-                continue
+            return None
 
-            fileHash = self.__getFileHash(cacheFileNameFH)
-            CacheHandler.hashedLocks[fileHash].acquire()
-            self.holdingHashedLock = fileHash
+        # hashed lock taken before lookupTableLock is released and held until the files are removed,
+        # so files written for the key meanwhile (cacheResponses, under the hashed lock) are never removed by this delete
+        fileHash = self.__getFileHash(cacheFileNameFH)
+        CacheHandler.hashedLocks[fileHash].acquire()
+        self.holdingHashedLock = fileHash
 
-            for i in range(1, int(numFiles) + 1):
-                cacheFileName = CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory + cacheFileNameFH + ', ' + encoding + ', ' + str(i)
-                try:
-                    os.remove(cacheFileName)
-                except Exception as e:
-                    CacheHandler.hashedLocks[fileHash].release()
-                    self.holdingHashedLock = -1
-                    raise Exception('CacheHandler:: deleteFromCache: lookup table and data mismatch -> Corruption detected')
+        removedBytes = 0
+        try:
+            # remove the entry from the index before the files, fetching with an entry read before tolerates missing files
+            self.__updateLookup('DEL', cacheFileNameFH, releaseLookupTableLock=releaseLookupTableLock) # delete entire entry, because all encodings are deleted
 
+            for encoding in entry: # delete every encoding for the file name
+                if encoding in CacheIndex.METADATA_KEYS: # not encodings
+                    continue
+                numFiles = entry[encoding] # number of files stored for this encoded file
+                for i in range(1, int(numFiles) + 1):
+                    cacheFileName = CacheHandler.getCacheFilePath(cacheFileNameFH, encoding, i, entry.get('shard'))
+                    try:
+                        removedBytes += os.path.getsize(cacheFileName)
+                        os.remove(cacheFileName)
+                    except FileNotFoundError as e: # removed already, nothing to do
+                        pass
+                    except Exception as e:
+                        raise Exception('CacheHandler:: deleteFromCache: lookup table and data mismatch -> Corruption detected')
+                    CacheHandler.dropMappedFile(cacheFileName)
+        finally:
             CacheHandler.hashedLocks[fileHash].release()
             self.holdingHashedLock = -1
-        try:
-            if not self.holdingLookupTableLock:
-                CacheHandler.lookupTableLock.acquire()
-                self.holdingLookupTableLock = True
+        if entry.get('shard') is not None:
+            CacheShards.addUsage(entry['shard'], -removedBytes)
+        return removedBytes
 
-            self.__updateLookup('DEL', cacheFileNameFH) # delete entire entry, because all encodings are deleted
+    def purgeUrl(self):
+        '''
+        called by AdminHandler
+        delete url of rqp: its entry, every variant (Vary) and every encoding
+        returns (number of entries deleted, number of bytes removed)
+        '''
+        cacheFileNameFH, cacheFileNameSplitted = self.__getCacheFileNameFH()
+        variantKeys = CacheHandler.getIndex().getKeys(cacheFileNameFH + '#')
+        return CacheHandler.purgeKeys([cacheFileNameFH] + variantKeys)
 
-            if releaseLookupTableLock:
-                CacheHandler.lookupTableLock.release()
-                self.holdingLookupTableLock = False
-        except Exception as e:
-            raise e
+    def getUrlKey(self):
+        '''
+        returns the cache key of the url of rqp, regardless of Vary
+        '''
+        cacheFileNameFH, cacheFileNameSplitted = self.__getCacheFileNameFH()
+        return cacheFileNameFH
+
+    def getCacheKey(self):
+        '''
+        returns the cache key (entry name) of rqp
+        if responses of the url vary by request headers (Vary), returns the key of the variant matching rqp
+        (the url key while the index is loading)
+        '''
+        cacheFileNameFH, cacheFileNameSplitted = self.__getCacheFileNameFH()
+        if not self.holdingLookupTableLock and not CacheHandler.isIndexLoaded():
+            return cacheFileNameFH
+        entry = self.__getEntry(cacheFileNameFH, releaseLookupTableLock=not self.holdingLookupTableLock) # keep the lock if caller holds it
+        if entry is None or entry.get('vary', []) == []:
+            return cacheFileNameFH
+        return self.__getVariantKey(cacheFileNameFH, entry['vary'])
+
+    def getResponseKey(self):
+        '''
+        returns the cache key cacheResponses() stores rsps (responses to rqp) under:
+        the variant selected by Vary of the response, the url key if it does not vary
+        unlike getCacheKey(), the index is not needed, it may not know the variant yet
+        returns None if the response cannot be stored (Vary: *)
+        '''
+        cacheFileNameFH, cacheFileNameSplitted = self.__getCacheFileNameFH()
+        varyHeaders = self.__getVaryHeaders()
+        if varyHeaders is None:
+            return None
+        if varyHeaders == []:
+            return cacheFileNameFH
+        return self.__getVariantKey(cacheFileNameFH, varyHeaders)
+
+    def __getVaryHeaders(self):
+        '''
+        returns sorted list of request header names listed in Vary of the response
+        accept-encoding is left out, encodings are stored side by side in the entry
+        returns None if Vary is '*'
+        '''
+        vary = self.rsps[0].getHeaderInfo('vary')
+        if vary == 'nil':
+            return []
+        varyHeaders = []
+        for fieldName in vary.lower().split(','):
+            fieldName = fieldName.strip()
+            if fieldName == '*':
+                return None
+            if fieldName != '' and fieldName != 'accept-encoding' and fieldName not in varyHeaders:
+                varyHeaders.append(fieldName)
+        varyHeaders.sort()
+        return varyHeaders
+
+    def __getVariantKey(self, cacheFileNameFH, varyHeaders):
+        '''
+        returns entry name of the variant selected by values of varyHeaders in rqp
+        '#' never appears in a request path, so variant keys never clash with urls
+        '''
+        values = []
+        for fieldName in varyHeaders:
+            values.append(fieldName + ':' + self.rqp.getHeaderInfo(fieldName))
+        return cacheFileNameFH + '#' + hashlib.sha1('\n'.join(values).encode()).hexdigest()[:16]
+
+    def __negotiateEncoding(self, entry):
+        '''
+        returns the encoding stored in entry most preferred by accept-encoding of rqp
+        returns None if no stored encoding is acceptable
 
-    def __updateLookup(self, method, cacheFileNameFH, encoding='', numFiles=1, expiry='nil', releaseLookupTableLock=True):
+        stored encodings 'nil' (no content-encoding) and 'identity' are both identity,
+        identity is acceptable unless excluded by q=0 (explicitly or by '*;q=0')
+        no accept-encoding: any encoding acceptable, identity preferred
+        ranking: q-value, then listed explicitly before matched by '*', then order in accept-encoding
+        '''
+        qValues, order = ContentCoding.parseAcceptEncoding(self.rqp.getHeaderInfo('accept-encoding'))
+
+        bestEncoding = None
+        bestRank = None
+        for encoding in entry:
+            if encoding in CacheIndex.METADATA_KEYS or int(entry[encoding]) == 0: # not an encoding, or nothing stored
+                continue
+            coding = encoding.lower()
+            if coding == 'nil':
+                coding = 'identity'
+
+            if coding in qValues:
+                q = qValues[coding]
+                explicit = 1
+            elif '*' in qValues:
+                q = qValues['*']
+                explicit = 0
+            elif coding == 'identity':
+                q = 1.0
+                explicit = 0
+            else:
+                continue
+            if q <= 0: # not acceptable
+                continue
+
+            position = order.index(coding) if coding in order else len(order)
+            rank = (q, explicit, -position)
+            if bestRank is None or rank > bestRank:
+                bestEncoding = encoding
+                bestRank = rank
+        return bestEncoding
+
+    def __readCacheFiles(self, cacheFileNameFH, encoding, numFiles, shard=None):
+        '''
+        read cached files of one encoding (stored in shard), returns list of response packets/ raw payloads
+        payload files larger than MMAP_THRESHOLD are returned as memoryview of a shared mmap
+        the caller should hold the hashed lock
+        '''
+        rsps = []
+        for i in range(1, numFiles + 1):
+            cacheFileName = CacheHandler.getCacheFilePath(cacheFileNameFH, encoding, i, shard)
+            if i > 1 and os.path.getsize(cacheFileName) > CacheHandler.MMAP_THRESHOLD: # first file holds the header, never mapped
+                rsps.append(CacheHandler.getMappedFile(cacheFileName))
+                continue
+            with open(cacheFileName, 'rb') as responseFile:
+                responseRaw = responseFile.read()
+            try:
+                rsps.append(ResponsePacket.parsePacket(responseRaw))
+            except TypeError as e:
+                rsps.append(responseRaw)
+        return rsps
+
+    def __updateLookup(self, method, cacheFileNameFH, encoding='', numFiles=1, expiry='nil', metadata={}, releaseLookupTableLock=True):
         '''
         update lookup table according to method
-        ADD: add record/ entry to lookup table
-        DEL: delete record/ entry from lookup table, ignores encoding, numFiles
+        ADD: add record/ entry to lookup table, metadata (see CacheIndex.METADATA_KEYS) is stored in entry
+        DEL: delete record/ entry from lookup table, ignores encoding, numFiles, metadata
+        REFRESH: update metadata of existing entry only (after 304), ignores encoding, numFiles, expiry
         '''
         if not self.holdingLookupTableLock:
             CacheHandler.lookupTableLock.acquire()
@@ -415,79 +908,85 @@ class CacheHandler:
         if CacheHandler.origin is None: # unlikely
             CacheHandler.origin = os.getcwd()
 
-        idx = self.__entryExists(cacheFileNameFH, releaseLookupTableLock=False)
-
+        entry = self.__getEntry(cacheFileNameFH, releaseLookupTableLock=False)
 
         if method == 'ADD':
-            if idx == -1: # no existing entry found
-                newEntry = self.__generateJSON(cacheFileNameFH) # create new entry
-                try:
-                    newEntry.update({encoding : numFiles})
-                    if expiry != 'nil':
-                        newEntry.update({'expiry' : expiry})
-                except Exception as e:
-                    if releaseLookupTableLock:
-                        CacheHandler.lookupTableLock.release()
-                        releaseLookupTableLock = False
-                    raise e
-                self.__getLookupTable().append(newEntry)
-            else: # entry found
-                try:
-                    entry = self.__getLookupTable()[idx]
-                    entry.update({encoding : numFiles})
-                    if expiry != 'nil':
-                        entry.update({'expiry' : expiry})
-                    CacheHandler.lookupTable[idx] = entry
-                except Exception as e:
-                    if releaseLookupTableLock:
-                        CacheHandler.lookupTableLock.release()
-                        releaseLookupTableLock = False
-                    raise e
+            try:
+                if entry is None: # no existing entry found
+                    entry = self.__generateJSON(cacheFileNameFH) # create new entry
+                else: # entry found, don't modify the entry held by index
+                    entry = dict(entry)
+                entry.update({encoding : numFiles})
+                entry.update({'expiry' : expiry}) # 'nil' too, expiry of deleted responses must not be kept
+                entry.update(metadata)
+                CacheHandler.getIndex().putEntry(method, entry)
+            except Exception as e:
+                if releaseLookupTableLock:
+                    CacheHandler.lookupTableLock.release()
+                    self.holdingLookupTableLock = False
+                    releaseLookupTableLock = False
+                raise e
+
+        elif method == 'REFRESH':
+            if entry is not None: # deleted meanwhile, nothing to refresh
+                entry = dict(entry)
+                entry.update(metadata)
+                CacheHandler.getIndex().putEntry(method, entry)
 
         elif method == 'DEL':
-            if idx == -1: # something wrong
+            if entry is None: # something wrong
                 if releaseLookupTableLock:
                     CacheHandler.lookupTableLock.release()
+                    self.holdingLookupTableLock = False
                     releaseLookupTableLock = False
                 raise Exception('CacheHandler:: __updateLookup(): attempted to delete non-existing entry')
             else:
-                entry = self.__getLookupTable()[idx]
+                entry = dict(entry)
                 for encoding in entry:
-                    if encoding == 'cacheFileNameFH' or encoding == 'expiry': # this is not an encoding key-value pair, continue
+                    if encoding in CacheIndex.METADATA_KEYS: # this is not an encoding key-value pair, continue
                         continue
                     entry.update({encoding : 0})
-                CacheHandler.lookupTable[idx] = entry
+                if entry.get('vary', []) != []: # url entry of variants, only deleted by purge, together with the variants
+                    entry['vary'] = []
+                CacheHandler.getIndex().putEntry(method, entry)
         else:
             if releaseLookupTableLock:
                 CacheHandler.lookupTableLock.release()
+                self.holdingLookupTableLock = False
                 releaseLookupTableLock = False
             raise Exception('CacheHandler:: __updateLookup(): invalid method: ' + method)
 
         if releaseLookupTableLock:
             CacheHandler.lookupTableLock.release()
+            self.holdingLookupTableLock = False
             releaseLookupTableLock = False
 
-    def __entryExists(self, cacheFileNameFH, releaseLookupTableLock=True):
+    def __getEntry(self, cacheFileNameFH, releaseLookupTableLock=True):
         '''
-        check if an entry with name: cacheFileNameFH exists
-        if yes then return the index of entry
-        else return -1
+        returns the entry with name: cacheFileNameFH
+        returns None if not found
+
+        if index backend supports concurrent reads,
+        lookupTableLock is not needed for a read that releases the lock anyway,
+        such reads may miss changes not published yet (see CacheIndex.readEntry)
         '''
+        index = CacheHandler.getIndex()
+
+        if releaseLookupTableLock and not self.holdingLookupTableLock and index.CONCURRENT_READS:
+            return index.readEntry(cacheFileNameFH)
+
         if not self.holdingLookupTableLock:
             CacheHandler.lookupTableLock.acquire()
             self.holdingLookupTableLock = True
 
-        entries = self.__getLookupTable()
-
-        if releaseLookupTableLock:
-            CacheHandler.lookupTableLock.release()
-            self.holdingLookupTableLock = False
-
-        for idx in range(len(entries)):
-            if entries[idx]['cacheFileNameFH'] == cacheFileNameFH:
-                return idx
+        try:
+            entry = index.getEntry(cacheFileNameFH)
+        finally:
+            if releaseLookupTableLock:
+                CacheHandler.lookupTableLock.release()
+                self.holdingLookupTableLock = False
 
-        return -1
+        return entry
 
     def __generateJSON(self, cacheFileNameFH):
         '''
@@ -508,10 +1007,12 @@ class CacheHandler:
     def __getCacheFileNameFH(self):
         '''
         from rqp, generate entry name
+        host and query are normalized (see CacheKey), so urls naming the same content share the entry
         '''
-        cacheFileNameSplitted = [self.rqp.getHostName()]
-        if self.rqp.getFilePath() != '/':
-            filePathSplitted = self.rqp.getFilePath()[1:].split('/')
+        host, filePath = CacheKey.normalize(self.rqp.getHostName(), self.rqp.getFilePath())
+        cacheFileNameSplitted = [host]
+        if filePath != '/':
+            filePathSplitted = filePath[1:].split('/')
             for subPath in filePathSplitted:
                 cacheFileNameSplitted.append(subPath)
         cacheFileNameFH = ''
@@ -522,30 +1023,42 @@ class CacheHandler:
     def __getExpiry(self, cacheOptionSplitted):
         '''
         get the expiration time from cacheOptionSplitted
-        calculated from current time
+        calculated from date of response (current time if not specified)
+        s-maxage, then max-age, then Expires header,
+        otherwise heuristic freshness from Last-Modified (see __getHeuristicFreshness)
         '''
         expiry = 'nil' # default expiration is nil
 
+        responseDate = self.rsps[0].getHeaderInfo('date')
+        try:
+            responseTime = TimeComparator(responseDate)
+        except Exception as e: # date of retrieval not specified/ malformed
+            responseTime = TimeComparator.currentTime() # use current time
+
         for option in cacheOptionSplitted:
             if option[0:len('max-age')].lower() == 'max-age':
                 secondStr = option.split('=')[1]
-                responseDate = self.rsps[0].getHeaderInfo('date')
-                if responseDate == 'nil': # date of retrieval not specified
-                    expiry = (TimeComparator.currentTime() + secondStr).toString() # use current time
-                else:
-                    expiry = (TimeComparator(responseDate) + secondStr).toString()
+                expiry = (responseTime + secondStr).toString()
                 break
 
         for option in cacheOptionSplitted: # overwrite expiry from max-age with s-maxage
             if option[0:len('s-maxage')].lower() == 's-maxage':
                 secondStr = option.split('=')[1]
-                responseDate = self.rsps[0].getHeaderInfo('date')
-                if responseDate == 'nil':
-                    expiry = (TimeComparator.currentTime() + secondStr).toString()
-                else:
-                    expiry = (TimeComparator(responseDate) + secondStr).toString()
+                expiry = (responseTime + secondStr).toString()
                 break
 
+        if expiry == 'nil':
+            expires = self.rsps[0].getHeaderInfo('expires')
+            if expires != 'nil':
+                try:
+                    expiry = TimeComparator(expires).toString()
+                except Exception as e: # invalid date means already expired
+                    expiry = responseTime.toString()
+            else:
+                freshness = self.__getHeuristicFreshness(responseTime)
+                if freshness > 0:
+                    expiry = (responseTime + freshness).toString()
+
         for option in cacheOptionSplitted: # don't do anything on expiry if must revalidate
             if option == 'must-revalidate' or option == 'proxy-revalidate' or option == 'no-cache':
                 expiry = 'nil' # overwrite expiry back to 'nil'
@@ -553,23 +1066,162 @@ class CacheHandler:
 
         return expiry
 
-    def __createDirectories(self, cacheFileNameSplitted):
+    def __compressAtRest(self, cacheOptionSplitted):
+        '''
+        returns (encoding, fragments) to store the response compressed with AT_REST_ENCODING
+        returns None if it is stored as received:
+            not 200, encoded already, content type not compressible, no-transform,
+            body incomplete/ smaller than AT_REST_MIN_SIZE/ larger than AT_REST_MAX_SIZE, or compression does not pay off
+
+        the stored header describes the stored body: content-encoding, content-length,
+        etag weakened and vary extended by accept-encoding, as the representation is transformed by the proxy
+        '''
+        coding = CacheHandler.AT_REST_ENCODING
+        if coding is None or not ContentCoding.isAvailable(coding):
+            return None
+        header = self.rsps[0]
+        if header.responseCode() != '200' or 'no-transform' in cacheOptionSplitted:
+            return None
+        if SpilledBody.isSpilled(self.rsps): # too large for memory
+            return None
+        if header.getHeaderInfo('content-encoding') not in ['nil', 'identity']:
+            return None
+        if not ContentCoding.isCompressible(header.getHeaderInfo('content-type')):
+            return None
+
+        pieces = RangeHandler.getBody(self.rsps)
+        if pieces is None:
+            return None
+        size = 0
+        for piece in pieces:
+            size += len(piece)
+        if size < CacheHandler.AT_REST_MIN_SIZE or size > CacheHandler.AT_REST_MAX_SIZE:
+            return None
+
+        body = ContentCoding.encode(b''.join(pieces), coding, CacheHandler.AT_REST_LEVEL)
+        if len(body) >= size:
+            return None
+
+        storedHeader = header.copyHeader()
+        storedHeader.removeHeader('transfer-encoding')
+        storedHeader.setHeader('Content-Encoding', coding)
+        storedHeader.setHeader('Content-Length', str(len(body)))
+        if header.getHeaderInfo('etag') != 'nil':
+            storedHeader.setHeader('ETag', ContentCoding.weakenETag(header.getHeaderInfo('etag')))
+        storedHeader.setHeader('Vary', ContentCoding.addVary(header.getHeaderInfo('vary'), 'Accept-Encoding'))
+        print('CacheHandler:: __compressAtRest: ' + str(size) + ' bytes stored as ' + str(len(body)) + ' bytes ' + coding)
+        return (coding, [storedHeader.getPacketRaw(), body])
+
+    def __getDecodableEncoding(self, entry):
+        '''
+        returns a stored encoding of entry the proxy can decode, if client accepts identity
+        returns None otherwise
+        '''
+        if self.__negotiateEncoding({'identity' : 1}) is None: # identity not acceptable to client
+            return None
+        for encoding in entry:
+            if encoding in CacheIndex.METADATA_KEYS or int(entry[encoding]) == 0:
+                continue
+            if ContentCoding.isAvailable(encoding):
+                return encoding
+        return None
+
+    def __decodeResponses(self, rsps, encoding):
+        '''
+        returns cached responses with encoding removed, as one response packet
+        returns None if the responses must not be transformed (no-transform) or cannot be decoded
+        '''
+        header = rsps[0]
+        cacheOptionSplitted = header.getHeaderInfo('cache-control').lower().split(',')
+        for option in cacheOptionSplitted:
+            if option.strip() == 'no-transform':
+                return None
+        pieces = RangeHandler.getBody(rsps)
+        if pieces is None:
+            return None
+        try:
+            body = ContentCoding.decode(b''.join(pieces), encoding)
+        except Exception as e:
+            print('CacheHandler:: __decodeResponses: failed to decode ' + encoding + ': ' + str(e))
+            return None
+
+        decoded = header.copyHeader()
+        decoded.removeHeader('content-encoding')
+        decoded.removeHeader('transfer-encoding')
+        decoded.setHeader('Content-Length', str(len(body)))
+        if header.getHeaderInfo('etag') != 'nil':
+            decoded.setHeader('ETag', ContentCoding.weakenETag(header.getHeaderInfo('etag')))
+        decoded.setHeader('Vary', ContentCoding.addVary(header.getHeaderInfo('vary'), 'Accept-Encoding'))
+        decoded.setPayload(body)
+        return [decoded]
+
+    def __getHeuristicFreshness(self, responseTime):
+        '''
+        returns seconds the response is fresh without explicit expiry, 0 if it cannot be determined
+        HEURISTIC_FRACTION of the time between Last-Modified and the response date, at most HEURISTIC_MAX_AGE
+        only for 200 responses
+        '''
+        if self.rsps[0].responseCode() != '200':
+            return 0
+        lastModified = self.rsps[0].getHeaderInfo('last-modified')
+        if lastModified == 'nil':
+            return 0
+        try:
+            age = responseTime.toSeconds() - TimeComparator(lastModified).toSeconds()
+        except Exception as e: # malformed date
+            return 0
+        if age <= 0:
+            return 0
+        return min(int(age * CacheHandler.HEURISTIC_FRACTION), CacheHandler.HEURISTIC_MAX_AGE)
+
+    def __getValidators(self):
+        '''
+        returns validators of the response, used for revalidation: {'etag', 'lastModified'}, 'nil' if not present
+        '''
+        return {'etag' : self.rsps[0].getHeaderInfo('etag'), 'lastModified' : self.rsps[0].getHeaderInfo('last-modified')}
+
+    def __getStaleWindows(self, cacheOptionSplitted):
+        '''
+        get stale-while-revalidate and stale-if-error (seconds after expiry) from cacheOptionSplitted
+        both are 0 if not specified or the response must be revalidated
+        '''
+        staleWindows = {'staleWhileRevalidate' : 0, 'staleIfError' : 0}
+
+        for option in cacheOptionSplitted:
+            optionSplitted = option.split('=')
+            try:
+                if optionSplitted[0].strip() == 'stale-while-revalidate':
+                    staleWindows['staleWhileRevalidate'] = int(optionSplitted[1].strip())
+                elif optionSplitted[0].strip() == 'stale-if-error':
+                    staleWindows['staleIfError'] = int(optionSplitted[1].strip())
+            except (IndexError, ValueError) as e: # malformed option, ignore
+                continue
+
+        for option in cacheOptionSplitted: # stale copy must not be used if must revalidate
+            if option == 'must-revalidate' or option == 'proxy-revalidate' or option == 'no-cache':
+                staleWindows = {'staleWhileRevalidate' : 0, 'staleIfError' : 0}
+                break
+
+        return staleWindows
+
+    def __createDirectories(self, cacheFileNameSplitted, shard=None):
         '''
         called by cacheResponses
-        creates necessary directories to store necessary files
+        creates necessary directories to store necessary files, in shard if given
         '''
         if CacheHandler.origin is None: # unlikely
             CacheHandler.origin = os.getcwd()
 
-        completeDirectory = CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory + ''.join(cacheFileNameSplitted[:-1])
+        cacheRoot = CacheHandler.getCacheRoot(shard)
+        completeDirectory = cacheRoot + '/'.join(cacheFileNameSplitted[:-1])
         if not os.path.exists(completeDirectory):
             CacheHandler.chdirLock.acquire()
             self.holdingChdirLock = True
             try: # ensure cache directory exists
-                os.chdir(CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory)
+                os.chdir(cacheRoot)
             except FileNotFoundError as e:
-                os.mkdir(CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory)
-                os.chdir(CacheHandler.origin + '/' + CacheHandler.cacheFileDirectory)
+                os.mkdir(cacheRoot)
+                os.chdir(cacheRoot)
             for idx in range(len(cacheFileNameSplitted) - 1): # ensure layers of directory exists
                 try:
                     os.chdir(cacheFileNameSplitted[idx])
@@ -586,70 +1238,384 @@ class CacheHandler:
         '''
         return abs(hash(cacheFileNameFH))%CacheHandler.NUMSLOTS
 
-    def __getLookupTable(self, releaseLookupTableLock=True):
+
+
+#  ██  ██      ███████ ██████  ██ ██      ██      ███████ ██████      ██████   ██████  ██████  ██    ██
+# ████████     ██      ██   ██ ██ ██      ██      ██      ██   ██     ██   ██ ██    ██ ██   ██  ██  ██
+#  ██  ██      ███████ ██████  ██ ██      ██      █████   ██   ██     ██████  ██    ██ ██   ██   ████
+# ████████          ██ ██      ██ ██      ██      ██      ██   ██     ██   ██ ██    ██ ██   ██    ██
+#  ██  ██      ███████ ██      ██ ███████ ███████ ███████ ██████      ██████   ██████  ██████     ██
+
+
+
+
+class SpilledBody:
+    '''
+    body of a response too large to be held in memory (see SocketHandler.MAX_BUFFER_SIZE),
+    written piece by piece to a file in cache_spill/ while the response streams to the client
+
+    passed as last fragment of the responses to cache, like the raw fragments it replaces,
+    writeCacheFile() moves the file into the cache instead of copying it
+    a spilled body not moved into the cache is discarded by its owner (CacheWriter, RevalidationThread)
+    '''
+
+    DIRECTORY = 'cache_spill/'
+
+    def __init__(self):
         '''
-        returns lookupTable
+        path:                   spill file
 
-        if CacheHandler.lookupTable is None,
-            open file and fetch, put to variable
+        file:                   open for writing until closed
 
-            if file not found/ has error, reset as empty list
+        size:                   bytes written
         '''
-        if not self.holdingLookupTableLock:
-            CacheHandler.lookupTableLock.acquire()
-            self.holdingLookupTableLock = True
-            releaseLookupTableLock = True
+        directory = SpilledBody.getDirectory()
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='spill-', dir=directory)
+        os.chmod(self.path, 0o644) # mode of other cache files, mkstemp creates it private
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
 
-        if CacheHandler.lookupTable is None:
+    @staticmethod
+    def getDirectory():
+        if CacheHandler.origin == '':
+            CacheHandler.origin = os.getcwd()
+        return CacheHandler.origin + '/' + SpilledBody.DIRECTORY
+
+    @staticmethod
+    def removeLeftovers():
+        '''
+        called by CacheHandler.initIndex(), remove spill files left by a previous run
+        '''
+        directory = SpilledBody.getDirectory()
+        if not os.path.isdir(directory):
+            return
+        for fileName in os.listdir(directory):
             try:
-                with open('cache_lookup_table.json', 'r') as table:
-                    CacheHandler.lookupTable = json.load(table)
-            except Exception as e:
-                CacheHandler.lookupTable = []
+                os.remove(directory + fileName)
+            except OSError as e:
+                pass
 
-        if releaseLookupTableLock:
-            CacheHandler.lookupTableLock.release()
-            self.holdingLookupTableLock = False
+    @staticmethod
+    def isSpilled(rsps):
+        '''
+        returns true if the body of responses rsps is spilled to disk
+        '''
+        return rsps is not None and rsps != [] and isinstance(rsps[-1], SpilledBody)
 
-        return CacheHandler.lookupTable
+    @staticmethod
+    def discardAll(rsps):
+        '''
+        discard spilled body of rsps, if any and not moved into the cache yet
+        '''
+        if SpilledBody.isSpilled(rsps):
+            rsps[-1].discard()
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def moveTo(self, fileName):
+        '''
+        move spill file to fileName, renamed if on the same file system, copied otherwise (eg cache shard on another disk)
+        '''
+        self.close()
+        shutil.move(self.path, fileName)
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError as e: # moved into the cache
+            pass
+
+    def __len__(self):
+        return self.size
 
 
 
-#  ██  ██       ██████  █████   ██████ ██   ██ ███████     ████████ ██   ██ ██████  ███████  █████  ██████
-# ████████     ██      ██   ██ ██      ██   ██ ██             ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
-#  ██  ██      ██      ███████ ██      ███████ █████          ██    ███████ ██████  █████   ███████ ██   ██
-# ████████     ██      ██   ██ ██      ██   ██ ██             ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
-#  ██  ██       ██████ ██   ██  ██████ ██   ██ ███████        ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+#  ██  ██       ██████  █████   ██████ ██   ██ ███████     ██     ██ ██████  ██ ████████ ███████ ██████
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██     ██ ██   ██ ██    ██    ██      ██   ██
+#  ██  ██      ██      ███████ ██      ███████ █████       ██  █  ██ ██████  ██    ██    █████   ██████
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██ ███ ██ ██   ██ ██    ██    ██      ██   ██
+#  ██  ██       ██████ ██   ██  ██████ ██   ██ ███████      ███ ███  ██   ██ ██    ██    ███████ ██   ██
 
 
 
 
 import threading
-from CacheHandler import CacheHandler
+import time
+from collections import OrderedDict
+from CacheHandler import CacheHandler, SpilledBody
 
-class CacheThread(threading.Thread):
+class CacheWriter:
     '''
-    thread to cache the response
+    fixed pool of cache writer threads fed by a bounded queue,
+    SocketHandler submits cache operations instead of starting a thread per response
+    it acts as a global singleton
+
+    operations are queued per cache key, a newer operation on a key replaces its pending one
+    (eg ADD then DEL of the same key leaves DEL only), operations on one key never run concurrently
+    ADD is keyed by the variant its response is stored under (see CacheHandler.getResponseKey),
+    so variants of one url never replace each other, even while the index is loading
+
+    when the queue is full:
+        ADD is dropped, the response is simply not cached
+        DEL replaces the oldest pending ADD, an expired/ deleted entry must not stay in cache
+
+    a spilled body (see SpilledBody) is owned by its queued ADD, discarded when the ADD is written, replaced or dropped
     '''
 
-    def __init__(self, option, rqp, rsps):
+    NUM_WRITERS = 4
+    MAX_QUEUE_SIZE = 256
+    pending = OrderedDict() # cacheKey -> (option, rqp, rsps), oldest first
+    writing = set() # cache keys being written by a writer thread
+    condition = threading.Condition()
+    writers = []
+    isRunning = False
+
+    metrics = {
+        'submitted' : 0,
+        'coalesced' : 0, # replaced a pending operation of the same key
+        'dropped' : 0, # dropped as queue is full
+        'written' : 0,
+        'failed' : 0,
+        'maxQueueDepth' : 0,
+        'totalWriteTime' : 0.0, # seconds
+        'maxWriteTime' : 0.0,
+    }
+
+    @staticmethod
+    def start():
+        '''
+        called by Proxy object, start NUM_WRITERS writer threads
         '''
-        __option:               'ADD' / 'DEL'
+        CacheWriter.condition.acquire()
+        CacheWriter.isRunning = True
+        CacheWriter.condition.release()
+        for i in range(CacheWriter.NUM_WRITERS):
+            writer = CacheWriterThread(i)
+            writer.start()
+            CacheWriter.writers.append(writer)
 
-        __rqp:                  request packet
+    @staticmethod
+    def stop(timeout=10):
+        '''
+        called by exit routine, writer threads finish the queued operations then stop
+        '''
+        CacheWriter.condition.acquire()
+        CacheWriter.isRunning = False
+        CacheWriter.condition.notify_all()
+        CacheWriter.condition.release()
+        for writer in CacheWriter.writers:
+            writer.join(timeout)
+        CacheWriter.writers = []
 
-        __rsps:                 response packets
+    @staticmethod
+    def submit(option, rqp, rsps):
         '''
-        threading.Thread.__init__(self)
-        self.__option = option
-        self.cacher = CacheHandler(rqp, rsps)
+        queue cache operation, option: 'ADD' / 'DEL'
+        returns false if the operation is dropped
+        '''
+        cacheKey = None
+        if option == 'ADD' and rsps is not None and rsps != []:
+            cacheKey = CacheHandler(rqp, rsps).getResponseKey()
+        if cacheKey is None: # DEL, or response not stored anyway (Vary: *)
+            cacheKey = CacheHandler(rqp).getCacheKey()
 
-    def run(self):
+        if not CacheWriter.isRunning: # writer pool not started/ stopped, write in caller thread
+            CacheWriter.write(option, rqp, rsps)
+            return True
+
+        CacheWriter.condition.acquire()
+        try:
+            CacheWriter.metrics['submitted'] += 1
+            if cacheKey in CacheWriter.pending: # newer operation replaces the pending one, keep queue position
+                SpilledBody.discardAll(CacheWriter.pending[cacheKey][2])
+                CacheWriter.pending[cacheKey] = (option, rqp, rsps)
+                CacheWriter.metrics['coalesced'] += 1
+                return True
+
+            if len(CacheWriter.pending) >= CacheWriter.MAX_QUEUE_SIZE:
+                victim = None
+                if option == 'DEL':
+                    for pendingKey in CacheWriter.pending:
+                        if CacheWriter.pending[pendingKey][0] == 'ADD':
+                            victim = pendingKey
+                            break
+                if victim is None:
+                    CacheWriter.metrics['dropped'] += 1
+                    print('CacheWriter:: submit: queue full, dropped ' + option + ' ' + cacheKey)
+                    SpilledBody.discardAll(rsps)
+                    return False
+                SpilledBody.discardAll(CacheWriter.pending[victim][2])
+                del CacheWriter.pending[victim]
+                CacheWriter.metrics['dropped'] += 1
+                print('CacheWriter:: submit: queue full, dropped ADD ' + victim)
+
+            CacheWriter.pending[cacheKey] = (option, rqp, rsps)
+            CacheWriter.metrics['maxQueueDepth'] = max(CacheWriter.metrics['maxQueueDepth'], len(CacheWriter.pending))
+            CacheWriter.condition.notify()
+            return True
+        finally:
+            CacheWriter.condition.release()
+
+    @staticmethod
+    def take():
+        '''
+        called by writer thread, blocks until an operation of a key not being written is queued
+        returns (cacheKey, option, rqp, rsps), None if stopped and nothing is left
+        '''
+        CacheWriter.condition.acquire()
+        try:
+            while True:
+                for cacheKey in CacheWriter.pending:
+                    if cacheKey not in CacheWriter.writing:
+                        option, rqp, rsps = CacheWriter.pending.pop(cacheKey)
+                        CacheWriter.writing.add(cacheKey)
+                        return (cacheKey, option, rqp, rsps)
+                if not CacheWriter.isRunning and len(CacheWriter.pending) == 0:
+                    return None
+                CacheWriter.condition.wait(1)
+        finally:
+            CacheWriter.condition.release()
+
+    @staticmethod
+    def done(cacheKey, writeTime, succeeded):
+        '''
+        called by writer thread after an operation of cacheKey
+        '''
+        CacheWriter.condition.acquire()
+        CacheWriter.writing.discard(cacheKey)
+        if succeeded:
+            CacheWriter.metrics['written'] += 1
+        else:
+            CacheWriter.metrics['failed'] += 1
+        CacheWriter.metrics['totalWriteTime'] += writeTime
+        CacheWriter.metrics['maxWriteTime'] = max(CacheWriter.metrics['maxWriteTime'], writeTime)
+        CacheWriter.condition.notify_all() # pending operation of cacheKey can be taken now
+        CacheWriter.condition.release()
+
+    @staticmethod
+    def write(option, rqp, rsps):
         '''
         'ADD': call CacheHandler.cacheResponse(rqp, rsp)
         'DEL': call CacheHandler.deleteFromCache(rqp)
         '''
-        if self.__option == 'ADD':
-            self.cacher.cacheResponses()
-        elif self.__option == 'DEL':
-            self.cacher.deleteFromCache()
+        cacher = CacheHandler(rqp, rsps)
+        try:
+            if option == 'ADD':
+                cacher.cacheResponses()
+            elif option == 'DEL':
+                cacher.deleteFromCache()
+        finally:
+            SpilledBody.discardAll(rsps) # not cached after all
+
+    @staticmethod
+    def getMetrics():
+        '''
+        returns copy of metrics, with current queue depth and average write time (seconds)
+        '''
+        CacheWriter.condition.acquire()
+        metrics = dict(CacheWriter.metrics)
+        metrics['queueDepth'] = len(CacheWriter.pending)
+        metrics['writing'] = len(CacheWriter.writing)
+        CacheWriter.condition.release()
+        numWrites = metrics['written'] + metrics['failed']
+        metrics['averageWriteTime'] = metrics['totalWriteTime'] / numWrites if numWrites > 0 else 0.0
+        return metrics
+
+class CacheWriterThread(threading.Thread):
+    '''
+    writer thread of CacheWriter
+    '''
+
+    def __init__(self, id):
+        '''
+        __id:                   index in the pool
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__id = id
+
+    def run(self):
+        '''
+        take queued operations until CacheWriter is stopped and the queue is empty
+        '''
+        while True:
+            operation = CacheWriter.take()
+            if operation is None:
+                break
+            cacheKey, option, rqp, rsps = operation
+            startTime = time.time()
+            succeeded = True
+            try:
+                CacheWriter.write(option, rqp, rsps)
+            except Exception as e:
+                succeeded = False
+                print('CacheWriterThread:: ' + str(self.__id) + ': ' + option + ' ' + cacheKey + ' failed: ' + str(e))
+            CacheWriter.done(cacheKey, time.time() - startTime, succeeded)
+
+
+
+
+
+#  ██  ██       ██████  ██████  ███    ███ ██████   █████   ██████ ████████ ██  ██████  ███    ██     ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██      ██    ██ ████  ████ ██   ██ ██   ██ ██         ██    ██ ██    ██ ████   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██      ██    ██ ██ ████ ██ ██████  ███████ ██         ██    ██ ██    ██ ██ ██  ██        ██    ███████ ██████  █████   ███████ ██   ██
+# ████████     ██      ██    ██ ██  ██  ██ ██      ██   ██ ██         ██    ██ ██    ██ ██  ██ ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██       ██████  ██████  ██      ██ ██      ██   ██  ██████    ██    ██  ██████  ██   ████        ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+import threading
+import time
+from time import sleep
+from CacheJournal import CacheJournal
+
+class CompactionThread(threading.Thread):
+    '''
+    background thread loading the cache index at startup,
+    then compacting the lookup table journal into the snapshot
+    '''
+
+    def __init__(self):
+        '''
+        __isRunning:            cleared by stop()
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__isRunning = threading.Event()
+        self.__isRunning.set()
+
+    def run(self):
+        '''
+        load the index (requests are misses until then),
+        then every COMPACTION_INTERVAL seconds,
+        call CacheHandler.writeLookupTableToFile() if the index backend needs compaction
+        eg enough journal records have piled up
+        '''
+        startTime = time.time()
+        try:
+            CacheHandler.getIndex()
+            print('CompactionThread:: cache index loaded in ' + str(round(time.time() - startTime, 3)) + 's')
+        except Exception as e:
+            print('CompactionThread:: failed to load cache index: ' + str(e))
+
+        while self.__isRunning.is_set():
+            sleep(CacheJournal.COMPACTION_INTERVAL)
+            if not self.__isRunning.is_set():
+                break
+            if CacheHandler.index is not None and CacheHandler.index.needsCompaction():
+                try:
+                    CacheHandler.writeLookupTableToFile()
+                except Exception as e:
+                    print('CompactionThread:: compaction failed: ' + str(e))
+
+    def stop(self):
+        self.__isRunning.clear()
@@ -0,0 +1,500 @@
+import json
+import bisect
+import heapq
+import sqlite3
+import threading
+from CacheJournal import CacheJournal
+from TimeComparator import TimeComparator
+
+
+#  ██  ██       ██████  █████   ██████ ██   ██ ███████     ██ ███    ██ ██████  ███████ ██   ██
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██ ████   ██ ██   ██ ██       ██ ██
+#  ██  ██      ██      ███████ ██      ███████ █████       ██ ██ ██  ██ ██   ██ █████     ███
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██ ██  ██ ██ ██   ██ ██       ██ ██
+#  ██  ██       ██████ ██   ██  ██████ ██   ██ ███████     ██ ██   ████ ██████  ███████ ██   ██
+
+
+
+class CacheIndex:
+    '''
+    cache index backends, used by CacheHandler to look up cached entries
+    an entry is a flat dict: METADATA_KEYS (cacheFileNameFH, expiry, ...) and number of files per encoding
+
+    create(backend, origin) returns the backend by name, storing its files in origin:
+        'json':     JSONCacheIndex, whole table in memory, persisted by CacheJournal (default)
+        'sqlite':   SQLiteCacheIndex, table in an sqlite database, only the working set in memory
+
+    every backend provides:
+        load()                          load the index, called before every access, must be cheap once loaded
+        isLoaded()                      true once load() finished, never blocks
+        getEntry(cacheFileNameFH)       returns entry or None, the entry must not be modified by the caller
+        readEntry(cacheFileNameFH)      same as getEntry, for readers not holding lookupTableLock, may miss the latest changes
+        putEntry(method, entry)         insert/ replace entry, method is 'ADD', 'DEL' or 'REFRESH'
+        getEntries()                    returns list of all entries
+        getKeys(prefix, after, limit)   returns sorted list of cacheFileNameFH starting with prefix, using an ordered index
+                                        only keys greater than after (if given), at most limit keys (if given)
+        popExpiredEntries(before, limit) returns at most limit entries with files stored, expiring before `before` (seconds since epoch),
+                                        oldest expiry first, using an index over expiry times, an entry popped once is normally not returned again until its expiry changes
+        purge()                         remove entries without any file stored
+        needsCompaction()               true if beginCompaction() should be called
+        beginCompaction()               called while lookupTableLock is held
+        finishCompaction(compaction)    called after lookupTableLock is released, with result of beginCompaction()
+        close()
+
+    writes are serialized by CacheHandler.lookupTableLock,
+    reads skip the lock (and use readEntry) if CONCURRENT_READS is true
+    '''
+
+    METADATA_KEYS = ['cacheFileNameFH', 'expiry', 'staleWhileRevalidate', 'staleIfError', 'vary', 'etag', 'lastModified', 'shard', 'atRest'] # entry keys which are not encodings
+    CONCURRENT_READS = False
+
+    @staticmethod
+    def create(backend, origin):
+        if backend == 'json':
+            return JSONCacheIndex(origin)
+        elif backend == 'sqlite':
+            return SQLiteCacheIndex(origin)
+        else:
+            raise Exception('CacheIndex:: create: invalid backend: ' + backend)
+
+    def readEntry(self, cacheFileNameFH):
+        return self.getEntry(cacheFileNameFH)
+
+    def isLoaded(self):
+        return True
+
+    @staticmethod
+    def isEmptyEntry(entry):
+        '''
+        returns true if no file is stored for any encoding of entry
+        entry of a url with Vary is never empty, it selects the variant entries
+        '''
+        if entry.get('vary', []) != []:
+            return False
+        for encoding in entry:
+            if encoding in CacheIndex.METADATA_KEYS: # this is not an encoding key-value pair, continue
+                continue
+            elif entry[encoding] != 0:
+                return False
+        return True
+
+    @staticmethod
+    def countFiles(entry):
+        '''
+        returns number of files stored for entry, all encodings together
+        '''
+        numFiles = 0
+        for encoding in entry:
+            if encoding in CacheIndex.METADATA_KEYS:
+                continue
+            numFiles += int(entry[encoding])
+        return numFiles
+
+
+
+
+
+#  ██  ██           ██ ███████  ██████  ███    ██      ██████  █████   ██████ ██   ██ ███████     ██ ███    ██ ██████  ███████ ██   ██
+# ████████          ██ ██      ██    ██ ████   ██     ██      ██   ██ ██      ██   ██ ██          ██ ████   ██ ██   ██ ██       ██ ██
+#  ██  ██           ██ ███████ ██    ██ ██ ██  ██     ██      ███████ ██      ███████ █████       ██ ██ ██  ██ ██   ██ █████     ███
+# ████████     ██   ██      ██ ██    ██ ██  ██ ██     ██      ██   ██ ██      ██   ██ ██          ██ ██  ██ ██ ██   ██ ██       ██ ██
+#  ██  ██       █████  ███████  ██████  ██   ████      ██████ ██   ██  ██████ ██   ██ ███████     ██ ██   ████ ██████  ███████ ██   ██
+
+
+
+
+class JSONCacheIndex(CacheIndex):
+    '''
+    default backend
+    lookup table kept in memory as cacheFileNameFH -> entry, split into NUM_SHARDS tables by hash of the key,
+    changes appended to CacheJournal, snapshot written to cache_lookup_table.jsonl by compaction
+
+    readers never lock (read-copy-update):
+    published tables are never modified, changes (ADD, DEL, REFRESH alike) are collected in pending
+    and published in batches every PUBLISH_INTERVAL seconds, only the tables holding changed keys are copied,
+    so publishing costs the same for a small and a multi-million entry cache, purge likewise copies only the tables holding empty entries
+    readers look up pending before the tables, so a change is visible at once, eg files can be removed right after DEL
+    '''
+
+    CONCURRENT_READS = True
+    PUBLISH_INTERVAL = 0.05 # seconds between publishing batches of changes
+    NUM_SHARDS = 1024 # tables the lookup table is split into, a publish copies the changed ones
+
+    def __init__(self, origin):
+        '''
+        tables:                 published list of NUM_SHARDS tables cacheFileNameFH -> entry, None until loaded,
+                                the list and its tables are replaced but never modified
+
+        pending:                changes not published yet, cacheFileNameFH -> entry, only modified while holding publishLock
+
+        numEntries:             number of entries in tables
+
+        publishLock:            guards pending and publishing
+
+        publishTimer:           publishes pending changes, None if nothing is scheduled
+
+        loadLock:               make sure the table is loaded only once
+
+        sortedKeys:             (tables, sorted keys of tables), for prefix lookups, rebuilt when other tables are published
+
+        expiryHeap:             min-heap of (expiry in seconds, cacheFileNameFH, expiry), guarded by publishLock
+                                pushed on every put, outdated items are skipped when popped
+
+        emptyShards:            shards of tables which may hold empty entries, the ones purge copies, guarded by publishLock
+        '''
+        CacheJournal.origin = origin
+        self.tables = None
+        self.pending = {}
+        self.numEntries = 0
+        self.publishLock = threading.Semaphore()
+        self.publishTimer = None
+        self.loadLock = threading.Semaphore()
+        self.sortedKeys = (None, [])
+        self.expiryHeap = []
+        self.emptyShards = set()
+
+    def load(self):
+        if self.tables is not None:
+            return
+        self.loadLock.acquire()
+        if self.tables is None:
+            tables = [{} for i in range(JSONCacheIndex.NUM_SHARDS)]
+            emptyShards = set()
+            for entry in CacheJournal.load(): # snapshot + journal replay, empty list if nothing found
+                shard = self.__getShard(entry['cacheFileNameFH'])
+                tables[shard][entry['cacheFileNameFH']] = entry
+                if CacheIndex.isEmptyEntry(entry):
+                    emptyShards.add(shard)
+            self.publishLock.acquire()
+            self.tables = tables
+            self.emptyShards = emptyShards
+            self.numEntries = sum(len(table) for table in tables)
+            self.__rebuildExpiryHeap()
+            self.publishLock.release()
+        self.loadLock.release()
+
+    def isLoaded(self):
+        return self.tables is not None
+
+    def getEntry(self, cacheFileNameFH):
+        return self.readEntry(cacheFileNameFH)
+
+    def readEntry(self, cacheFileNameFH):
+        '''
+        pending first, then the published tables
+        tables are published before pending is emptied, so no change is missed in between
+        '''
+        entry = self.pending.get(cacheFileNameFH)
+        if entry is None:
+            entry = self.tables[self.__getShard(cacheFileNameFH)].get(cacheFileNameFH)
+        return entry
+
+    def putEntry(self, method, entry):
+        self.publishLock.acquire()
+        self.pending[entry['cacheFileNameFH']] = entry
+        CacheJournal.append(method, entry)
+        self.__pushExpiry(entry)
+        if self.publishTimer is None:
+            self.publishTimer = threading.Timer(JSONCacheIndex.PUBLISH_INTERVAL, self.publish)
+            self.publishTimer.daemon = True
+            self.publishTimer.start()
+        self.publishLock.release()
+
+    def publish(self):
+        '''
+        publish pending changes as a new table
+        '''
+        self.publishLock.acquire()
+        self.__publish()
+        self.publishLock.release()
+
+    def getEntries(self):
+        self.publish()
+        return [entry for table in self.tables for entry in table.values()]
+
+    def getKeys(self, prefix, after=None, limit=None):
+        '''
+        keys of the published tables are sorted once per publish, prefix lookups bisect them
+        '''
+        self.publish()
+        tables, sortedKeys = self.sortedKeys
+        if tables is not self.tables:
+            tables = self.tables
+            sortedKeys = sorted(cacheFileNameFH for table in tables for cacheFileNameFH in table)
+            self.sortedKeys = (tables, sortedKeys)
+        start = bisect.bisect_left(sortedKeys, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(sortedKeys, after))
+        keys = []
+        for idx in range(start, len(sortedKeys)):
+            if not sortedKeys[idx].startswith(prefix) or len(keys) == limit:
+                break
+            keys.append(sortedKeys[idx])
+        return keys
+
+    def popExpiredEntries(self, before, limit):
+        '''
+        pops the expiry heap, an item is outdated if the entry was deleted or got another expiry meanwhile
+        '''
+        entries = []
+        self.publishLock.acquire()
+        while self.expiryHeap != [] and self.expiryHeap[0][0] < before and len(entries) < limit:
+            _, cacheFileNameFH, expiry = heapq.heappop(self.expiryHeap)
+            entry = self.readEntry(cacheFileNameFH)
+            if entry is None or entry['expiry'] != expiry or CacheIndex.countFiles(entry) == 0:
+                continue
+            entries.append(entry)
+        self.publishLock.release()
+        return entries
+
+    def purge(self):
+        '''
+        only the tables in emptyShards are copied, the others are published again as they are
+        '''
+        self.publishLock.acquire()
+        self.__publish()
+        if self.tables is not None and self.emptyShards != set():
+            tables = list(self.tables)
+            for shard in self.emptyShards:
+                purgedTable = {}
+                for cacheFileNameFH, entry in tables[shard].items():
+                    if not CacheIndex.isEmptyEntry(entry):
+                        purgedTable[cacheFileNameFH] = entry
+                self.numEntries -= len(tables[shard]) - len(purgedTable)
+                tables[shard] = purgedTable
+            self.tables = tables
+            self.emptyShards = set()
+        self.publishLock.release()
+
+    def needsCompaction(self):
+        return self.tables is not None and CacheJournal.numRecords >= CacheJournal.COMPACTION_THRESHOLD
+
+    def beginCompaction(self):
+        '''
+        rotate the journal, returns the entries of the published tables to be written as snapshot
+        entries are never modified once put, so they need no copy
+        '''
+        if self.tables is None: # nothing loaded yet
+            return None
+        self.publish()
+        table = [entry for table in self.tables for entry in table.values()]
+        CacheJournal.rotate()
+        return table
+
+    def finishCompaction(self, compaction):
+        '''
+        write snapshot without holding lookupTableLock, then drop the journal records it contains
+        '''
+        if compaction is None:
+            return
+        CacheJournal.writeSnapshot(compaction)
+        CacheJournal.finishCompaction()
+
+    def close(self):
+        self.publishLock.acquire()
+        if self.publishTimer is not None:
+            self.publishTimer.cancel()
+        self.__publish()
+        self.publishLock.release()
+        CacheJournal.close()
+
+    def __publish(self):
+        '''
+        caller must hold publishLock
+        only tables holding changed keys are copied,
+        the new tables are published before pending is emptied, so readEntry without publishLock finds every entry
+        '''
+        self.publishTimer = None
+        if self.pending == {} or self.tables is None:
+            return
+        tables = list(self.tables)
+        copied = set() # shards copied by this publish, modified before being published
+        for cacheFileNameFH, entry in self.pending.items():
+            shard = self.__getShard(cacheFileNameFH)
+            if shard not in copied:
+                tables[shard] = dict(tables[shard])
+                copied.add(shard)
+            if cacheFileNameFH not in tables[shard]:
+                self.numEntries += 1
+            tables[shard][cacheFileNameFH] = entry
+            if CacheIndex.isEmptyEntry(entry):
+                self.emptyShards.add(shard)
+        self.tables = tables
+        self.pending = {}
+        if len(self.expiryHeap) > 2 * self.numEntries + 1000: # too many outdated items
+            self.__rebuildExpiryHeap()
+
+    def __getShard(self, cacheFileNameFH):
+        return hash(cacheFileNameFH) % JSONCacheIndex.NUM_SHARDS
+
+    def __pushExpiry(self, entry):
+        '''
+        caller must hold publishLock
+        '''
+        if entry['expiry'] == 'nil' or CacheIndex.countFiles(entry) == 0:
+            return
+        heapq.heappush(self.expiryHeap, (TimeComparator(entry['expiry']).toSeconds(), entry['cacheFileNameFH'], entry['expiry']))
+
+    def __rebuildExpiryHeap(self):
+        '''
+        caller must hold publishLock
+        '''
+        self.expiryHeap = []
+        for table in self.tables:
+            for entry in table.values():
+                self.__pushExpiry(entry)
+        for entry in self.pending.values():
+            self.__pushExpiry(entry)
+
+
+
+
+
+#  ██  ██      ███████  ██████  ██      ██ ████████ ███████      ██████  █████   ██████ ██   ██ ███████     ██ ███    ██ ██████  ███████ ██   ██
+# ████████     ██      ██    ██ ██      ██    ██    ██          ██      ██   ██ ██      ██   ██ ██          ██ ████   ██ ██   ██ ██       ██ ██
+#  ██  ██      ███████ ██    ██ ██      ██    ██    █████       ██      ███████ ██      ███████ █████       ██ ██ ██  ██ ██   ██ █████     ███
+# ████████          ██ ██ ▄▄ ██ ██      ██    ██    ██          ██      ██   ██ ██      ██   ██ ██          ██ ██  ██ ██ ██   ██ ██       ██ ██
+#  ██  ██      ███████  ██████  ███████ ██    ██    ███████      ██████ ██   ██  ██████ ██   ██ ███████     ██ ██   ████ ██████  ███████ ██   ██
+
+
+
+
+class SQLiteCacheIndex(CacheIndex):
+    '''
+    sqlite backend for large caches
+    entries stored in cache_lookup_table.sqlite3 (WAL mode), indexed by cacheFileNameFH and expiry,
+    one connection per thread, so reads run in parallel,
+    connections of exited threads are closed when the next one is opened, close() closes every connection
+    '''
+
+    DATABASE_FILE = 'cache_lookup_table.sqlite3'
+    CONCURRENT_READS = True
+    COMPACTION_THRESHOLD = 1000 # purge empty entries once this many entries were deleted
+
+    def __init__(self, origin):
+        '''
+        origin:                 directory of the database file
+
+        local:                  thread local storage holding the connection of each thread
+
+        connections:            thread -> connection opened by it, every connection still open
+
+        connectionsLock:        lock of connections
+
+        loaded:                 true once the table is created
+
+        numDeleted:             number of DEL since last compaction
+
+        expiryCursor:           (expiry in seconds, cacheFileNameFH) of the last entry returned by popExpiredEntries
+        '''
+        self.origin = origin
+        self.local = threading.local()
+        self.connections = {}
+        self.connectionsLock = threading.Semaphore()
+        self.loaded = False
+        self.numDeleted = 0
+        self.expiryCursor = (-1, '')
+
+    def load(self):
+        if self.loaded:
+            return
+        connection = self.__getConnection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries (cacheFileNameFH TEXT PRIMARY KEY, expiry REAL, numFiles INTEGER, entry TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_expiry ON entries (expiry)')
+        self.loaded = True
+
+    def isLoaded(self):
+        return self.loaded
+
+    def getEntry(self, cacheFileNameFH):
+        row = self.__getConnection().execute('SELECT entry FROM entries WHERE cacheFileNameFH = ?', (cacheFileNameFH,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def putEntry(self, method, entry):
+        expiry = None # 'nil' expiry stored as NULL
+        if entry['expiry'] != 'nil':
+            expiry = TimeComparator(entry['expiry']).toSeconds()
+        connection = self.__getConnection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO entries (cacheFileNameFH, expiry, numFiles, entry) VALUES (?, ?, ?, ?)',
+                (entry['cacheFileNameFH'], expiry, CacheIndex.countFiles(entry), json.dumps(entry)))
+        if method == 'DEL':
+            self.numDeleted += 1
+
+    def getEntries(self):
+        rows = self.__getConnection().execute('SELECT entry FROM entries ORDER BY rowid').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def getKeys(self, prefix, after=None, limit=None):
+        '''
+        range scan on the primary key
+        '''
+        rows = self.__getConnection().execute('SELECT cacheFileNameFH FROM entries WHERE cacheFileNameFH >= ? AND cacheFileNameFH > ? AND cacheFileNameFH < ? ORDER BY cacheFileNameFH LIMIT ?',
+            (prefix, '' if after is None else after, prefix + '\U0010ffff', -1 if limit is None else limit)).fetchall()
+        return [row[0] for row in rows if row[0].startswith(prefix)]
+
+    def popExpiredEntries(self, before, limit):
+        '''
+        range scan on the expiry index, continuing after the last entry returned
+        an entry refreshed to an expiry before the cursor is not returned again, it is found lazily instead
+        '''
+        expiry, cacheFileNameFH = self.expiryCursor
+        rows = self.__getConnection().execute('SELECT expiry, cacheFileNameFH, entry FROM entries WHERE expiry >= ? AND (expiry > ? OR cacheFileNameFH > ?) AND expiry < ? AND numFiles > 0 ORDER BY expiry, cacheFileNameFH LIMIT ?',
+            (expiry, expiry, cacheFileNameFH, before, limit)).fetchall()
+        if rows != []:
+            self.expiryCursor = (rows[-1][0], rows[-1][1])
+        return [json.loads(row[2]) for row in rows]
+
+    def purge(self):
+        connection = self.__getConnection()
+        with connection:
+            rows = connection.execute('SELECT cacheFileNameFH, entry FROM entries WHERE numFiles = 0').fetchall()
+            for row in rows:
+                if CacheIndex.isEmptyEntry(json.loads(row[1])): # keep entries of urls with Vary
+                    connection.execute('DELETE FROM entries WHERE cacheFileNameFH = ?', (row[0],))
+        self.numDeleted = 0
+
+    def needsCompaction(self):
+        return self.loaded and self.numDeleted >= SQLiteCacheIndex.COMPACTION_THRESHOLD
+
+    def beginCompaction(self):
+        return None # purge is enough, nothing to do while holding lookupTableLock
+
+    def finishCompaction(self, compaction):
+        self.__getConnection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        '''
+        close connections of every thread, threads using the index afterwards open a new one
+        '''
+        self.connectionsLock.acquire()
+        connections = self.connections
+        self.connections = {}
+        self.connectionsLock.release()
+        for connection in connections.values():
+            connection.close()
+        self.local.connection = None
+
+    def __getConnection(self):
+        '''
+        returns connection of calling thread, open one if not yet opened (or closed by close())
+        connections of threads which exited meanwhile are closed, they would keep the WAL open
+        '''
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or threading.current_thread() not in self.connections:
+            connection = sqlite3.connect(self.origin + '/' + SQLiteCacheIndex.DATABASE_FILE, timeout=30, check_same_thread=False) # closed by other threads
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL') # durable enough in WAL mode, avoid fsync per write
+            self.local.connection = connection
+
+            self.connectionsLock.acquire()
+            exitedThreads = [thread for thread in self.connections if not thread.is_alive()]
+            exitedConnections = [self.connections.pop(thread) for thread in exitedThreads]
+            self.connections[threading.current_thread()] = connection
+            self.connectionsLock.release()
+            for exitedConnection in exitedConnections:
+                exitedConnection.close()
+        return connection
@@ -0,0 +1,170 @@
+import json # journal records and snapshot are stored as json
+import os
+import threading
+
+class CacheJournal:
+    '''
+    append-only journal for the cache lookup table
+    it acts as a global singleton, used by CacheHandler only
+
+    every ADD/ DEL applied to the lookup table is appended as one json line,
+    the line holds the entry as it is after the change, so replaying is idempotent
+    records are periodically compacted into the snapshot (cache_lookup_table.jsonl, one json entry per line)
+
+    on startup: snapshot + journal being compacted + journal are replayed in order,
+    snapshot is read line by line, a cache_lookup_table.json of older versions (one json array,
+    or json lines) is still read if there is no snapshot yet, it is deleted once a snapshot is written
+    '''
+
+    origin = '' # initialized by CacheHandler.initJournal
+    SNAPSHOT_FILE = 'cache_lookup_table.jsonl'
+    LEGACY_SNAPSHOT_FILE = 'cache_lookup_table.json' # written by older versions
+    JOURNAL_FILE = 'cache_lookup_table.journal'
+    COMPACTING_FILE = 'cache_lookup_table.journal.compacting'
+    COMPACTION_INTERVAL = 30 # seconds between compaction checks
+    COMPACTION_THRESHOLD = 1000 # compact once this many records are in the journal
+    FSYNC = False # fsync after every record, survives power loss but slows down every cache write
+    journalFile = None
+    journalLock = threading.Semaphore()
+    numRecords = 0
+
+    @staticmethod
+    def append(method, entry):
+        '''
+        called by CacheHandler.__updateLookup
+        append one record to the journal, the caller should hold lookupTableLock
+        '''
+        record = json.dumps({'method' : method, 'entry' : entry}) + '\n'
+        CacheJournal.journalLock.acquire()
+        try:
+            if CacheJournal.journalFile is None:
+                CacheJournal.journalFile = open(CacheJournal.__path(CacheJournal.JOURNAL_FILE), 'a')
+            CacheJournal.journalFile.write(record)
+            CacheJournal.journalFile.flush()
+            if CacheJournal.FSYNC:
+                os.fsync(CacheJournal.journalFile.fileno())
+            CacheJournal.numRecords += 1
+        finally:
+            CacheJournal.journalLock.release()
+
+    @staticmethod
+    def load():
+        '''
+        returns the lookup table (list of entries) rebuilt from snapshot and journals
+        records of a torn last line (crash during write) are ignored
+        '''
+        entries = {} # cacheFileNameFH -> entry, keeps insertion order
+        snapshotName = CacheJournal.SNAPSHOT_FILE
+        if not os.path.exists(CacheJournal.__path(snapshotName)):
+            snapshotName = CacheJournal.LEGACY_SNAPSHOT_FILE
+        try:
+            with open(CacheJournal.__path(snapshotName), 'r') as table:
+                if table.read(1) == '[': # json array written by older versions
+                    table.seek(0)
+                    for entry in json.load(table):
+                        entries[entry['cacheFileNameFH']] = entry
+                else:
+                    table.seek(0)
+                    for line in table: # streamed, the snapshot is never held in memory as a whole
+                        try:
+                            entry = json.loads(line)
+                        except ValueError as e:
+                            print('CacheJournal:: load: skipped corrupted entry in ' + snapshotName)
+                            continue
+                        entries[entry['cacheFileNameFH']] = entry
+        except Exception as e:
+            entries = {}
+
+        numRecords = 0
+        for journalName in [CacheJournal.COMPACTING_FILE, CacheJournal.JOURNAL_FILE]:
+            try:
+                with open(CacheJournal.__path(journalName), 'r') as journal:
+                    for line in journal:
+                        try:
+                            record = json.loads(line)
+                        except ValueError as e:
+                            print('CacheJournal:: load: skipped corrupted record in ' + journalName)
+                            continue
+                        entry = record['entry']
+                        entries[entry['cacheFileNameFH']] = entry
+                        numRecords += 1
+            except FileNotFoundError as e:
+                continue
+
+        CacheJournal.numRecords = numRecords # replayed records are compacted on next check
+        if numRecords > 0:
+            print('CacheJournal:: load: replayed ' + str(numRecords) + ' records')
+        return list(entries.values())
+
+    @staticmethod
+    def rotate():
+        '''
+        called by CacheHandler.writeLookupTableToFile, while lookupTableLock is held
+        move current journal aside, so records written from now on go to a new journal
+        the moved journal is deleted by finishCompaction() once the snapshot is safely written
+        '''
+        CacheJournal.journalLock.acquire()
+        try:
+            if CacheJournal.journalFile is not None:
+                CacheJournal.journalFile.close()
+                CacheJournal.journalFile = None
+            journalPath = CacheJournal.__path(CacheJournal.JOURNAL_FILE)
+            compactingPath = CacheJournal.__path(CacheJournal.COMPACTING_FILE)
+            if os.path.exists(journalPath):
+                if os.path.exists(compactingPath): # previous compaction failed, keep its records too
+                    with open(journalPath, 'r') as journal, open(compactingPath, 'a') as compacting:
+                        compacting.write(journal.read())
+                    os.remove(journalPath)
+                else:
+                    os.replace(journalPath, compactingPath)
+            CacheJournal.numRecords = 0
+        finally:
+            CacheJournal.journalLock.release()
+
+    @staticmethod
+    def writeSnapshot(table):
+        '''
+        write table (list of entries) to the snapshot file atomically (write temp file, then rename)
+        one entry per line, so the snapshot can be written and loaded as a stream
+        '''
+        snapshotPath = CacheJournal.__path(CacheJournal.SNAPSHOT_FILE)
+        with open(snapshotPath + '.tmp', 'w') as snapshot:
+            for entry in table:
+                snapshot.write(json.dumps(entry) + '\n')
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(snapshotPath + '.tmp', snapshotPath)
+        try: # entries of the old snapshot are in the new one now
+            os.remove(CacheJournal.__path(CacheJournal.LEGACY_SNAPSHOT_FILE))
+        except FileNotFoundError as e:
+            pass
+
+    @staticmethod
+    def finishCompaction():
+        '''
+        snapshot contains every record of the moved journal, it can be deleted
+        '''
+        try:
+            os.remove(CacheJournal.__path(CacheJournal.COMPACTING_FILE))
+        except FileNotFoundError as e:
+            pass
+
+    @staticmethod
+    def close():
+        '''
+        called by CacheHandler.exitRoutine
+        flush and close the journal, records are replayed on next startup
+        '''
+        CacheJournal.journalLock.acquire()
+        if CacheJournal.journalFile is not None:
+            CacheJournal.journalFile.flush()
+            os.fsync(CacheJournal.journalFile.fileno())
+            CacheJournal.journalFile.close()
+            CacheJournal.journalFile = None
+        CacheJournal.journalLock.release()
+
+    @staticmethod
+    def __path(fileName):
+        if CacheJournal.origin == '':
+            CacheJournal.origin = os.getcwd()
+        return CacheJournal.origin + '/' + fileName
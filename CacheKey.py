@@ -0,0 +1,82 @@
+from fnmatch import fnmatchcase
+
+class CacheKey:
+    '''
+    cache key normalization, so urls naming the same content share one cache entry
+    used by CacheHandler (entry names), NegativeCache, Prefetcher and AdminHandler (url keys)
+
+    if NORMALIZE is true:
+        host is lower cased, default port :80 is removed
+        query parameters matching IGNORED_PARAMETERS (fnmatch patterns, case insensitive, eg tracking parameters) are dropped
+        remaining query parameters are sorted by name, values of a repeated name keep their order
+    the path itself is kept as is, servers may treat its case and encoding as significant
+    a fragment (#...) is always removed, even if NORMALIZE is false: it is never part of the resource,
+    and '#' separates the url from the variant in keys of entries with Vary (see CacheHandler)
+
+    only the key is normalized, requests are sent to servers unchanged
+    '''
+
+    NORMALIZE = True
+    IGNORED_PARAMETERS = ['utm_*', 'fbclid', 'gclid', 'msclkid']
+    DEFAULT_PORT = ':80' # only http is cached, https is tunneled
+
+    @staticmethod
+    def parse(val):
+        '''
+        returns list of patterns from option value 'pattern,pattern', 'none' for an empty list
+        '''
+        if val == 'none':
+            return []
+        return [pattern.strip() for pattern in val.split(',') if pattern.strip() != '']
+
+    @staticmethod
+    def normalize(host, filePath):
+        '''
+        returns (host, filePath) normalized, filePath includes the query
+        '''
+        filePath = filePath.split('#', 1)[0]
+        if not CacheKey.NORMALIZE:
+            return (host, filePath)
+        host = host.lower()
+        if host.endswith(CacheKey.DEFAULT_PORT):
+            host = host[:-len(CacheKey.DEFAULT_PORT)]
+        if '?' not in filePath:
+            return (host, filePath)
+        path, query = filePath.split('?', 1)
+        parameters = []
+        for parameter in query.split('&'):
+            if parameter == '' or CacheKey.isIgnored(parameter.split('=')[0]):
+                continue
+            parameters.append(parameter)
+        parameters.sort(key=lambda parameter: parameter.split('=')[0]) # stable, repeated names keep their order
+        if parameters == []:
+            return (host, path)
+        return (host, path + '?' + '&'.join(parameters))
+
+    @staticmethod
+    def isIgnored(name):
+        '''
+        returns true if query parameter name matches IGNORED_PARAMETERS
+        '''
+        for pattern in CacheKey.IGNORED_PARAMETERS:
+            if fnmatchcase(name.lower(), pattern.lower()):
+                return True
+        return False
+
+    @staticmethod
+    def buildCacheKey(host, filePath):
+        '''
+        returns url key (cacheFileNameFH of an entry without Vary) of host and filePath: host + path, host alone for '/'
+        '''
+        host, filePath = CacheKey.normalize(host, filePath)
+        if filePath == '/':
+            return host
+        return host + filePath
+
+    @staticmethod
+    def buildUrl(host, filePath):
+        '''
+        returns host + filePath normalized, like buildCacheKey but always with the path, '/' included
+        '''
+        host, filePath = CacheKey.normalize(host, filePath)
+        return host + filePath
@@ -0,0 +1,269 @@
+import hashlib
+import http.client
+import math
+import struct
+import threading
+from time import sleep
+from RequestPacket import RequestPacket
+from CacheHandler import CacheHandler
+from CacheIndex import CacheIndex
+
+
+
+#  ██  ██       ██████  █████   ██████ ██   ██ ███████     ██████  ███████ ███████ ██████  ███████
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██   ██ ██      ██      ██   ██ ██
+#  ██  ██      ██      ███████ ██      ███████ █████       ██████  █████   █████   ██████  ███████
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██      ██      ██      ██   ██      ██
+#  ██  ██       ██████ ██   ██  ██████ ██   ██ ███████     ██      ███████ ███████ ██   ██ ███████
+
+
+
+
+class CachePeers:
+    '''
+    cache peering between proxy instances on the same machine, each with its own cache
+    it acts as a global singleton, used by SocketHandler and AdminHandler
+
+    every DIGEST_INTERVAL seconds, DigestThread
+        builds a digest (see CacheDigest, a bloom filter) of the url keys cached here, served as GET http://proxy.admin/digest,
+        fetches the digest of every peer through the peer's proxy port
+    on a cache miss, a peer whose digest holds the url is asked before the server,
+    with Cache-Control: only-if-cached, so the peer answers from its cache or with 504, never asks the server itself
+    digests are approximate: urls cached after the last digest are not found, false positives cost one 504
+
+    the admin interface answers loopback clients only, peers are proxies on this machine, eg 127.0.0.1:6299
+    '''
+
+    PEERS = [] # (host, port) of peer proxies
+    DIGEST_INTERVAL = 60 # seconds
+    FALSE_POSITIVE_RATE = 0.01
+    TIMEOUT = 2 # seconds to connect to a peer and receive its response
+    DIGEST_HOST = 'proxy.admin' # AdminHandler.ADMIN_HOST of peers
+    digest = None # CacheDigest of this proxy, None until built
+    peerDigests = {} # (host, port) -> CacheDigest, replaced by DigestThread but never modified, read without locking
+    digestThread = None
+
+    @staticmethod
+    def parse(val):
+        '''
+        returns list of (host, port) from option value 'host:port,host:port'
+        '''
+        peers = []
+        for peer in val.split(','):
+            host, port = peer.strip().rsplit(':', 1)
+            peers.append((host, int(port)))
+        return peers
+
+    @staticmethod
+    def start():
+        '''
+        called by Proxy object, start building and fetching digests if peers are configured
+        '''
+        if CachePeers.PEERS == [] or CachePeers.digestThread is not None:
+            return
+        CachePeers.digestThread = DigestThread()
+        CachePeers.digestThread.start()
+        print('CachePeers:: peers: ' + ', '.join([host + ':' + str(port) for host, port in CachePeers.PEERS]))
+
+    @staticmethod
+    def stop():
+        if CachePeers.digestThread is not None:
+            CachePeers.digestThread.stop()
+            CachePeers.digestThread = None
+
+    @staticmethod
+    def selectPeer(rqp):
+        '''
+        returns (host, port) of a peer which probably has the url of rqp cached, None if there is none
+        requests which must not be answered by another cache (no-cache, authorization, from a peer) are never sent to peers
+        '''
+        peerDigests = CachePeers.peerDigests
+        if peerDigests == {} or rqp.getHeaderInfo('authorization') != 'nil':
+            return None
+        if rqp.getHeaderInfo('pragma').lower() == 'no-cache':
+            return None
+        for option in rqp.getHeaderInfo('cache-control').lower().split(','):
+            if option.strip() in ['no-cache', 'no-store', 'only-if-cached', 'max-age=0']:
+                return None
+        urlKey = CacheHandler(rqp).getUrlKey()
+        for peer, peerDigest in peerDigests.items():
+            if peerDigest.contains(urlKey):
+                return peer
+        return None
+
+    @staticmethod
+    def createPeerRequest(rqp):
+        '''
+        returns copy of rqp to send to a peer proxy: absolute url, Cache-Control: only-if-cached
+        '''
+        peerRequest = RequestPacket.parsePacket(rqp.getPacketRaw())
+        requestLineSplitted = peerRequest.getRequestLine().split(' ')
+        requestLineSplitted[1] = 'http://' + rqp.getHostName() + rqp.getFilePath() # proxies expect absolute urls
+        peerRequest.setRequestLine(' '.join(requestLineSplitted))
+        peerRequest.setHeader('Cache-Control', 'only-if-cached')
+        peerRequest.setHeader('Connection', 'close')
+        return peerRequest
+
+    @staticmethod
+    def isOnlyIfCached(rqp):
+        '''
+        returns true if rqp must be answered from cache only (504 otherwise), eg request of a peer
+        '''
+        for option in rqp.getHeaderInfo('cache-control').lower().split(','):
+            if option.strip() == 'only-if-cached':
+                return True
+        return False
+
+    @staticmethod
+    def buildDigest():
+        '''
+        returns CacheDigest of url keys with cached files, variants are found by the key of their url
+        '''
+        urlKeys = []
+        for entry in CacheHandler.getIndex().getEntries():
+            if '#' not in entry['cacheFileNameFH'] and not CacheIndex.isEmptyEntry(entry):
+                urlKeys.append(entry['cacheFileNameFH'])
+        digest = CacheDigest(len(urlKeys), CachePeers.FALSE_POSITIVE_RATE)
+        for urlKey in urlKeys:
+            digest.add(urlKey)
+        return digest
+
+    @staticmethod
+    def fetchDigest(peer):
+        '''
+        returns CacheDigest of peer (host, port), None if it cannot be fetched
+        '''
+        connection = http.client.HTTPConnection(peer[0], peer[1], timeout=CachePeers.TIMEOUT)
+        try:
+            connection.request('GET', 'http://' + CachePeers.DIGEST_HOST + '/digest', headers={'Host' : CachePeers.DIGEST_HOST, 'Connection' : 'close'})
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                print('CachePeers:: fetchDigest: ' + peer[0] + ':' + str(peer[1]) + ' answered ' + str(response.status))
+                return None
+            return CacheDigest.fromBytes(body)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            print('CachePeers:: fetchDigest: ' + peer[0] + ':' + str(peer[1]) + ' unavailable: ' + str(e))
+            return None
+        finally:
+            connection.close()
+
+
+
+
+
+
+
+
+
+#  ██  ██       ██████  █████   ██████ ██   ██ ███████     ██████  ██  ██████  ███████ ███████ ████████
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██   ██ ██ ██       ██      ██         ██
+#  ██  ██      ██      ███████ ██      ███████ █████       ██   ██ ██ ██   ███ █████   ███████    ██
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██   ██ ██ ██    ██ ██           ██    ██
+#  ██  ██       ██████ ██   ██  ██████ ██   ██ ███████     ██████  ██  ██████  ███████ ███████    ██
+
+
+
+
+class CacheDigest:
+    '''
+    bloom filter of cache keys, sized for numKeys keys at falsePositiveRate
+    contains() may return true for keys never added (false positive), never false for keys added
+    bit positions: double hashing of sha1 of the key
+
+    serialized (toBytes) as MAGIC, number of hash functions (4 bytes), number of bits (8 bytes), number of keys (8 bytes), bits
+    '''
+
+    MAGIC = b'PCD1'
+    HEADER_FORMAT = '!4sIQQ'
+    MIN_BITS = 1024
+
+    def __init__(self, numKeys, falsePositiveRate=0.01, numHashes=None, numBits=None, bits=None):
+        if numBits is None:
+            numBits = max(int(math.ceil(-max(numKeys, 1) * math.log(falsePositiveRate) / (math.log(2) ** 2))), CacheDigest.MIN_BITS)
+        if numHashes is None:
+            numHashes = max(int(round(numBits / max(numKeys, 1) * math.log(2))), 1)
+            numHashes = min(numHashes, 16)
+        self.numKeys = numKeys
+        self.numHashes = numHashes
+        self.numBits = numBits
+        self.bits = bytearray((numBits + 7) // 8) if bits is None else bits
+
+    def add(self, key):
+        for position in self.__getPositions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def contains(self, key):
+        for position in self.__getPositions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def toBytes(self):
+        return struct.pack(CacheDigest.HEADER_FORMAT, CacheDigest.MAGIC, self.numHashes, self.numBits, self.numKeys) + bytes(self.bits)
+
+    @staticmethod
+    def fromBytes(data):
+        '''
+        returns CacheDigest serialized by toBytes, raises ValueError if data is not a digest
+        '''
+        headerSize = struct.calcsize(CacheDigest.HEADER_FORMAT)
+        if len(data) < headerSize:
+            raise ValueError('CacheDigest:: fromBytes: truncated digest')
+        magic, numHashes, numBits, numKeys = struct.unpack(CacheDigest.HEADER_FORMAT, data[:headerSize])
+        if magic != CacheDigest.MAGIC or numHashes == 0 or numBits == 0 or len(data) - headerSize != (numBits + 7) // 8:
+            raise ValueError('CacheDigest:: fromBytes: not a cache digest')
+        return CacheDigest(numKeys, numHashes=numHashes, numBits=numBits, bits=bytearray(data[headerSize:]))
+
+    def __getPositions(self, key):
+        keyHash = hashlib.sha1(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(keyHash[:8], 'big')
+        h2 = int.from_bytes(keyHash[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.numBits for i in range(self.numHashes)]
+
+
+
+
+
+
+
+
+
+#  ██  ██      ██████  ██  ██████  ███████ ███████ ████████     ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██   ██ ██ ██       ██      ██         ██           ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██   ██ ██ ██   ███ █████   ███████    ██           ██    ███████ ██████  █████   ███████ ██   ██
+# ████████     ██   ██ ██ ██    ██ ██           ██    ██           ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██████  ██  ██████  ███████ ███████    ██           ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+class DigestThread(threading.Thread):
+    '''
+    rebuild the digest of this proxy and fetch digests of peers every CachePeers.DIGEST_INTERVAL seconds
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set() and not CacheHandler.isIndexLoaded(): # digest of a loading index is empty
+            sleep(1)
+        while not self.stopped.is_set():
+            try:
+                CachePeers.digest = CachePeers.buildDigest()
+                print('DigestThread:: digest of ' + str(CachePeers.digest.numKeys) + ' urls, ' + str(len(CachePeers.digest.bits)) + ' bytes')
+            except Exception as e:
+                print('DigestThread:: failed to build digest: ' + str(e))
+            peerDigests = {}
+            for peer in CachePeers.PEERS:
+                peerDigest = CachePeers.fetchDigest(peer)
+                if peerDigest is not None: # peer down otherwise, do not ask it until its digest is fetched again
+                    peerDigests[peer] = peerDigest
+            CachePeers.peerDigests = peerDigests # published at once, selectPeer never sees a dict being modified
+            self.stopped.wait(CachePeers.DIGEST_INTERVAL) # returns early on stop
+
+    def stop(self):
+        self.stopped.set()
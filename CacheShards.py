@@ -0,0 +1,201 @@
+import os
+import bisect
+import hashlib
+import threading
+
+
+
+#  ██  ██       ██████  █████   ██████ ██   ██ ███████     ███████ ██   ██  █████  ██████  ██████  ███████
+# ████████     ██      ██   ██ ██      ██   ██ ██          ██      ██   ██ ██   ██ ██   ██ ██   ██ ██
+#  ██  ██      ██      ███████ ██      ███████ █████       ███████ ███████ ███████ ██████  ██   ██ ███████
+# ████████     ██      ██   ██ ██      ██   ██ ██               ██ ██   ██ ██   ██ ██   ██ ██   ██      ██
+#  ██  ██       ██████ ██   ██  ██████ ██   ██ ███████     ███████ ██   ██ ██   ██ ██   ██ ██████  ███████
+
+
+
+
+class CacheShards:
+    '''
+    spread cache files over several directories (eg one per disk), used by CacheHandler
+    it acts as a global singleton
+
+    a shard is a directory with a weight (share of keys) and a size limit (bytes, None: unlimited)
+    keys are assigned to shards by consistent hashing, each shard owns VIRTUAL_NODES * weight points on a ring,
+    a key goes to the shard owning the first point after the hash of the key
+    a full shard passes the key on to the next shard along the ring, responses are not cached if every shard is full
+
+    the shard is recorded in the entry ('shard'), files are always looked up where they were written:
+    adding a shard never invalidates cached entries, only new keys are spread to it,
+    removing or losing a shard only invalidates the entries stored in it (dropped when their files are found missing)
+
+    no shards configured: files are stored in CacheHandler.cacheFileDirectory, entries carry no shard
+    '''
+
+    VIRTUAL_NODES = 100 # points on the ring per unit of weight
+    shards = {} # directory -> {'weight', 'maxSize', 'usedSize'}
+    ring = [] # sorted points
+    ringShards = [] # ringShards[i]: directory owning ring[i]
+    usageLock = threading.Semaphore()
+
+    @staticmethod
+    def parse(val):
+        '''
+        returns list of (directory, weight, maxSize) from option value 'directory[:weight[:maxSize]],...'
+        maxSize in bytes, or with suffix K, M, G, eg /mnt/disk1/cache:2:100G,/mnt/disk2/cache
+        '''
+        shardConfigs = []
+        for shard in val.split(','):
+            shardSplitted = shard.strip().split(':')
+            directory = shardSplitted[0]
+            weight = int(shardSplitted[1]) if len(shardSplitted) > 1 and shardSplitted[1] != '' else 1
+            maxSize = CacheShards.parseSize(shardSplitted[2]) if len(shardSplitted) > 2 else None
+            shardConfigs.append((directory, weight, maxSize))
+        return shardConfigs
+
+    @staticmethod
+    def configure(shardConfigs):
+        '''
+        called by proxy_main
+        set shards from list of (directory, weight, maxSize) and build the ring,
+        directories are created if missing, shards whose directory cannot be created are left out
+        '''
+        shards = {}
+        for directory, weight, maxSize in shardConfigs:
+            directory = os.path.abspath(directory) + '/'
+            if weight <= 0:
+                raise Exception('CacheShards:: configure: weight of ' + directory + ' must be positive')
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                print('CacheShards:: configure: shard ' + directory + ' unavailable, left out: ' + str(e))
+                continue
+            shards[directory] = {'weight' : weight, 'maxSize' : maxSize, 'usedSize' : 0}
+
+        points = []
+        for directory in shards:
+            for i in range(CacheShards.VIRTUAL_NODES * shards[directory]['weight']):
+                points.append((CacheShards.__hash(directory + '#' + str(i)), directory))
+        points.sort()
+        CacheShards.shards = shards
+        CacheShards.ring = [point for point, directory in points]
+        CacheShards.ringShards = [directory for point, directory in points]
+        print('CacheShards:: configure: ' + str(len(shards)) + ' shards: ' + ', '.join(shards))
+
+    @staticmethod
+    def isEnabled():
+        return CacheShards.shards != {}
+
+    @staticmethod
+    def getDirectories():
+        return list(CacheShards.shards)
+
+    @staticmethod
+    def selectShard(cacheFileNameFH, size):
+        '''
+        returns directory of the shard storing size bytes for cacheFileNameFH
+        returns None if every shard is full
+        '''
+        if CacheShards.ring == []:
+            return None
+        start = bisect.bisect_right(CacheShards.ring, CacheShards.__hash(cacheFileNameFH)) % len(CacheShards.ring)
+        visited = set()
+        idx = start
+        while len(visited) < len(CacheShards.shards):
+            directory = CacheShards.ringShards[idx]
+            if directory not in visited:
+                visited.add(directory)
+                if CacheShards.hasRoom(directory, size):
+                    return directory
+            idx = (idx + 1) % len(CacheShards.ring)
+        return None
+
+    @staticmethod
+    def hasRoom(directory, size):
+        shard = CacheShards.shards[directory]
+        return shard['maxSize'] is None or shard['usedSize'] + size <= shard['maxSize']
+
+    @staticmethod
+    def addUsage(directory, size):
+        '''
+        record size bytes written to (negative: removed from) shard directory
+        '''
+        if directory not in CacheShards.shards: # shard removed from configuration
+            return
+        CacheShards.usageLock.acquire()
+        CacheShards.shards[directory]['usedSize'] += size
+        CacheShards.usageLock.release()
+
+    @staticmethod
+    def startScan():
+        '''
+        called by CacheHandler.initIndex
+        measure space used by each shard in background, one thread per shard, so disks are scanned in parallel
+        size limits are not enforced on data cached before startup until the scan of the shard finishes
+        '''
+        for directory in CacheShards.shards:
+            ShardScanThread(directory).start()
+
+    @staticmethod
+    def getStats():
+        '''
+        returns directory -> {'weight', 'maxSize', 'usedSize'}
+        '''
+        CacheShards.usageLock.acquire()
+        stats = {}
+        for directory in CacheShards.shards:
+            stats[directory] = dict(CacheShards.shards[directory])
+        CacheShards.usageLock.release()
+        return stats
+
+    @staticmethod
+    def __hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    @staticmethod
+    def parseSize(size):
+        '''
+        returns number of bytes of size, eg '512', '100K', '1.5G'
+        '''
+        units = {'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3}
+        size = size.strip().upper()
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+
+
+
+
+
+
+
+
+
+#  ██  ██      ███████ ██   ██  █████  ██████  ██████      ███████  ██████  █████  ███    ██     ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██      ██   ██ ██   ██ ██   ██ ██   ██     ██      ██      ██   ██ ████   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ███████ ███████ ███████ ██████  ██   ██     ███████ ██      ███████ ██ ██  ██        ██    ███████ ██████  █████   ███████ ██   ██
+# ████████          ██ ██   ██ ██   ██ ██   ██ ██   ██          ██ ██      ██   ██ ██  ██ ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ███████ ██   ██ ██   ██ ██   ██ ██████      ███████  ██████ ██   ██ ██   ████        ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+class ShardScanThread(threading.Thread):
+    '''
+    add up the size of files in a shard directory
+    '''
+
+    def __init__(self, directory):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+
+    def run(self):
+        usedSize = 0
+        for dirPath, dirNames, fileNames in os.walk(self.directory):
+            for fileName in fileNames:
+                try:
+                    usedSize += os.path.getsize(os.path.join(dirPath, fileName))
+                except OSError as e: # removed meanwhile
+                    pass
+        CacheShards.addUsage(self.directory, usedSize)
+        print('CacheShards:: shard ' + self.directory + ' holds ' + str(usedSize) + ' bytes')
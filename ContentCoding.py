@@ -0,0 +1,148 @@
+import gzip
+import zlib
+
+try: # optional, zstd codings are not available without it
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try: # optional, br codings are not available without it
+    import brotli
+except ImportError:
+    brotli = None
+
+class ContentCoding:
+    '''
+    content codings (Content-Encoding) the proxy can apply or remove itself
+    used by CacheHandler (compressed-at-rest cache) and ResponseCompressor (compression for clients)
+
+    gzip and deflate are always available, zstd and br only if their modules are installed
+    '''
+
+    COMPRESSIBLE_TYPES = ['text/', 'application/javascript', 'application/x-javascript', 'application/ecmascript',
+        'application/json', 'application/ld+json', 'application/manifest+json', 'application/xml',
+        'application/xhtml+xml', 'application/rss+xml', 'application/atom+xml', 'image/svg+xml', 'image/x-icon']
+
+    @staticmethod
+    def isAvailable(coding):
+        '''
+        returns true if coding can be encoded and decoded
+        '''
+        coding = coding.lower()
+        if coding == 'gzip' or coding == 'x-gzip' or coding == 'deflate':
+            return True
+        if coding == 'zstd':
+            return zstandard is not None
+        if coding == 'br':
+            return brotli is not None
+        return False
+
+    @staticmethod
+    def isCompressible(contentType):
+        '''
+        returns true if responses of contentType (value of Content-Type) are worth compressing, eg html, css, js
+        '''
+        contentType = contentType.split(';')[0].strip().lower()
+        for compressibleType in ContentCoding.COMPRESSIBLE_TYPES:
+            if contentType == compressibleType or (compressibleType[-1] == '/' and contentType.startswith(compressibleType)):
+                return True
+        return False
+
+    @staticmethod
+    def encode(body, coding, level=6):
+        '''
+        returns body (bytes) encoded with coding
+        '''
+        coding = coding.lower()
+        if coding == 'gzip' or coding == 'x-gzip':
+            return gzip.compress(body, compresslevel=level, mtime=0)
+        if coding == 'deflate':
+            return zlib.compress(body, level) # zlib format, as defined for deflate coding
+        if coding == 'zstd' and zstandard is not None:
+            return zstandard.ZstdCompressor(level=level).compress(body)
+        if coding == 'br' and brotli is not None:
+            return brotli.compress(body, quality=level)
+        raise ValueError('ContentCoding:: encode: unsupported coding: ' + coding)
+
+    @staticmethod
+    def decode(body, coding):
+        '''
+        returns body (bytes) with coding removed
+        '''
+        coding = coding.lower()
+        if coding == 'gzip' or coding == 'x-gzip':
+            return gzip.decompress(body)
+        if coding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error as e: # some servers send raw deflate without zlib header
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        if coding == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(body) # frame may not hold content size
+        if coding == 'br' and brotli is not None:
+            return brotli.decompress(body)
+        raise ValueError('ContentCoding:: decode: unsupported coding: ' + coding)
+
+    @staticmethod
+    def createEncoder(coding, level=6):
+        '''
+        returns incremental encoder for coding, with compress(data) and flush() returning encoded bytes
+        used to encode a body piece by piece without holding all of it
+        '''
+        coding = coding.lower()
+        if coding == 'gzip' or coding == 'x-gzip':
+            return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip header and trailer
+        if coding == 'deflate':
+            return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+        if coding == 'zstd' and zstandard is not None:
+            return zstandard.ZstdCompressor(level=level).compressobj()
+        raise ValueError('ContentCoding:: createEncoder: unsupported coding: ' + coding)
+
+    @staticmethod
+    def parseAcceptEncoding(acceptEncoding):
+        '''
+        returns (qValues, order) of acceptEncoding (value of Accept-Encoding)
+        qValues: coding (lower case) -> q-value, order: codings in order listed
+        no accept-encoding ('nil'): identity preferred, anything else acceptable
+        '''
+        qValues = {}
+        order = []
+        if acceptEncoding == 'nil':
+            return ({'identity' : 1.0, '*' : 0.5}, order)
+        for coding in acceptEncoding.split(','):
+            codingSplitted = coding.split(';')
+            name = codingSplitted[0].strip().lower()
+            if name == '':
+                continue
+            q = 1.0
+            for parameter in codingSplitted[1:]:
+                parameter = parameter.strip()
+                if parameter[0:2].lower() == 'q=':
+                    try:
+                        q = float(parameter[2:])
+                    except ValueError as e:
+                        pass # malformed q-value, use default
+            qValues[name] = q
+            order.append(name)
+        return (qValues, order)
+
+    @staticmethod
+    def weakenETag(etag):
+        '''
+        returns etag as weak validator, a transformed representation is not byte-identical to the origin's
+        '''
+        if etag == 'nil' or etag[0:2] == 'W/':
+            return etag
+        return 'W/' + etag
+
+    @staticmethod
+    def addVary(vary, fieldName):
+        '''
+        returns value of Vary (or 'nil') with fieldName added
+        '''
+        if vary == 'nil' or vary.strip() == '':
+            return fieldName
+        for name in vary.split(','):
+            if name.strip().lower() == fieldName.lower() or name.strip() == '*':
+                return vary
+        return vary + ', ' + fieldName
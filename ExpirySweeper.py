@@ -0,0 +1,215 @@
+import heapq
+import threading
+from RequestPacket import RequestPacket
+from CacheHandler import CacheHandler
+from CacheIndex import CacheIndex
+from TimeComparator import TimeComparator
+from SocketHandler import SocketHandler, RevalidationThread
+
+
+
+#  ██  ██      ███████ ██   ██ ██████  ██ ██████  ██    ██     ███████ ██     ██ ███████ ███████ ██████  ███████ ██████
+# ████████     ██       ██ ██  ██   ██ ██ ██   ██  ██  ██      ██      ██     ██ ██      ██      ██   ██ ██      ██   ██
+#  ██  ██      █████     ███   ██████  ██ ██████    ████       ███████ ██  █  ██ █████   █████   ██████  █████   ██████
+# ████████     ██       ██ ██  ██      ██ ██   ██    ██             ██ ██ ███ ██ ██      ██      ██      ██      ██   ██
+#  ██  ██      ███████ ██   ██ ██      ██ ██   ██    ██        ███████  ███ ███  ███████ ███████ ██      ███████ ██   ██
+
+
+
+
+class ExpirySweeper:
+    '''
+    find expired cache entries proactively, instead of waiting for a request to hit them (PATH BBAB)
+    it acts as a global singleton, started by Proxy object
+
+    every INTERVAL seconds, SweepThread
+        pops entries expired since the last sweep from the expiry index of the cache (see CacheIndex popExpiredEntries),
+        drops those which cannot be revalidated (no ETag/ Last-Modified) once their stale windows are over,
+        entries with validators are kept, a request revalidates them with a cheap 304,
+        entries still within a stale window are checked again when it ends
+    if PREREVALIDATE_HITS is set, url entries hit that many times since cached are refreshed
+    LEAD_TIME seconds before they expire (see RevalidationThread), so hot urls never go stale
+
+    variant entries (Vary) are dropped but never pre-revalidated, the request headers selecting them are not kept
+    '''
+
+    INTERVAL = 60 # seconds between sweeps, 0 disables the sweeper
+    BATCH_SIZE = 1000 # expired entries handled per sweep at most, the rest are left for the next sweep
+    PREREVALIDATE_HITS = 0 # hits since cached making an entry hot, 0 disables pre-revalidation
+    LEAD_TIME = 10 # seconds before expiry hot entries are refreshed
+    sweepThread = None
+    metrics = {
+        'sweeps' : 0,
+        'dropped' : 0, # expired entries without validators deleted
+        'droppedBytes' : 0,
+        'kept' : 0, # expired entries with validators, left for revalidation
+        'prerevalidated' : 0 # hot entries refreshed before expiry
+    }
+    metricsLock = threading.Semaphore() # metrics are counted by the sweep thread and read by request threads
+
+    @staticmethod
+    def start():
+        '''
+        called by Proxy object
+        '''
+        if ExpirySweeper.INTERVAL <= 0 or ExpirySweeper.sweepThread is not None:
+            return
+        ExpirySweeper.sweepThread = SweepThread()
+        ExpirySweeper.sweepThread.start()
+
+    @staticmethod
+    def stop():
+        if ExpirySweeper.sweepThread is not None:
+            ExpirySweeper.sweepThread.stop()
+            ExpirySweeper.sweepThread = None
+
+    @staticmethod
+    def hasValidators(entry):
+        return entry.get('etag', 'nil') != 'nil' or entry.get('lastModified', 'nil') != 'nil'
+
+    @staticmethod
+    def getStaleDeadline(entry):
+        '''
+        returns seconds since epoch after which entry can no longer be served stale
+        '''
+        staleWindow = max(entry.get('staleWhileRevalidate', 0), entry.get('staleIfError', 0), SocketHandler.STALE_GRACE_PERIOD)
+        return TimeComparator(entry['expiry']).toSeconds() + staleWindow
+
+    @staticmethod
+    def prerevalidate(now):
+        '''
+        refresh hot url entries expiring within LEAD_TIME seconds
+        '''
+        if ExpirySweeper.PREREVALIDATE_HITS <= 0:
+            return
+        for cacheFileNameFH in CacheHandler.getHotKeys(ExpirySweeper.PREREVALIDATE_HITS):
+            if '#' in cacheFileNameFH: # variant entry
+                continue
+            entry = CacheHandler.getIndex().readEntry(cacheFileNameFH)
+            if entry is None or entry['expiry'] == 'nil' or CacheIndex.countFiles(entry) == 0:
+                continue
+            expiry = TimeComparator(entry['expiry']).toSeconds()
+            if expiry > now + ExpirySweeper.LEAD_TIME or expiry < now: # not expiring yet, or expired already (refreshed on request)
+                continue
+            rqp = ExpirySweeper.__createRequest(cacheFileNameFH, entry)
+            if rqp is None or SocketHandler.onBlackList(rqp):
+                continue
+            RevalidationThread.revalidate(rqp, cacheFileNameFH)
+            ExpirySweeper.count('prerevalidated')
+            print('ExpirySweeper:: pre-revalidating ' + cacheFileNameFH + ', expiry: ' + entry['expiry'])
+
+    @staticmethod
+    def count(name, amount=1):
+        ExpirySweeper.metricsLock.acquire()
+        ExpirySweeper.metrics[name] += amount
+        ExpirySweeper.metricsLock.release()
+
+    @staticmethod
+    def getMetrics():
+        ExpirySweeper.metricsLock.acquire()
+        metrics = dict(ExpirySweeper.metrics)
+        ExpirySweeper.metricsLock.release()
+        return metrics
+
+    @staticmethod
+    def __createRequest(cacheFileNameFH, entry):
+        '''
+        returns GET request packet for url key cacheFileNameFH (host + path), accepting the encodings stored in entry
+        returns None if the key is not ascii
+        '''
+        host = cacheFileNameFH.split('/')[0]
+        filePath = cacheFileNameFH[len(host):]
+        if filePath == '':
+            filePath = '/'
+        requestRaw = 'GET http://' + host + filePath + ' HTTP/1.1\r\nHost: ' + host + '\r\n'
+        encodings = [encoding for encoding in entry if encoding not in CacheIndex.METADATA_KEYS and encoding not in ['nil', 'identity']]
+        if encodings != []:
+            requestRaw += 'Accept-Encoding: ' + ', '.join(encodings) + '\r\n'
+        requestRaw += 'Connection: close\r\n\r\n'
+        try:
+            return RequestPacket.parsePacket(requestRaw.encode('ascii'))
+        except UnicodeError as e:
+            return None
+
+
+
+
+
+
+
+
+
+#  ██  ██      ███████ ██     ██ ███████ ███████ ██████      ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██      ██     ██ ██      ██      ██   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ███████ ██  █  ██ █████   █████   ██████         ██    ███████ ██████  █████   ███████ ██   ██
+# ████████          ██ ██ ███ ██ ██      ██      ██             ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ███████  ███ ███  ███████ ███████ ██             ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+class SweepThread(threading.Thread):
+    '''
+    sweep expired entries every ExpirySweeper.INTERVAL seconds,
+    look for hot entries to pre-revalidate every LEAD_TIME / 2 seconds
+    '''
+
+    def __init__(self):
+        '''
+        stopped:        set by stop(), ends the thread
+
+        deferred:       min-heap of (end of stale windows in seconds, cacheFileNameFH, expiry),
+                        expired entries without validators which may still be served stale
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopped = threading.Event()
+        self.deferred = []
+
+    def run(self):
+        while not self.stopped.is_set() and not CacheHandler.isIndexLoaded():
+            self.stopped.wait(1)
+        step = ExpirySweeper.INTERVAL
+        if ExpirySweeper.PREREVALIDATE_HITS > 0: # hot entries must be seen within LEAD_TIME of expiry
+            step = max(1, min(ExpirySweeper.INTERVAL, ExpirySweeper.LEAD_TIME // 2))
+        lastSweep = None
+        while not self.stopped.is_set():
+            now = TimeComparator.currentTime().toSeconds()
+            try:
+                if lastSweep is None or now - lastSweep >= ExpirySweeper.INTERVAL:
+                    self.sweep(now)
+                    lastSweep = now
+                ExpirySweeper.prerevalidate(now)
+            except Exception as e:
+                print('SweepThread:: sweep failed: ' + str(e))
+            self.stopped.wait(step) # returns early on stop
+
+    def sweep(self, now):
+        for entry in CacheHandler.getIndex().popExpiredEntries(now, ExpirySweeper.BATCH_SIZE):
+            self.__handleExpired(entry, now)
+        while self.deferred != [] and self.deferred[0][0] <= now:
+            _, cacheFileNameFH, expiry = heapq.heappop(self.deferred)
+            entry = CacheHandler.getIndex().readEntry(cacheFileNameFH)
+            if entry is not None and entry['expiry'] == expiry: # not replaced or refreshed meanwhile
+                self.__handleExpired(entry, now)
+        ExpirySweeper.count('sweeps')
+
+    def stop(self):
+        self.stopped.set()
+
+    def __handleExpired(self, entry, now):
+        '''
+        keep entry if it can be revalidated, defer it while it can be served stale, drop it otherwise
+        '''
+        if ExpirySweeper.hasValidators(entry):
+            ExpirySweeper.count('kept')
+            return
+        staleDeadline = ExpirySweeper.getStaleDeadline(entry)
+        if staleDeadline > now:
+            heapq.heappush(self.deferred, (staleDeadline, entry['cacheFileNameFH'], entry['expiry']))
+            return
+        removedBytes = CacheHandler.dropExpiredEntry(entry)
+        if removedBytes is not None:
+            ExpirySweeper.count('dropped')
+            ExpirySweeper.count('droppedBytes', removedBytes)
+            print('SweepThread:: dropped expired ' + entry['cacheFileNameFH'] + ', ' + str(removedBytes) + ' bytes')
@@ -0,0 +1,153 @@
+import bisect
+import itertools
+import threading
+
+
+
+#  ██  ██      ███    ███ ███████ ████████ ██████  ██  ██████ ███████
+# ████████     ████  ████ ██         ██    ██   ██ ██ ██      ██
+#  ██  ██      ██ ████ ██ █████      ██    ██████  ██ ██      ███████
+# ████████     ██  ██  ██ ██         ██    ██   ██ ██ ██           ██
+#  ██  ██      ██      ██ ███████    ██    ██   ██ ██  ██████ ███████
+
+
+
+
+class Metrics:
+    '''
+    metrics registry of the proxy, rendered in Prometheus text format by AdminHandler (GET /metrics)
+    it acts as a global singleton, updated by SocketHandler and Proxy
+
+    metrics are declared in DEFINITIONS, name -> (type, help), type is 'counter', 'gauge' or 'histogram'
+    a sample is identified by metric name and labels (dict of label name -> value, eg {'path' : 'BBAA'})
+
+    updates are striped: every thread updates one of NUM_STRIPES stripes (assigned round robin on first update),
+    each with a lock of its own, so concurrent connections rarely wait for each other,
+    render() adds up the stripes
+    '''
+
+    NUM_STRIPES = 16
+    LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # seconds, upper bounds
+    DEFINITIONS = {
+        'proxy_requests_total' : ('counter', 'Requests handled, by handleRequest path.'),
+        'proxy_cache_requests_total' : ('counter', 'GET requests, by cache result (hit, stale, miss, revalidate, negative).'),
+        'proxy_response_bytes_total' : ('counter', 'Bytes sent to clients, by source (cache, origin, proxy).'),
+        'proxy_active_connections' : ('gauge', 'Client connections being handled.'),
+        'proxy_active_tunnels' : ('gauge', 'CONNECT tunnels open.'),
+        'proxy_request_duration_seconds' : ('histogram', 'Time from receiving a request to answering it, by handleRequest path.'),
+    }
+    stripes = [{} for i in range(NUM_STRIPES)] # (name, labels) -> value, histogram value: [count per bucket..., count above, sum]
+    stripeLocks = [threading.Lock() for i in range(NUM_STRIPES)]
+    stripeCounter = itertools.count()
+    local = threading.local() # stripe index of each thread
+
+    @staticmethod
+    def increment(name, labels=None, value=1):
+        '''
+        add value to counter or gauge name, gauges are decremented by a negative value
+        '''
+        idx = Metrics.__getStripe()
+        key = (name, Metrics.__getLabelsKey(labels))
+        Metrics.stripeLocks[idx].acquire()
+        stripe = Metrics.stripes[idx]
+        stripe[key] = stripe.get(key, 0) + value
+        Metrics.stripeLocks[idx].release()
+
+    @staticmethod
+    def observe(name, value, labels=None):
+        '''
+        record value in histogram name
+        '''
+        idx = Metrics.__getStripe()
+        key = (name, Metrics.__getLabelsKey(labels))
+        bucket = bisect.bisect_left(Metrics.LATENCY_BUCKETS, value) # bucket upper bounds are inclusive
+        Metrics.stripeLocks[idx].acquire()
+        stripe = Metrics.stripes[idx]
+        histogram = stripe.get(key)
+        if histogram is None:
+            histogram = [0] * (len(Metrics.LATENCY_BUCKETS) + 1) + [0.0]
+            stripe[key] = histogram
+        histogram[bucket] += 1
+        histogram[-1] += value
+        Metrics.stripeLocks[idx].release()
+
+    @staticmethod
+    def collect():
+        '''
+        returns (name, labels) -> value of all stripes added up
+        '''
+        samples = {}
+        for idx in range(Metrics.NUM_STRIPES):
+            Metrics.stripeLocks[idx].acquire()
+            items = [(key, list(value) if isinstance(value, list) else value) for key, value in Metrics.stripes[idx].items()]
+            Metrics.stripeLocks[idx].release()
+            for key, value in items:
+                if key not in samples:
+                    samples[key] = value
+                elif isinstance(value, list):
+                    samples[key] = [total + part for total, part in zip(samples[key], value)]
+                else:
+                    samples[key] += value
+        return samples
+
+    @staticmethod
+    def render():
+        '''
+        returns all metrics in Prometheus text exposition format (version 0.0.4)
+        '''
+        samples = Metrics.collect()
+        lines = []
+        for name in Metrics.DEFINITIONS:
+            metricType, helpText = Metrics.DEFINITIONS[name]
+            lines.append('# HELP ' + name + ' ' + helpText)
+            lines.append('# TYPE ' + name + ' ' + metricType)
+            keys = sorted([key for key in samples if key[0] == name])
+            if keys == [] and metricType == 'gauge':
+                lines.append(name + ' 0')
+            for key in keys:
+                labels = key[1]
+                if metricType != 'histogram':
+                    lines.append(name + Metrics.__formatLabels(labels) + ' ' + Metrics.__formatValue(samples[key]))
+                    continue
+                histogram = samples[key]
+                count = 0
+                for bucket in range(len(Metrics.LATENCY_BUCKETS) + 1):
+                    count += histogram[bucket]
+                    upperBound = '+Inf' if bucket == len(Metrics.LATENCY_BUCKETS) else Metrics.__formatValue(Metrics.LATENCY_BUCKETS[bucket])
+                    lines.append(name + '_bucket' + Metrics.__formatLabels(labels + (('le', upperBound),)) + ' ' + str(count))
+                lines.append(name + '_sum' + Metrics.__formatLabels(labels) + ' ' + Metrics.__formatValue(histogram[-1]))
+                lines.append(name + '_count' + Metrics.__formatLabels(labels) + ' ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __getStripe():
+        idx = getattr(Metrics.local, 'stripe', None)
+        if idx is None:
+            idx = next(Metrics.stripeCounter) % Metrics.NUM_STRIPES
+            Metrics.local.stripe = idx
+        return idx
+
+    @staticmethod
+    def __getLabelsKey(labels):
+        '''
+        returns labels dict as sorted tuple of (name, value), usable as dict key
+        '''
+        if labels is None:
+            return ()
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def __formatLabels(labels):
+        if labels == ():
+            return ''
+        formatted = []
+        for labelName, labelValue in labels:
+            labelValue = str(labelValue).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            formatted.append(labelName + '="' + labelValue + '"')
+        return '{' + ','.join(formatted) + '}'
+
+    @staticmethod
+    def __formatValue(value):
+        if isinstance(value, float) and value.is_integer(): # eg bucket bound 1 instead of 1.0
+            return str(int(value))
+        return str(value)
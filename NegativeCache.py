@@ -0,0 +1,131 @@
+import socket
+import threading
+from collections import OrderedDict
+from time import monotonic
+from CacheKey import CacheKey
+
+class NegativeCache:
+    '''
+    short lived memory of upstream failures, so repeated failing requests are answered without the network
+    it acts as a global singleton, used by SocketHandler
+
+    'url':      404/ 410 responses, per url (host + path, normalized by CacheKey), answered from memory
+    'dns':      name resolution failures (NXDOMAIN), per host
+    'connect':  refused connections, per host:port
+
+    a ttl of 0 disables the kind of failure
+    404/ 410 responses are shared like cached responses (see RequestCoalescer.isShareable), not remembered if
+        they have no-store, private or set-cookie, or are larger than MAX_RESPONSE_SIZE,
+        the request has cookie, or authorization unless the response is public
+    requests with no-cache (cache-control or pragma) are never answered from memory
+    '''
+
+    NOT_FOUND_TTL = 30 # seconds
+    DNS_FAILURE_TTL = 60
+    CONNECT_FAILURE_TTL = 10
+    MAX_ENTRIES = 10000 # oldest failures are forgotten first
+    MAX_RESPONSE_SIZE = 64 * 1024 # bytes
+    NAME_ERRORS = [socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)] # gaierror errno meaning the name does not exist
+    entries = OrderedDict() # (kind, key) -> (expiry in monotonic seconds, value), oldest first
+    entriesLock = threading.Semaphore()
+
+    @staticmethod
+    def getResponses(rqp):
+        '''
+        returns remembered 404/ 410 responses for url of rqp, None if there are none
+        returns None if rqp asks for a response from the server (no-cache)
+        '''
+        if rqp.getHeaderInfo('pragma').lower() == 'no-cache':
+            return None
+        for option in rqp.getHeaderInfo('cache-control').lower().split(','):
+            if option.strip() in ['no-cache', 'max-age=0']:
+                return None
+        return NegativeCache.__get('url', NegativeCache.__getUrlKey(rqp))
+
+    @staticmethod
+    def putResponses(rqp, rsps):
+        '''
+        remember 404/ 410 responses rsps for url of rqp
+        '''
+        if rsps == [] or rsps[0].responseCode() not in ['404', '410']:
+            return
+        if rsps[0].getHeaderInfo('set-cookie') != 'nil' or rqp.getHeaderInfo('cookie') != 'nil': # response specific to this client
+            return
+        cacheOptionSplitted = [option.strip() for option in rsps[0].getHeaderInfo('cache-control').lower().split(',')]
+        if 'no-store' in cacheOptionSplitted or 'private' in cacheOptionSplitted:
+            return
+        if rqp.getHeaderInfo('authorization') != 'nil' and 'public' not in cacheOptionSplitted:
+            return
+        size = 0
+        for rsp in rsps:
+            try:
+                size += len(rsp.getPacketRaw())
+            except AttributeError as e:
+                size += len(rsp)
+        if size > NegativeCache.MAX_RESPONSE_SIZE:
+            return
+        NegativeCache.__put('url', NegativeCache.__getUrlKey(rqp), rsps, NegativeCache.NOT_FOUND_TTL)
+
+    @staticmethod
+    def removeResponses(prefix):
+        '''
+        called by AdminHandler
+        forget 404/ 410 responses of urls starting with prefix (host + path)
+        '''
+        NegativeCache.entriesLock.acquire()
+        for kind, key in list(NegativeCache.entries):
+            if kind == 'url' and key.startswith(prefix):
+                del NegativeCache.entries[(kind, key)]
+        NegativeCache.entriesLock.release()
+
+    @staticmethod
+    def isDNSFailure(host):
+        return NegativeCache.__get('dns', host.lower()) is not None
+
+    @staticmethod
+    def putDNSFailure(host, e):
+        '''
+        remember failed name resolution of host if gaierror e says the name does not exist
+        temporary failures (eg EAI_AGAIN) are not remembered
+        '''
+        if getattr(e, 'errno', None) in NegativeCache.NAME_ERRORS:
+            NegativeCache.__put('dns', host.lower(), True, NegativeCache.DNS_FAILURE_TTL)
+
+    @staticmethod
+    def isConnectFailure(host, port):
+        return NegativeCache.__get('connect', host.lower() + ':' + str(port)) is not None
+
+    @staticmethod
+    def putConnectFailure(host, port):
+        NegativeCache.__put('connect', host.lower() + ':' + str(port), True, NegativeCache.CONNECT_FAILURE_TTL)
+
+    @staticmethod
+    def __get(kind, key):
+        '''
+        returns remembered value, None if not remembered or expired
+        '''
+        NegativeCache.entriesLock.acquire()
+        record = NegativeCache.entries.get((kind, key))
+        if record is not None and record[0] <= monotonic():
+            del NegativeCache.entries[(kind, key)]
+            record = None
+        NegativeCache.entriesLock.release()
+        if record is None:
+            return None
+        return record[1]
+
+    @staticmethod
+    def __put(kind, key, value, ttl):
+        if ttl <= 0:
+            return
+        NegativeCache.entriesLock.acquire()
+        NegativeCache.entries.pop((kind, key), None) # re-inserted as newest
+        NegativeCache.entries[(kind, key)] = (monotonic() + ttl, value)
+        while len(NegativeCache.entries) > NegativeCache.MAX_ENTRIES:
+            NegativeCache.entries.popitem(last=False)
+        NegativeCache.entriesLock.release()
+        print('NegativeCache:: remembered ' + kind + ' failure for ' + str(ttl) + 's: ' + key)
+
+    @staticmethod
+    def __getUrlKey(rqp):
+        return CacheKey.buildUrl(rqp.getHostName(), rqp.getFilePath())
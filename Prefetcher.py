@@ -0,0 +1,453 @@
+import threading
+import ipaddress
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+from time import monotonic, sleep
+from urllib.parse import urljoin, urlsplit
+from RequestPacket import RequestPacket
+from CacheHandler import CacheHandler, CacheWriter
+from CacheIndex import CacheIndex
+from CacheKey import CacheKey
+from ContentCoding import ContentCoding
+from RangeHandler import RangeHandler
+from RequestCoalescer import RequestCoalescer
+
+
+
+#  ██  ██      ██████  ██████  ███████ ███████ ███████ ████████  ██████ ██   ██ ███████ ██████
+# ████████     ██   ██ ██   ██ ██      ██      ██         ██    ██      ██   ██ ██      ██   ██
+#  ██  ██      ██████  ██████  █████   █████   █████      ██    ██      ███████ █████   ██████
+# ████████     ██      ██   ██ ██      ██      ██         ██    ██      ██   ██ ██      ██   ██
+#  ██  ██      ██      ██   ██ ███████ ██      ███████    ██     ██████ ██   ██ ███████ ██   ██
+
+
+
+
+class Prefetcher:
+    '''
+    warm the cache for subresources of html pages fetched from servers, so the browser's follow-up requests hit
+    it acts as a global singleton, used by SocketHandler
+
+    200 text/html responses about to be cached are queued as pages,
+    one background thread (PrefetchThread) parses them for same-site <link> (stylesheet, icon, preload), <script> and <img> urls,
+    then requests the urls not cached yet, at most RATE per second, and caches the responses like any other miss
+
+    prefetch requests carry 'Purpose: prefetch', user-agent, accept-encoding and accept-language of the page request,
+    no cookies, so only responses cacheable for everyone are prefetched
+    only http urls are prefetched, https is tunneled and never cached
+
+    a prefetched url requested by a client within USE_WINDOW seconds counts as used, otherwise as wasted
+    '''
+
+    ENABLED = False
+    RATE = 2.0 # prefetch requests per second
+    MAX_PAGES = 32 # pages waiting to be parsed, oldest are dropped
+    MAX_QUEUE_SIZE = 256 # urls waiting to be prefetched, further urls are dropped
+    MAX_URLS_PER_PAGE = 32
+    MAX_PAGE_SIZE = 1024 * 1024 # bytes, larger pages are not parsed
+    USE_WINDOW = 300 # seconds
+    FORWARDED_HEADERS = ['User-Agent', 'Accept-Encoding', 'Accept-Language']
+    SECOND_LEVEL_LABELS = ['ac', 'co', 'com', 'edu', 'gov', 'net', 'org'] # eg ust.hk vs com.hk, see getSite
+    pages = deque() # (rqp, rsps) of pages waiting to be parsed
+    requests = OrderedDict() # url (host + path) -> request packet waiting to be prefetched, oldest first
+    prefetched = OrderedDict() # url (host + path) -> monotonic time prefetched, not used yet, oldest first
+    condition = threading.Condition()
+    isRunning = False
+    worker = None
+
+    metrics = {
+        'pages' : 0, # pages parsed
+        'droppedPages' : 0,
+        'queued' : 0, # urls queued
+        'dropped' : 0, # urls dropped as queue is full
+        'skipped' : 0, # cached already, being requested by a client, or banned (see SocketHandler.onBlackList)
+        'prefetched' : 0, # fetched and cached
+        'failed' : 0, # not fetched, or response not cacheable
+        'used' : 0,
+        'wasted' : 0,
+    }
+
+    @staticmethod
+    def start():
+        '''
+        called by Proxy object, start the prefetch thread if ENABLED
+        '''
+        if not Prefetcher.ENABLED or Prefetcher.worker is not None:
+            return
+        Prefetcher.condition.acquire()
+        Prefetcher.isRunning = True
+        Prefetcher.condition.release()
+        Prefetcher.worker = PrefetchThread()
+        Prefetcher.worker.start()
+        print('Prefetcher:: started, ' + str(Prefetcher.RATE) + ' requests per second')
+
+    @staticmethod
+    def stop(timeout=10):
+        '''
+        called by Proxy on exit, queued pages and urls are dropped
+        '''
+        if Prefetcher.worker is None:
+            return
+        Prefetcher.condition.acquire()
+        Prefetcher.isRunning = False
+        Prefetcher.pages.clear()
+        Prefetcher.requests.clear()
+        Prefetcher.condition.notify_all()
+        Prefetcher.condition.release()
+        Prefetcher.worker.join(timeout)
+        Prefetcher.worker = None
+        print('Prefetcher:: stop: prefetch metrics: ' + str(Prefetcher.getMetrics()))
+
+    @staticmethod
+    def submitPage(rqp, rsps):
+        '''
+        called by SocketHandler when responses rsps to rqp are sent to cache
+        queue the page for parsing if it is a cacheable html page
+        '''
+        if not Prefetcher.isRunning or rsps == [] or rsps[0].responseCode() != '200':
+            return
+        if rqp.getHeaderInfo('purpose').lower() == 'prefetch':
+            return
+        if rsps[0].getHeaderInfo('content-type').split(';')[0].strip().lower() != 'text/html':
+            return
+        cacheOptionSplitted = rsps[0].getHeaderInfo('cache-control').lower().split(',')
+        for option in cacheOptionSplitted:
+            if option.strip() == 'no-store' or option.strip() == 'private':
+                return
+
+        Prefetcher.condition.acquire()
+        Prefetcher.pages.append((rqp, rsps))
+        if len(Prefetcher.pages) > Prefetcher.MAX_PAGES:
+            Prefetcher.pages.popleft()
+            Prefetcher.metrics['droppedPages'] += 1
+        Prefetcher.condition.notify()
+        Prefetcher.condition.release()
+
+    @staticmethod
+    def take():
+        '''
+        called by prefetch thread, blocks until a page or url is queued
+        returns ('page', rqp, rsps) or ('url', rqp, None), pages first, None if stopped
+        '''
+        Prefetcher.condition.acquire()
+        try:
+            while Prefetcher.isRunning:
+                if len(Prefetcher.pages) > 0:
+                    rqp, rsps = Prefetcher.pages.popleft()
+                    return ('page', rqp, rsps)
+                if len(Prefetcher.requests) > 0:
+                    url, rqp = Prefetcher.requests.popitem(last=False)
+                    return ('url', rqp, None)
+                Prefetcher.condition.wait(1)
+            return None
+        finally:
+            Prefetcher.condition.release()
+
+    @staticmethod
+    def parsePage(rqp, rsps):
+        '''
+        returns prefetch request packets for same-site subresources of html page rsps (responses to rqp)
+        returns [] if the body is incomplete, too large or cannot be decoded
+        '''
+        pieces = RangeHandler.getBody(rsps)
+        if pieces is None:
+            return []
+        body = b''.join(pieces)
+        coding = rsps[0].getHeaderInfo('content-encoding')
+        if coding != 'nil' and coding.lower() != 'identity':
+            if not ContentCoding.isAvailable(coding) or len(body) > Prefetcher.MAX_PAGE_SIZE:
+                return []
+            try:
+                body = ContentCoding.decode(body, coding)
+            except Exception as e:
+                print('Prefetcher:: parsePage: failed to decode ' + coding + ': ' + str(e))
+                return []
+        if len(body) > Prefetcher.MAX_PAGE_SIZE:
+            return []
+
+        pageUrl = 'http://' + rqp.getHostName() + rqp.getFilePath()
+        parser = PrefetchLinkParser(pageUrl)
+        try:
+            parser.feed(body.decode('utf-8', 'replace'))
+            parser.close()
+        except Exception as e: # malformed html, use the urls found so far
+            print('Prefetcher:: parsePage: failed to parse ' + pageUrl + ': ' + str(e))
+
+        pageSite = Prefetcher.getSite(rqp.getHostName())
+        prefetchRequests = []
+        urls = set()
+        for url in parser.urls:
+            urlSplitted = urlsplit(url)
+            if urlSplitted.scheme != 'http' or urlSplitted.netloc == '' or Prefetcher.getSite(urlSplitted.netloc) != pageSite:
+                continue
+            filePath = urlSplitted.path if urlSplitted.path != '' else '/'
+            if urlSplitted.query != '':
+                filePath += '?' + urlSplitted.query
+            if urlSplitted.netloc + filePath in urls:
+                continue
+            urls.add(urlSplitted.netloc + filePath)
+            prefetchRequest = Prefetcher.__createRequest(rqp, urlSplitted.netloc, filePath, pageUrl)
+            if prefetchRequest is not None:
+                prefetchRequests.append(prefetchRequest)
+            if len(prefetchRequests) == Prefetcher.MAX_URLS_PER_PAGE:
+                break
+        return prefetchRequests
+
+    @staticmethod
+    def queueRequests(prefetchRequests):
+        '''
+        queue prefetch request packets, urls queued or prefetched already are left out
+        '''
+        Prefetcher.condition.acquire()
+        for prefetchRequest in prefetchRequests:
+            url = Prefetcher.__getUrlKey(prefetchRequest)
+            if url in Prefetcher.requests or url in Prefetcher.prefetched:
+                continue
+            if len(Prefetcher.requests) >= Prefetcher.MAX_QUEUE_SIZE:
+                Prefetcher.metrics['dropped'] += 1
+                continue
+            Prefetcher.requests[url] = prefetchRequest
+            Prefetcher.metrics['queued'] += 1
+        Prefetcher.condition.notify()
+        Prefetcher.condition.release()
+
+    @staticmethod
+    def markPrefetched(rqp):
+        '''
+        called by prefetch thread, url of rqp was prefetched and sent to cache
+        '''
+        Prefetcher.condition.acquire()
+        Prefetcher.__expire()
+        url = Prefetcher.__getUrlKey(rqp)
+        Prefetcher.prefetched.pop(url, None)
+        Prefetcher.prefetched[url] = monotonic()
+        Prefetcher.metrics['prefetched'] += 1
+        Prefetcher.condition.release()
+
+    @staticmethod
+    def markUsed(rqp):
+        '''
+        called by SocketHandler when rqp is answered from cache
+        '''
+        if len(Prefetcher.prefetched) == 0: # nothing prefetched, skip the lock
+            return
+        Prefetcher.condition.acquire()
+        Prefetcher.__expire()
+        if Prefetcher.prefetched.pop(Prefetcher.__getUrlKey(rqp), None) is not None:
+            Prefetcher.metrics['used'] += 1
+        Prefetcher.condition.release()
+
+    @staticmethod
+    def count(name):
+        Prefetcher.condition.acquire()
+        Prefetcher.metrics[name] += 1
+        Prefetcher.condition.release()
+
+    @staticmethod
+    def getMetrics():
+        '''
+        returns copy of metrics, with current queue lengths and prefetched urls not used yet (neither used nor wasted)
+        '''
+        Prefetcher.condition.acquire()
+        Prefetcher.__expire()
+        metrics = dict(Prefetcher.metrics)
+        metrics['queuedPages'] = len(Prefetcher.pages)
+        metrics['queueDepth'] = len(Prefetcher.requests)
+        metrics['pending'] = len(Prefetcher.prefetched)
+        Prefetcher.condition.release()
+        return metrics
+
+    @staticmethod
+    def getSite(host):
+        '''
+        returns site of host (host:port), the registrable domain, eg example.com for static.example.com:8080
+        guessed from the last two labels, three if the second last is a generic label (eg www.ust.edu.hk -> ust.edu.hk),
+        ip addresses are sites by themselves
+        '''
+        if host.startswith('['): # ipv6 address
+            hostname = host[1:host.find(']')]
+        else:
+            hostname = host.split(':')[0]
+        hostname = hostname.lower().rstrip('.')
+        try:
+            ipaddress.ip_address(hostname)
+            return hostname
+        except ValueError as e:
+            pass
+        labels = hostname.split('.')
+        if len(labels) > 2 and labels[-2] in Prefetcher.SECOND_LEVEL_LABELS:
+            return '.'.join(labels[-3:])
+        return '.'.join(labels[-2:])
+
+    @staticmethod
+    def __createRequest(rqp, host, filePath, pageUrl):
+        '''
+        returns GET request packet for http://host + filePath, forwarding headers of page request rqp
+        returns None if the url is not ascii
+        '''
+        requestRaw = 'GET http://' + host + filePath + ' HTTP/1.1\r\nHost: ' + host + '\r\n'
+        for fieldName in Prefetcher.FORWARDED_HEADERS:
+            if rqp.getHeaderInfo(fieldName.lower()) != 'nil':
+                requestRaw += fieldName + ': ' + rqp.getHeaderInfo(fieldName.lower()) + '\r\n'
+        requestRaw += 'Accept: */*\r\nReferer: ' + pageUrl + '\r\nPurpose: prefetch\r\nConnection: close\r\n\r\n'
+        try:
+            return RequestPacket.parsePacket(requestRaw.encode('ascii'))
+        except UnicodeError as e:
+            return None
+
+    @staticmethod
+    def __expire():
+        '''
+        count prefetched urls not used within USE_WINDOW as wasted, caller holds condition
+        '''
+        now = monotonic()
+        while len(Prefetcher.prefetched) > 0:
+            url, prefetchTime = next(iter(Prefetcher.prefetched.items()))
+            if now - prefetchTime <= Prefetcher.USE_WINDOW:
+                break
+            del Prefetcher.prefetched[url]
+            Prefetcher.metrics['wasted'] += 1
+
+    @staticmethod
+    def __getUrlKey(rqp):
+        return CacheKey.buildUrl(rqp.getHostName(), rqp.getFilePath())
+
+
+
+
+
+
+
+
+
+#  ██  ██      ██████  ██████  ███████ ███████ ███████ ████████  ██████ ██   ██     ██      ██ ███    ██ ██   ██     ██████   █████  ██████  ███████ ███████ ██████
+# ████████     ██   ██ ██   ██ ██      ██      ██         ██    ██      ██   ██     ██      ██ ████   ██ ██  ██      ██   ██ ██   ██ ██   ██ ██      ██      ██   ██
+#  ██  ██      ██████  ██████  █████   █████   █████      ██    ██      ███████     ██      ██ ██ ██  ██ █████       ██████  ███████ ██████  ███████ █████   ██████
+# ████████     ██      ██   ██ ██      ██      ██         ██    ██      ██   ██     ██      ██ ██  ██ ██ ██  ██      ██      ██   ██ ██   ██      ██ ██      ██   ██
+#  ██  ██      ██      ██   ██ ███████ ██      ███████    ██     ██████ ██   ██     ███████ ██ ██   ████ ██   ██     ██      ██   ██ ██   ██ ███████ ███████ ██   ██
+
+
+
+
+class PrefetchLinkParser(HTMLParser):
+    '''
+    collect absolute urls of subresources of a html page, in document order
+    <link> of rel in PREFETCH_RELS (href), <script> (src), <img> (src), <base href> is applied
+    '''
+
+    PREFETCH_RELS = ['stylesheet', 'icon', 'apple-touch-icon', 'preload', 'modulepreload']
+
+    def __init__(self, pageUrl):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.baseUrl = pageUrl
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        url = None
+        if tag == 'base' and attrs.get('href'):
+            self.baseUrl = urljoin(self.baseUrl, attrs['href'].strip())
+        elif tag == 'link':
+            rels = (attrs.get('rel') or '').lower().split()
+            for rel in rels:
+                if rel in PrefetchLinkParser.PREFETCH_RELS:
+                    url = attrs.get('href')
+                    break
+        elif tag == 'script' or tag == 'img':
+            url = attrs.get('src')
+        if url is not None and url.strip() != '':
+            self.urls.append(urljoin(self.baseUrl, url.strip()).split('#')[0])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+
+
+
+
+
+
+
+
+#  ██  ██      ██████  ██████  ███████ ███████ ███████ ████████  ██████ ██   ██     ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██   ██ ██   ██ ██      ██      ██         ██    ██      ██   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██████  ██████  █████   █████   █████      ██    ██      ███████        ██    ███████ ██████  █████   ███████ ██   ██
+# ████████     ██      ██   ██ ██      ██      ██         ██    ██      ██   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██      ██   ██ ███████ ██      ███████    ██     ██████ ██   ██        ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+class PrefetchThread(threading.Thread):
+    '''
+    prefetch thread of Prefetcher, parses queued pages and requests queued urls, at most Prefetcher.RATE per second
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lastRequestTime = None
+
+    def run(self):
+        '''
+        take queued pages and urls until Prefetcher is stopped
+        '''
+        while True:
+            task = Prefetcher.take()
+            if task is None:
+                break
+            kind, rqp, rsps = task
+            try:
+                if kind == 'page':
+                    Prefetcher.queueRequests(Prefetcher.parsePage(rqp, rsps))
+                    Prefetcher.count('pages')
+                else:
+                    self.__prefetch(rqp)
+            except Exception as e:
+                print('PrefetchThread:: failed to prefetch for ' + rqp.getHostName() + rqp.getFilePath() + ': ' + str(e))
+
+    def __prefetch(self, rqp):
+        '''
+        request rqp with a socket handler of its own (no client socket) and cache a 200 response,
+        unless the url is cached already or requested by a client meanwhile
+        '''
+        from SocketHandler import SocketHandler # not at module level, SocketHandler imports Prefetcher
+
+        if not CacheHandler.isIndexLoaded() or SocketHandler.onBlackList(rqp):
+            Prefetcher.count('skipped')
+            return
+        cacheKey = CacheHandler(rqp).getCacheKey()
+        entry = CacheHandler.getIndex().readEntry(cacheKey)
+        if entry is not None and not CacheIndex.isEmptyEntry(entry):
+            Prefetcher.count('skipped')
+            return
+
+        if self.lastRequestTime is not None: # rate limit
+            delay = self.lastRequestTime + 1 / Prefetcher.RATE - monotonic()
+            if delay > 0:
+                sleep(delay)
+        self.lastRequestTime = monotonic()
+
+        inFlightRequest, isLeader = RequestCoalescer.join(cacheKey, rqp) # clients requesting the url meanwhile wait for the prefetch
+        if not isLeader: # being requested by a client
+            Prefetcher.count('skipped')
+            return
+
+        socketHandler = SocketHandler(None)
+        rsps = None
+        try:
+            rsps = socketHandler.requestToServer(rqp)
+            if rsps != [] and rsps[0].responseCode() == '200' and RequestCoalescer.isShareable(rsps) and CacheWriter.submit('ADD', rqp, rsps):
+                Prefetcher.markPrefetched(rqp)
+                print('PrefetchThread:: prefetched ' + cacheKey)
+            else:
+                Prefetcher.count('failed')
+        except Exception as e:
+            Prefetcher.count('failed')
+            rsps = None
+            raise e
+        finally:
+            RequestCoalescer.finish(cacheKey, inFlightRequest, rsps if rsps != [] else None)
+            socketHandler.closeConnection()
+            if socketHandler.serverSideSocket is not None:
+                socketHandler.serverSideSocket.close()
@@ -1,5 +1,9 @@
 from socket import *
-from CacheHandler import CacheHandler
+from CacheHandler import CacheHandler, CacheWriter
+from AdminHandler import AdminHandler
+from Prefetcher import Prefetcher
+from CachePeers import CachePeers
+from ExpirySweeper import ExpirySweeper
 
 
 #  ██  ██      ██████  ██████   ██████  ██   ██ ██    ██
@@ -27,7 +31,7 @@ class Proxy:
         default port number: 6298
 
         initialize welcoming socket, freeIndexArr, connectionThreads array,
-        configure CacheHandler hashed locks
+        configure CacheHandler hashed locks and cache index, start cache writers, prefetcher, cache peering, expiry sweeper and admin server
 
         MAX_CONNECTION:         @static
 
@@ -60,6 +64,12 @@ class Proxy:
             Proxy.freeIndexArr.append(True)
             Proxy.connectionThreads.append([])
         CacheHandler.initHashedLocks(Proxy.MAX_CONNECTION)
+        CacheHandler.initIndex()
+        CacheWriter.start()
+        Prefetcher.start()
+        CachePeers.start()
+        ExpirySweeper.start()
+        AdminHandler.start()
         print('Proxy:: server starts')
 
     def getFreeIndex(self):
@@ -89,7 +99,7 @@ class Proxy:
         on key interrupt:
             close connections,
             join all threads,
-            write cache lookup table to file
+            flush cache lookup table journal
         '''
         while True:
             try:
@@ -111,10 +121,13 @@ class Proxy:
                 for i in range(Proxy.MAX_CONNECTION): # call close connection, dont wait for child processes here
                     if not Proxy.freeIndexArr[i]:
                         Proxy.connectionThreads[i].closeConnection()
-                CacheHandler.writeLookupTableToFile()
                 for i in range(Proxy.MAX_CONNECTION): # wait for all child processes
                     if not Proxy.freeIndexArr[i]:
                         Proxy.connectionThreads[i].join()
+                AdminHandler.stop()
+                Prefetcher.stop()
+                CachePeers.stop()
+                ExpirySweeper.stop()
                 CacheHandler.exitRoutine()
                 print('Proxy:: closing proxy') # after joining all processes, quit function`
                 break
@@ -138,6 +151,7 @@ class Proxy:
 
 import threading
 from SocketHandler import SocketHandler
+from Metrics import Metrics
 
 class ConnectionThread(threading.Thread):
     '''
@@ -156,7 +170,11 @@ class ConnectionThread(threading.Thread):
         when finish, set Proxy.freeIndexArr[idx] to be free (True)
         '''
         print('ConnectionThread:: thread id: ' + str(self.idx) + ' starting')
-        self.socketHandler.handleRequest()
+        Metrics.increment('proxy_active_connections')
+        try:
+            self.socketHandler.handleRequest()
+        finally:
+            Metrics.increment('proxy_active_connections', value=-1)
         print('ConnectionThread:: thread id: ' + str(self.idx) + ' ending')
         Proxy.setFreeIndex(self.idx, True)
         print('ConnectionThread:: thread id: ' + str(self.idx) + ' in Proxy class is set free')
@@ -0,0 +1,210 @@
+import os
+from ResponsePacket import ResponsePacket
+
+class RangeHandler:
+    '''
+    answer Range requests from complete cached responses, used by SocketHandler
+    single range: 206 with Content-Range
+    multiple ranges: 206 multipart/byteranges
+    no satisfiable range: 416
+
+    the Range header is ignored (full response is sent) if
+        it is not a valid 'bytes' range,
+        If-Range does not match the cached response,
+        cached response is not a complete 200 response
+    '''
+
+    MAX_RANGES = 64 # more ranges than this are ignored, full response is sent instead
+
+    @staticmethod
+    def respond(rqp, rsps):
+        '''
+        returns list of response packets/ raw payloads answering Range of rqp from rsps (cached responses)
+        returns None if rsps should be sent as is
+        '''
+        rangeHeader = rqp.getHeaderInfo('range')
+        if rangeHeader == 'nil' or rsps is None or rsps == [] or rsps[0].responseCode() != '200':
+            return None
+        if not RangeHandler.matchesIfRange(rqp, rsps[0]):
+            return None
+
+        pieces = RangeHandler.getBody(rsps)
+        if pieces is None: # incomplete cached response
+            return None
+        length = 0
+        for piece in pieces:
+            length += len(piece)
+
+        ranges = RangeHandler.parseRange(rangeHeader, length)
+        if ranges is None:
+            return None
+        if ranges == []:
+            print('RangeHandler:: respond: range not satisfiable: ' + rangeHeader)
+            return [RangeHandler.__createResponse(rsps[0], '416 Range Not Satisfiable', ['Content-Range: bytes */' + str(length), 'Content-Length: 0'])]
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headerFields = ['Content-Range: bytes ' + str(start) + '-' + str(end) + '/' + str(length), 'Content-Length: ' + str(end - start + 1)]
+            return [RangeHandler.__createResponse(rsps[0], '206 Partial Content', headerFields)] + RangeHandler.slice(pieces, start, end + 1)
+
+        boundary = os.urandom(12).hex()
+        contentType = rsps[0].getHeaderInfo('content-type')
+        parts = []
+        for start, end in ranges:
+            partHeader = '--' + boundary + '\r\n'
+            if contentType != 'nil':
+                partHeader += 'Content-Type: ' + contentType + '\r\n'
+            partHeader += 'Content-Range: bytes ' + str(start) + '-' + str(end) + '/' + str(length) + '\r\n\r\n'
+            parts.append(partHeader.encode('ascii'))
+            parts += RangeHandler.slice(pieces, start, end + 1)
+            parts.append(b'\r\n')
+        parts.append(('--' + boundary + '--\r\n').encode('ascii'))
+
+        contentLength = 0
+        for part in parts:
+            contentLength += len(part)
+        headerFields = ['Content-Type: multipart/byteranges; boundary=' + boundary, 'Content-Length: ' + str(contentLength)]
+        return [RangeHandler.__createResponse(rsps[0], '206 Partial Content', headerFields, dropContentType=True)] + parts
+
+    @staticmethod
+    def parseRange(rangeHeader, length):
+        '''
+        returns list of (start, end) (inclusive) for a representation of length bytes, in order requested
+        returns [] if no range is satisfiable
+        returns None if rangeHeader is invalid, or should be ignored
+        '''
+        rangeHeader = rangeHeader.strip()
+        if rangeHeader[0:len('bytes=')].lower() != 'bytes=':
+            return None
+        specs = rangeHeader[len('bytes='):].split(',')
+        if len(specs) > RangeHandler.MAX_RANGES:
+            return None
+
+        ranges = []
+        for spec in specs:
+            spec = spec.strip()
+            if spec == '':
+                continue
+            if '-' not in spec:
+                return None
+            first, last = spec.split('-', 1)
+            first = first.strip()
+            last = last.strip()
+            try:
+                if first == '': # suffix range, last n bytes
+                    suffixLength = int(last)
+                    if suffixLength <= 0:
+                        continue
+                    start = max(length - suffixLength, 0)
+                    end = length - 1
+                else:
+                    start = int(first)
+                    end = length - 1 if last == '' else min(int(last), length - 1)
+                    if last != '' and int(last) < start:
+                        return None
+            except ValueError as e:
+                return None
+            if start < 0:
+                return None
+            if start >= length: # not satisfiable
+                continue
+            ranges.append((start, end))
+        return ranges
+
+    @staticmethod
+    def matchesIfRange(rqp, rsp):
+        '''
+        returns true if Range of rqp should be applied to rsp, i.e. If-Range is absent or matches rsp
+        If-Range holds a strong etag or a http date
+        '''
+        ifRange = rqp.getHeaderInfo('if-range')
+        if ifRange == 'nil':
+            return True
+        if ifRange[0:1] == '"' or ifRange[0:2] == 'W/':
+            return ifRange[0:2] != 'W/' and ifRange == rsp.getHeaderInfo('etag')
+        return ifRange == rsp.getHeaderInfo('last-modified')
+
+    @staticmethod
+    def getBody(rsps):
+        '''
+        returns body of cached responses as list of bytes/ memoryview pieces (not copied)
+        chunked body is decoded
+        returns None if the body is incomplete (shorter than Content-Length, or last chunk missing)
+        '''
+        pieces = [rsps[0].getPayload()]
+        for rsp in rsps[1:]:
+            try:
+                pieces.append(rsp.getPacketRaw())
+            except AttributeError as e:
+                pieces.append(rsp)
+
+        if rsps[0].isChunked():
+            return RangeHandler.__decodeChunked(b''.join(pieces))
+
+        length = 0
+        for piece in pieces:
+            length += len(piece)
+        contentLength = rsps[0].getHeaderInfo('content-length')
+        if contentLength != 'nil' and int(contentLength) != length:
+            return None
+        return pieces
+
+    @staticmethod
+    def slice(pieces, start, end):
+        '''
+        returns list of pieces holding bytes [start, end) of the concatenation of pieces
+        memoryview pieces are sliced without copying
+        '''
+        sliced = []
+        offset = 0
+        for piece in pieces:
+            pieceLength = len(piece)
+            if offset + pieceLength > start and offset < end:
+                sliced.append(piece[max(start - offset, 0) : min(end - offset, pieceLength)])
+            offset += pieceLength
+            if offset >= end:
+                break
+        return sliced
+
+    @staticmethod
+    def __decodeChunked(body):
+        '''
+        returns [decoded body], None if the last chunk is missing or a chunk is malformed
+        '''
+        decoded = []
+        position = 0
+        while True:
+            lineEnd = body.find(b'\r\n', position)
+            if lineEnd == -1:
+                return None
+            try:
+                chunkSize = int(bytes(body[position:lineEnd]).split(b';')[0].strip(), 16)
+            except ValueError as e:
+                return None
+            if chunkSize == 0: # last chunk
+                return [b''.join(decoded)]
+            chunkStart = lineEnd + 2
+            if chunkStart + chunkSize > len(body):
+                return None
+            decoded.append(body[chunkStart : chunkStart + chunkSize])
+            position = chunkStart + chunkSize + 2 # skip chunk data and '\r\n'
+
+    @staticmethod
+    def __createResponse(rsp, status, headerFields, dropContentType=False):
+        '''
+        returns header only response packet based on rsp (cached response) with status and headerFields
+        framing fields of rsp are replaced by headerFields
+        '''
+        droppedFields = ['content-length', 'transfer-encoding', 'content-range']
+        if dropContentType:
+            droppedFields.append('content-type')
+        headerSplitted = []
+        for ss in rsp.getHeaderSplitted():
+            if ss.split(':')[0].strip().lower() not in droppedFields:
+                headerSplitted.append(ss)
+        headerSplitted += headerFields
+
+        response = ResponsePacket()
+        response.setResponseLine(rsp.getResponseLine().split(' ')[0] + ' ' + status)
+        response.setHeaderSplitted(headerSplitted)
+        return response
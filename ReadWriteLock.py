@@ -0,0 +1,60 @@
+import threading
+
+class ReadWriteLock:
+    '''
+    reader-writer lock, writer-preferring
+    many readers can hold the lock at the same time, a writer holds it alone,
+    readers arriving while a writer waits queue behind it, so writers are never starved
+
+    acquire()/ release() take the write lock, so it can be used where a threading.Semaphore guarded writes
+    '''
+
+    def __init__(self):
+        '''
+        __condition:            guards the counters below, readers and writers wait on it
+
+        __numReaders:           number of threads holding the read lock
+
+        __isWriting:            true if a thread holds the write lock
+
+        __numWaitingWriters:    number of threads waiting for the write lock
+        '''
+        self.__condition = threading.Condition(threading.Lock())
+        self.__numReaders = 0
+        self.__isWriting = False
+        self.__numWaitingWriters = 0
+
+    def acquireRead(self):
+        self.__condition.acquire()
+        while self.__isWriting or self.__numWaitingWriters > 0:
+            self.__condition.wait()
+        self.__numReaders += 1
+        self.__condition.release()
+
+    def releaseRead(self):
+        self.__condition.acquire()
+        self.__numReaders -= 1
+        if self.__numReaders == 0: # a waiting writer can go
+            self.__condition.notify_all()
+        self.__condition.release()
+
+    def acquire(self):
+        '''
+        acquire write lock
+        '''
+        self.__condition.acquire()
+        self.__numWaitingWriters += 1
+        while self.__isWriting or self.__numReaders > 0:
+            self.__condition.wait()
+        self.__numWaitingWriters -= 1
+        self.__isWriting = True
+        self.__condition.release()
+
+    def release(self):
+        '''
+        release write lock
+        '''
+        self.__condition.acquire()
+        self.__isWriting = False
+        self.__condition.notify_all()
+        self.__condition.release()
@@ -0,0 +1,105 @@
+import threading
+
+class RequestCoalescer:
+    '''
+    collapsed forwarding of concurrent cache misses
+    it acts as a global singleton, used by SocketHandler
+
+    the first miss of a cache key becomes the leader and requests the server,
+    misses of the same key arriving meanwhile (followers) wait for the leader
+    and send its responses instead of requesting the server themselves,
+    only the leader caches the responses
+
+    a follower requests the server by itself if
+        leader failed/ timed out,
+        leader's responses cannot be shared (not 200, private, set-cookie),
+        follower's request differs from leader's in a header named by Vary
+    '''
+
+    WAIT_TIMEOUT = 30 # seconds a follower waits for the leader
+    inFlight = {} # cacheKey -> in flight request {'rqp', 'done', 'rsps'}
+    inFlightLock = threading.Semaphore()
+
+    @staticmethod
+    def join(cacheKey, rqp):
+        '''
+        returns (inFlightRequest, isLeader)
+        inFlightRequest is None if the request should not be coalesced
+        '''
+        if rqp.getHeaderInfo('authorization') != 'nil' or rqp.getHeaderInfo('range') != 'nil': # response specific to this request
+            return (None, True)
+
+        RequestCoalescer.inFlightLock.acquire()
+        inFlightRequest = RequestCoalescer.inFlight.get(cacheKey)
+        if inFlightRequest is None:
+            inFlightRequest = {'rqp' : rqp, 'done' : threading.Event(), 'rsps' : None}
+            RequestCoalescer.inFlight[cacheKey] = inFlightRequest
+            isLeader = True
+        else:
+            isLeader = False
+        RequestCoalescer.inFlightLock.release()
+        return (inFlightRequest, isLeader)
+
+    @staticmethod
+    def finish(cacheKey, inFlightRequest, rsps):
+        '''
+        called by leader, wake up followers
+        rsps is None if leader failed
+        '''
+        if inFlightRequest is None:
+            return
+        RequestCoalescer.inFlightLock.acquire()
+        if RequestCoalescer.inFlight.get(cacheKey) is inFlightRequest:
+            del RequestCoalescer.inFlight[cacheKey]
+        RequestCoalescer.inFlightLock.release()
+
+        if rsps is not None and RequestCoalescer.isShareable(rsps):
+            inFlightRequest['rsps'] = rsps
+        inFlightRequest['done'].set()
+
+    @staticmethod
+    def wait(inFlightRequest, rqp):
+        '''
+        called by follower
+        returns leader's responses, None if they cannot be used for rqp
+        '''
+        if not inFlightRequest['done'].wait(RequestCoalescer.WAIT_TIMEOUT):
+            print('RequestCoalescer:: wait: timeout, request server directly')
+            return None
+        rsps = inFlightRequest['rsps']
+        if rsps is None:
+            return None
+        if not RequestCoalescer.matchesVary(inFlightRequest['rqp'], rqp, rsps[0]):
+            return None
+        return rsps
+
+    @staticmethod
+    def isShareable(rsps):
+        '''
+        returns true if responses can be sent to other clients
+        '''
+        if rsps == [] or rsps[0].responseCode() != '200':
+            return False
+        if rsps[0].getHeaderInfo('set-cookie') != 'nil':
+            return False
+        cacheOptionSplitted = rsps[0].getHeaderInfo('cache-control').lower().split(',')
+        for option in cacheOptionSplitted:
+            if option.strip() == 'private' or option.strip() == 'no-store':
+                return False
+        return True
+
+    @staticmethod
+    def matchesVary(leaderRqp, rqp, rsp):
+        '''
+        returns true if every request header listed in Vary of rsp is the same in both requests
+        '''
+        vary = rsp.getHeaderInfo('vary')
+        if vary == 'nil':
+            return True
+        for fieldName in vary.lower().split(','):
+            fieldName = fieldName.strip()
+            if fieldName == '*':
+                return False
+            if leaderRqp.getHeaderInfo(fieldName) != rqp.getHeaderInfo(fieldName):
+                return False
+        return True
@@ -121,6 +121,16 @@ class RequestPacket:
         else:
             self.__headerSplitted[index] = 'if-modified-since: ' + time
 
+    def setHeader(self, fieldName, value):
+        '''
+        set header field fieldName to value, replace the field if present, otherwise append
+        '''
+        for idx in range(len(self.__headerSplitted)):
+            if self.__headerSplitted[idx].split(':')[0].strip().lower() == fieldName.lower():
+                self.__headerSplitted[idx] = fieldName + ': ' + value
+                return
+        self.__headerSplitted.append(fieldName + ': ' + value)
+
     def getHostName(self):
         hostLine = ''
         for ss in self.__headerSplitted:
@@ -159,13 +169,13 @@ class RequestPacket:
         '''
         line = ''
         for ss in self.__headerSplitted:
-            if ss[0:len(fieldName)].lower() == fieldName:
+            if ss[0:len(fieldName)].lower() == fieldName and ss[len(fieldName):len(fieldName) + 1] == ':': # whole field name, 'accept' must not match 'accept-encoding'
                 line = ss
                 break
         if line == '':
             return 'nil'
         else:
-            return line[len(fieldName) + 2 :] # strip 'fieldName: '
+            return line[len(fieldName) + 1 :].strip() # strip 'fieldName:' and surrounding whitespace
 
     def getVersion(self):
         requestLineSplitted = self.__requestLine.split(' ')
@@ -0,0 +1,116 @@
+from ContentCoding import ContentCoding
+from RangeHandler import RangeHandler
+
+class ResponseCompressor:
+    '''
+    compress uncompressed responses on the fly for clients accepting it, used by SocketHandler
+    the body is encoded piece by piece and sent with chunked transfer coding as it is encoded,
+    only responses received as a whole are compressed: the body must be complete (see RangeHandler.getBody),
+    responses streamed to the client as they arrive (larger than SocketHandler.MAX_BUFFER_SIZE) are sent as is
+
+    responses are sent as is if
+        compression is disabled (CODINGS is empty),
+        request is not GET, or not HTTP/1.1 (no chunked transfer coding),
+        response is not 200, is encoded already, its content type is not compressible (see ContentCoding),
+        it says no-transform, or its body is smaller than MIN_SIZE
+    '''
+
+    CODINGS = [] # codings applied to responses, in order of preference, eg ['gzip', 'deflate']
+    LEVEL = 6
+    MIN_SIZE = 1024 # bytes, smaller bodies are not worth compressing
+
+    @staticmethod
+    def respond(rqp, rsps):
+        '''
+        returns response packets/ raw payloads to send for rsps, compressed if the client accepts a coding in CODINGS
+        returns a generator, pieces are encoded while being sent, the pieces themselves are held in memory already
+        returns rsps with Vary extended if the response could be compressed but the client does not accept any coding
+        returns None if rsps should be sent as is
+        '''
+        if not ResponseCompressor.isCompressible(rqp, rsps):
+            return None
+        pieces = RangeHandler.getBody(rsps)
+        if pieces is None: # incomplete body
+            return None
+        size = 0
+        for piece in pieces:
+            size += len(piece)
+        if size < ResponseCompressor.MIN_SIZE:
+            return None
+
+        header = rsps[0].copyHeader()
+        header.setHeader('Vary', ContentCoding.addVary(rsps[0].getHeaderInfo('vary'), 'Accept-Encoding')) # depends on accept-encoding from now on
+        coding = ResponseCompressor.negotiate(rqp.getHeaderInfo('accept-encoding'))
+        if coding is None:
+            header.setPayload(rsps[0].getPayload())
+            return [header] + rsps[1:]
+
+        print('ResponseCompressor:: respond: compressing ' + str(size) + ' bytes with ' + coding)
+        header.removeHeader('content-length')
+        header.setHeader('Transfer-Encoding', 'chunked')
+        header.setHeader('Content-Encoding', coding)
+        if rsps[0].getHeaderInfo('etag') != 'nil':
+            header.setHeader('ETag', ContentCoding.weakenETag(rsps[0].getHeaderInfo('etag')))
+        return ResponseCompressor.__encode(header, pieces, coding)
+
+    @staticmethod
+    def isCompressible(rqp, rsps):
+        '''
+        returns true if rsps (response to rqp) can be compressed by the proxy, regardless of accept-encoding
+        '''
+        if ResponseCompressor.CODINGS == [] or rsps is None or rsps == []:
+            return False
+        if rqp.getMethod().lower() != 'get' or str(rqp.getVersion()).upper() != 'HTTP/1.1':
+            return False
+        rsp = rsps[0]
+        if rsp.responseCode() != '200' or rsp.getHeaderInfo('content-encoding') not in ['nil', 'identity']:
+            return False
+        if not ContentCoding.isCompressible(rsp.getHeaderInfo('content-type')):
+            return False
+        for option in rsp.getHeaderInfo('cache-control').lower().split(','):
+            if option.strip() == 'no-transform':
+                return False
+        return True
+
+    @staticmethod
+    def negotiate(acceptEncoding):
+        '''
+        returns coding in CODINGS most preferred by acceptEncoding (value of Accept-Encoding)
+        returns None if the client accepts none of them, or sent no accept-encoding
+        codings are applied only if listed, or matched by '*', and not less preferred than identity
+        '''
+        if acceptEncoding == 'nil': # many clients without accept-encoding cannot decode
+            return None
+        qValues, order = ContentCoding.parseAcceptEncoding(acceptEncoding)
+        identityQ = qValues.get('identity', qValues.get('*', 1.0))
+        bestCoding = None
+        bestQ = 0
+        for coding in ResponseCompressor.CODINGS:
+            q = qValues.get(coding, qValues.get('*', 0))
+            if q > bestQ and q >= identityQ:
+                bestCoding = coding
+                bestQ = q
+        return bestCoding
+
+    @staticmethod
+    def __encode(header, pieces, coding):
+        '''
+        yields header, then each encoded piece as a chunk, then the last chunk
+        '''
+        yield header
+        encoder = ContentCoding.createEncoder(coding, ResponseCompressor.LEVEL)
+        for piece in pieces:
+            data = encoder.compress(piece)
+            if len(data) > 0:
+                yield ResponseCompressor.__chunk(data)
+        data = encoder.flush()
+        if len(data) > 0:
+            yield ResponseCompressor.__chunk(data)
+        yield b'0\r\n\r\n'
+
+    @staticmethod
+    def __chunk(data):
+        '''
+        returns data framed as one chunk of chunked transfer coding
+        '''
+        return ('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n'
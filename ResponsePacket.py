@@ -1,4 +1,5 @@
 from RequestPacket import RequestPacket
+from TimeComparator import TimeComparator
 
 class ResponsePacket:
     '''
@@ -77,6 +78,34 @@ class ResponsePacket:
         rp = ResponsePacket.parsePacket(packetRaw)
         return rp
 
+    @classmethod
+    def notModifiedPacket(cls, rsp):
+        '''
+        creates 304 Not Modified packet for cached response rsp
+        fields a 304 must carry (cache-control, etag, expires, vary, ...) are copied from rsp,
+        date is current time
+        '''
+        COPIED_FIELDS = ['cache-control', 'content-location', 'etag', 'expires', 'last-modified', 'vary', 'connection', 'keep-alive']
+        packet = rsp.getResponseLine().split(' ')[0] + ' 304 Not Modified\r\n'
+        packet += 'Date: ' + TimeComparator.currentTime().toString() + '\r\n'
+        for ss in rsp.getHeaderSplitted():
+            if ss.split(':')[0].strip().lower() in COPIED_FIELDS:
+                packet += ss + '\r\n'
+        packet += '\r\n'
+        return ResponsePacket.parsePacket(packet.encode('ascii'))
+
+    @classmethod
+    def gatewayTimeoutPacket(cls, rqp):
+        '''
+        creates 504 Gateway Timeout packet, answer to only-if-cached request rqp not found in cache
+        '''
+        packet = rqp.getVersion() + ' 504 Gateway Timeout\r\n'
+        packet += 'Date: ' + TimeComparator.currentTime().toString() + '\r\n'
+        packet += 'Cache-Control: no-store\r\n'
+        packet += 'Content-Length: 0\r\n'
+        packet += '\r\n'
+        return ResponsePacket.parsePacket(packet.encode('ascii'))
+
     def setHeaderSplitted(self, headerSplitted):
         self.__headerSplitted = headerSplitted
 
@@ -86,6 +115,35 @@ class ResponsePacket:
     def setPayload(self, payload):
         self.__payload = payload
 
+    def setHeader(self, fieldName, value):
+        '''
+        set header field fieldName to value, replace the field if present, otherwise append
+        '''
+        for idx in range(len(self.__headerSplitted)):
+            if self.__headerSplitted[idx].split(':')[0].strip().lower() == fieldName.lower():
+                self.__headerSplitted[idx] = fieldName + ': ' + value
+                return
+        self.__headerSplitted.append(fieldName + ': ' + value)
+
+    def removeHeader(self, fieldName):
+        '''
+        remove every line of header field fieldName
+        '''
+        headerSplitted = []
+        for ss in self.__headerSplitted:
+            if ss.split(':')[0].strip().lower() != fieldName.lower():
+                headerSplitted.append(ss)
+        self.__headerSplitted = headerSplitted
+
+    def copyHeader(self):
+        '''
+        returns new packet with same response line and header fields, without payload
+        '''
+        rp = ResponsePacket()
+        rp.setResponseLine(self.__responseLine)
+        rp.setHeaderSplitted(list(self.__headerSplitted))
+        return rp
+
     def modifyTime(self, time):
         '''
         change the date field to ${time}
@@ -155,13 +213,13 @@ class ResponsePacket:
         '''
         line = ''
         for ss in self.__headerSplitted:
-            if ss[0:len(fieldName)].lower() == fieldName:
+            if ss[0:len(fieldName)].lower() == fieldName and ss[len(fieldName):len(fieldName) + 1] == ':': # whole field name, 'accept' must not match 'accept-encoding'
                 line = ss
                 break
         if line == '':
             return 'nil'
         else:
-            return line[len(fieldName) + 2 :] # strip 'fieldName: '
+            return line[len(fieldName) + 1 :].strip() # strip 'fieldName:' and surrounding whitespace
 
     def getPacket(self, option=''):
         s = ''
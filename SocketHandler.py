@@ -1,10 +1,19 @@
 from socket import *
 from RequestPacket import RequestPacket
 from ResponsePacket import ResponsePacket
-from CacheHandler import CacheHandler, CacheThread
+from CacheHandler import CacheHandler, CacheWriter, SpilledBody
+from RequestCoalescer import RequestCoalescer
+from RangeHandler import RangeHandler
+from ResponseCompressor import ResponseCompressor
+from AdminHandler import AdminHandler
+from NegativeCache import NegativeCache
+from Prefetcher import Prefetcher
+from CachePeers import CachePeers
 from TimeComparator import TimeComparator
-from time import sleep
+from Metrics import Metrics
+from time import sleep, monotonic
 import errno
+import select
 import threading
 
 
@@ -28,9 +37,16 @@ class SocketHandler:
     '''
 
     BUFFER_SIZE = 8192 # 8KB
+    MAX_BUFFER_SIZE = 16 * 1024 * 1024 # bytes of a response held in memory, larger responses are streamed
     HTTPS_PORT = 443
     HTTP_PORT = 80
     BANNED_SITES = None
+    STALE_GRACE_PERIOD = 0 # seconds an expired entry can still be served, like stale-while-revalidate/ stale-if-error for every entry
+    CACHE_RESULTS = { # handleRequest path of GET -> cache result counted in metrics
+        'BAA' : 'hit', 'BBAA' : 'hit', 'BBABA' : 'stale', 'AC' : 'negative',
+        'BAB' : 'revalidate', 'BBABB' : 'revalidate', 'BBABC' : 'revalidate', 'BBB' : 'revalidate',
+        'A' : 'miss', 'AA' : 'miss', 'AB' : 'miss', 'AD' : 'miss', 'AE' : 'miss', 'AF' : 'miss', 'AG' : 'miss', 'BBABD' : 'miss'
+    }
 
     def __init__(self, socket):
         '''
@@ -39,12 +55,20 @@ class SocketHandler:
         BUFFER_SIZE:            @static
                                 maximum buffer size to receive/ send packet
 
+        MAX_BUFFER_SIZE:        @static
+                                maximum size of a response held in memory,
+                                the rest of a larger response is sent to the client as it is received,
+                                and spilled to disk if it may be cached (see SpilledBody)
+
         HTTPS_PORT:             @static
                                 port number for HTTPS protocol
 
         HTTP_PORT:              @static
                                 port number for HTTP protocol
 
+        STALE_GRACE_PERIOD:     @static
+                                proxy-wide minimum of stale-while-revalidate and stale-if-error
+
         __socket:               socket to client
 
         __timeout:              boolean, true if timer ends
@@ -60,6 +84,9 @@ class SocketHandler:
         serverSideSocket:       socket to server
 
         serverAddr:             server address
+
+        isStreamed:             true if the responses of the last requestToServer() were sent to the client already,
+                                too large to be held in memory
         '''
         self.__socket = socket
         self.__timeout = False
@@ -70,6 +97,7 @@ class SocketHandler:
         self.__threadRunning.set()
         self.serverSideSocket = None
         self.serverAddr = None
+        self.isStreamed = False
         print('SocketHandler:: Socket handler initialized')
 
     def handleRequest(self):
@@ -101,6 +129,7 @@ class SocketHandler:
             if requestRaw == b'': # data received is empty
                 continue
             rqp = RequestPacket.parsePacket(requestRaw)
+            startTime = monotonic()
             print('SocketHandler:: received request: \n' + rqp.getPacket('DEBUG') + '\nrequest packet end\n')
 
             if self.onBlackList(rqp):
@@ -110,74 +139,159 @@ class SocketHandler:
                 if self.serverSideSocket is not None:
                     self.serverSideSocket.close()
                 self.closeConnection()
+                self.__recordRequest('BANNED', startTime)
                 return
             else:
                 print('SocketHandler:: client access ok: ' + rqp.getHostName())
 
-            if rqp.getMethod().lower() == 'connect': # PATH HTTPS
-                self.establishHTTPSConnection(rqp)
+            if AdminHandler.isAdminRequest(rqp): # answered by the proxy itself PATH ADMIN
+                path = 'ADMIN'
+                rsps = [AdminHandler.respond(rqp.getMethod(), rqp.getFilePath(), self.__socket.getpeername()[0], rqp)]
+                self.__respondToClient(rsps, source='proxy')
+            elif rqp.getMethod().lower() == 'connect': # PATH HTTPS
+                self.__recordRequest('HTTPS', startTime) # tunnel lifetime is not a request latency
+                Metrics.increment('proxy_active_tunnels')
+                try:
+                    self.establishHTTPSConnection(rqp)
+                finally:
+                    Metrics.increment('proxy_active_tunnels', value=-1)
                 self.closeConnection()
                 return
             elif rqp.getMethod().lower() == 'get':
                 fetcher = CacheHandler(rqp=rqp)
                 fetchedResponses, expiry = fetcher.fetchResponses()
-
-                if fetchedResponses is None: # no cache found PATH A
-                    try:
-                        rsps = self.requestToServer(rqp)
-                    except ValueError as e:
-                        self.__socket.close()
-                        break
-
-                    if rsps == []:
-                        self.__socket.close()
-                        if self.serverSideSocket is not None:
-                            self.serverSideSocket.close()
-                        self.closeConnection()
-                        return
+                negativeResponses = None
+                if fetchedResponses is None:
+                    negativeResponses = NegativeCache.getResponses(rqp)
+
+                if CachePeers.isOnlyIfCached(rqp) and (fetchedResponses is None or not self.__isFresh(expiry)): # eg request of a peer, never ask the server PATH AE
+                    print('SocketHandler:: only-if-cached request not found in cache, 504 sent')
+                    path = 'AE'
+                    rsps = [ResponsePacket.gatewayTimeoutPacket(rqp)]
+                    self.__respondToClient(rsps, source='proxy')
+
+                elif negativeResponses is not None: # no cache found, url was not found recently PATH AC
+                    print('SocketHandler:: responses from negative cache: ' + negativeResponses[0].responseCode())
+                    path = 'AC'
+                    rsps = negativeResponses
+                    self.__respondToClient(rsps, source='cache')
+
+                elif fetchedResponses is None: # no cache found PATH A
+                    cacheKey = fetcher.getCacheKey()
+                    inFlightRequest, isLeader = RequestCoalescer.join(cacheKey, rqp)
+                    rsps = None
+                    if not isLeader: # same url is being requested by another connection, wait for its responses
+                        rsps = RequestCoalescer.wait(inFlightRequest, rqp)
+
+                    if rsps is not None: # responses shared by concurrent request, already cached by it PATH AB
+                        print('SocketHandler:: responses shared by concurrent request: ' + cacheKey)
+                        path = 'AB'
+                        Prefetcher.markUsed(rqp)
+                        self.__respondToClient(rsps, rqp)
                     else:
-                        print('SocketHandler:: received response 1 of total ' + str(len(rsps)) + ': \n' + rsps[0].getPacket('DEBUG') + '\nresponse packet end\n')
-                    if rsps[0].responseCode() == '200' or rsps[0].responseCode() == '206': # PATH AA
-                        ct = CacheThread('ADD', rqp, rsps)
-                        ct.start()
-                    else: # PATH A
-                        pass
-                    self.__respondToClient(rsps)
-
-                else: # cache response found PATH B
-                    if rqp.getHeaderInfo('if-modified-since') != 'nil': # PATH BA
                         try:
-                            rsps = self.__handleRequestSubroutine(rqp)
-                        except Exception as e:
-                            print('SocketHandler:: handleRequest: error encountered, ending connection')
+                            path = 'AF'
+                            rsps = self.__requestFromPeer(rqp) # PATH AF if a peer has it cached
+                            if rsps is None:
+                                path = None # by response of server below
+                                rsps = self.requestToServer(rqp, spill=True)
+                        except ValueError as e:
+                            if isLeader:
+                                RequestCoalescer.finish(cacheKey, inFlightRequest, None)
+                            self.__socket.close()
                             break
+                        except Exception as e:
+                            if isLeader:
+                                RequestCoalescer.finish(cacheKey, inFlightRequest, None)
+                            raise e
+                        if isLeader: # streamed responses do not hold the body, waiting requests ask the server themselves
+                            RequestCoalescer.finish(cacheKey, inFlightRequest, None if self.isStreamed else rsps)
+
+                        if rsps == []:
+                            self.__socket.close()
+                            if self.serverSideSocket is not None:
+                                self.serverSideSocket.close()
+                            self.closeConnection()
+                            return
+                        else:
+                            print('SocketHandler:: received response 1 of total ' + str(len(rsps)) + ': \n' + rsps[0].getPacket('DEBUG') + '\nresponse packet end\n')
+                        if self.isStreamed: # too large for memory, sent to client already PATH AG
+                            path = path or 'AG'
+                            if SpilledBody.isSpilled(rsps):
+                                CacheWriter.submit('ADD', rqp, rsps)
+                        elif rsps[0].responseCode() == '200': # PATH AA, 206 holds part of the body only, never cached
+                            path = path or 'AA'
+                            CacheWriter.submit('ADD', rqp, rsps)
+                            Prefetcher.submitPage(rqp, rsps)
+                        elif rsps[0].responseCode() == '404' or rsps[0].responseCode() == '410': # PATH AD
+                            path = path or 'AD'
+                            NegativeCache.putResponses(rqp, rsps)
+                        else: # PATH A
+                            path = path or 'A'
+                        if rsps[0].responseCode() == '206': # range of an uncached url, cache the whole response for the next ranges
+                            self.__fillForRange(rqp, rsps[0], cacheKey)
+                        if not self.isStreamed:
+                            self.__respondToClient(rsps, rqp)
+
+                else: # cache response found PATH B
+                    Prefetcher.markUsed(rqp)
+                    if rqp.getHeaderInfo('if-modified-since') != 'nil' or rqp.getHeaderInfo('if-none-match') != 'nil': # conditional request PATH BA
+                        if self.__isFresh(expiry): # evaluate the conditions against the fresh copy, no server request PATH BAA
+                            path = 'BAA'
+                            rsps = self.__respondToConditional(rqp, fetchedResponses)
+                        else: # PATH BAB
+                            path = 'BAB'
+                            try:
+                                rsps = self.__handleRequestSubroutine(rqp)
+                            except Exception as e:
+                                print('SocketHandler:: handleRequest: error encountered, ending connection')
+                                break
                     else: # PATH BB
                         if expiry is not None  and expiry != 'nil': # PATH BBA
-                            currentTime = TimeComparator.currentTime()
-                            expiryTime = TimeComparator(expiry)
-                            if expiryTime > currentTime: # packet cached has not expired yet PATH BBAA
-                                self.__respondToClient(fetchedResponses)
+                            if self.__isFresh(expiry): # packet cached has not expired yet PATH BBAA
+                                path = 'BBAA'
+                                self.__respondFromCache(rqp, fetchedResponses)
                                 rsps = fetchedResponses
-                            else: # packet cached expired, request new data from server PATH BBAB
-                                ct = CacheThread('DEL', rqp, None)
-                                ct.start()
-                                try:
-                                    rsps = self.__handleRequestSubroutine(rqp)
-                                except Exception as e:
-                                    print('SocketHandler:: handleRequest: error encountered, ending connection')
-                                    break
+                            else: # packet cached expired PATH BBAB
+                                staleWhileRevalidate = max(fetcher.fetchedEntry.get('staleWhileRevalidate', 0), SocketHandler.STALE_GRACE_PERIOD)
+                                staleIfError = max(fetcher.fetchedEntry.get('staleIfError', 0), SocketHandler.STALE_GRACE_PERIOD)
+                                if self.__isWithinStaleWindow(expiry, staleWhileRevalidate): # serve stale, refresh in background PATH BBABA
+                                    path = 'BBABA'
+                                    self.__respondFromCache(rqp, fetchedResponses)
+                                    rsps = fetchedResponses
+                                    RevalidationThread.revalidate(rqp, fetcher.getCacheKey())
+                                elif self.__isWithinStaleWindow(expiry, staleIfError): # revalidate, serve stale if server fails PATH BBABB
+                                    path = 'BBABB'
+                                    try:
+                                        rsps = self.__revalidate(rqp, fetcher, fetchedResponses, _staleResponses=fetchedResponses)
+                                    except Exception as e:
+                                        print('SocketHandler:: handleRequest: error encountered, ending connection')
+                                        break
+                                elif self.__hasValidators(fetcher.fetchedEntry, fetchedResponses): # revalidate, cached responses still usable on 304 PATH BBABC
+                                    path = 'BBABC'
+                                    try:
+                                        rsps = self.__revalidate(rqp, fetcher, fetchedResponses)
+                                    except Exception as e:
+                                        print('SocketHandler:: handleRequest: error encountered, ending connection')
+                                        break
+                                else: # request new data from server PATH BBABD
+                                    path = 'BBABD'
+                                    CacheWriter.submit('DEL', rqp, None)
+                                    try:
+                                        rsps = self.__handleRequestSubroutine(rqp)
+                                    except Exception as e:
+                                        print('SocketHandler:: handleRequest: error encountered, ending connection')
+                                        break
                         else: # must revalidate PATH BBB
-                            fetchTimeStr = fetchedResponses[0].getHeaderInfo('date')
-                            if fetchTimeStr != 'nil': # if previous fetch time is present, create if-modified-since line
-                                fetchTime = TimeComparator(fetchTimeStr)
-                                rqp.modifyTime(fetchTime.toString())
+                            path = 'BBB'
                             try:
-                                rsps = self.__handleRequestSubroutine(rqp, _304responses=fetchedResponses)
+                                rsps = self.__revalidate(rqp, fetcher, fetchedResponses)
                             except Exception as e:
                                 print('SocketHandler:: handleRequest: error encountered, ending connection')
                                 break
 
             else: # not GET nor CONNECT, request from server and reply to client, no caching required PATH C
+                path = 'C'
                 try:
                     rsps = self.requestToServer(rqp)
                 except ValueError as e:
@@ -188,8 +302,10 @@ class SocketHandler:
                     if self.serverSideSocket is not None:
                         self.serverSideSocket.close()
                     self.closeConnection()
-                self.__respondToClient(rsps)
+                if not self.isStreamed:
+                    self.__respondToClient(rsps)
 
+            self.__recordRequest(path, startTime)
             time = rsps[0].getKeepLive('timeout')
             if time == 'nil': # default timeout 20s
                 time = '20'
@@ -219,62 +335,250 @@ class SocketHandler:
             self.serverSideSocket.close()
 
 
-    def __handleRequestSubroutine(self, rqp, _304responses=''):
+    def __recordRequest(self, path, startTime):
+        '''
+        count request answered by handleRequest path (eg 'BBAA') in metrics, with its latency
+        '''
+        labels = {'path' : path}
+        Metrics.increment('proxy_requests_total', labels)
+        if path in SocketHandler.CACHE_RESULTS:
+            Metrics.increment('proxy_cache_requests_total', {'result' : SocketHandler.CACHE_RESULTS[path]})
+        Metrics.observe('proxy_request_duration_seconds', monotonic() - startTime, labels)
+
+    def __fillForRange(self, rqp, rsp, cacheKey):
+        '''
+        rsp is a 206 answering Range of rqp on a cache miss, partial responses are never cached
+        request the whole response in background (see RevalidationThread), so later ranges are answered from cache (see RangeHandler)
+        only if rsp may be cached and its complete length (Content-Range) is at most MAX_CACHEABLE_SIZE
+        '''
+        if not CacheHandler.isIndexLoaded() or rqp.getHeaderInfo('authorization') != 'nil':
+            return
+        for option in rsp.getHeaderInfo('cache-control').lower().split(','):
+            if option.strip() == 'no-store' or option.strip() == 'private':
+                return
+        completeLength = rsp.getHeaderInfo('content-range').split('/')[-1].strip()
+        if not completeLength.isdigit() or int(completeLength) > CacheHandler.MAX_CACHEABLE_SIZE: # '*': length unknown
+            return
+        print('SocketHandler:: __fillForRange: caching whole response of ' + cacheKey + ' in background')
+        RevalidationThread.revalidate(rqp, cacheKey)
+
+    def __revalidate(self, rqp, fetcher, fetchedResponses, _staleResponses=''):
+        '''
+        make conditional request for fetchedResponses with validators stored in the entry (see setValidators)
+        on 304 the cached responses are refreshed and sent, see __handleRequestSubroutine
+        '''
+        SocketHandler.setValidators(rqp, fetcher.fetchedEntry, fetchedResponses[0])
+        return self.__handleRequestSubroutine(rqp, _304responses=fetchedResponses, _staleResponses=_staleResponses, fetcher=fetcher)
+
+    @staticmethod
+    def setValidators(rqp, entry, rsp):
+        '''
+        make rqp conditional with validators stored in entry, those of cached response rsp if not stored
+        If-None-Match: etag, If-Modified-Since: last-modified (date of cached response if not present)
+        '''
+        etag = entry.get('etag', rsp.getHeaderInfo('etag'))
+        if etag != 'nil':
+            rqp.setHeader('If-None-Match', etag)
+
+        lastModified = entry.get('lastModified', rsp.getHeaderInfo('last-modified'))
+        if lastModified == 'nil': # if previous fetch time is present, create if-modified-since line
+            lastModified = rsp.getHeaderInfo('date')
+        if lastModified != 'nil':
+            rqp.modifyTime(lastModified)
+
+    def __hasValidators(self, entry, fetchedResponses):
+        '''
+        returns true if cached responses can be revalidated by etag or last-modified
+        '''
+        etag = entry.get('etag', fetchedResponses[0].getHeaderInfo('etag'))
+        lastModified = entry.get('lastModified', fetchedResponses[0].getHeaderInfo('last-modified'))
+        return etag != 'nil' or lastModified != 'nil'
+
+    def __handleRequestSubroutine(self, rqp, _304responses='', _staleResponses='', fetcher=None):
         '''
         make request to server,
         switch responseCode:
             200: cache and return
-            304: return
-            404: delete cache and return
+            304: return _304responses if given, refreshed by fetcher if given
+            404/ 410: delete cache, remember in negative cache and return
+            5xx: return _staleResponses if given (stale-if-error)
             else: return
+        if server cannot be reached, return _staleResponses if given
         '''
         try:
-            rsps = self.requestToServer(rqp)
+            rsps = self.requestToServer(rqp, spill=True)
         except Exception as e:
+            if _staleResponses != '':
+                print('SocketHandler:: __handleRequestSubroutine: server error, serving stale responses')
+                self.__respondFromCache(rqp, _staleResponses)
+                return _staleResponses
             raise e
 
+        if rsps == [] and _staleResponses != '':
+            print('SocketHandler:: __handleRequestSubroutine: cannot receive response, serving stale responses')
+            self.__respondFromCache(rqp, _staleResponses)
+            return _staleResponses
         if rsps == []:
             print('SocketHandler:: __handleRequestSubroutine: cannot receive response, forged a packet')
-            rsps.append(ResponsePacket.emptyPacket())
-        if rsps[0].responseCode() == '200': # PATH SUBROUTINE A
-            ct = CacheThread('ADD', rqp, rsps)
-            ct.start()
-            self.__respondToClient(rsps)
+            rsps.append(ResponsePacket.emptyPacket(rqp))
+        if self.isStreamed: # too large for memory, sent to client already PATH SUBROUTINE F
+            if SpilledBody.isSpilled(rsps):
+                CacheWriter.submit('ADD', rqp, rsps)
+            elif rsps[0].responseCode() in ['200', '404', '410']: # cached copy is outdated
+                CacheWriter.submit('DEL', rqp, None)
+
+        elif rsps[0].responseCode() == '200': # PATH SUBROUTINE A
+            CacheWriter.submit('ADD', rqp, rsps)
+            Prefetcher.submitPage(rqp, rsps)
+            self.__respondToClient(rsps, rqp)
 
         elif rsps[0].responseCode() == '304': # PATH SUBROUTINE B
             if _304responses != '':
-                rsps = _304responses
-            self.__respondToClient(rsps)
+                if fetcher is not None: # update cached header and expiry with the 304
+                    rsps = fetcher.refreshResponses(_304responses, rsps[0])
+                else:
+                    rsps = _304responses
+                self.__respondFromCache(rqp, rsps)
+            else:
+                self.__respondToClient(rsps)
 
-        elif rsps[0].responseCode() == '404': # PATH SUBROUTINE C
-            ct = CacheThread('DEL', rqp, rsps)
-            ct.start()
+        elif rsps[0].responseCode() == '404' or rsps[0].responseCode() == '410': # PATH SUBROUTINE C
+            CacheWriter.submit('DEL', rqp, rsps)
+            NegativeCache.putResponses(rqp, rsps)
             self.__respondToClient(rsps)
 
+        elif rsps[0].responseCode()[0] == '5' and _staleResponses != '': # PATH SUBROUTINE E
+            print('SocketHandler:: __handleRequestSubroutine: server error ' + rsps[0].responseCode() + ', serving stale responses')
+            rsps = _staleResponses
+            self.__respondFromCache(rqp, rsps)
+
         else: # PATH SUBROUTINE D
             self.__respondToClient(rsps)
         return rsps
 
+    def __respondToConditional(self, rqp, fetchedResponses):
+        '''
+        answer conditional request from fresh cached responses
+        send 304 if not modified (see __isNotModified), otherwise the cached responses
+        returns responses sent
+        '''
+        if self.__isNotModified(rqp, fetchedResponses[0]):
+            print('SocketHandler:: __respondToConditional: not modified, 304 sent from cache')
+            rsps = [ResponsePacket.notModifiedPacket(fetchedResponses[0])]
+            self.__respondToClient(rsps, source='cache')
+        else:
+            rsps = fetchedResponses
+            self.__respondFromCache(rqp, rsps)
+        return rsps
+
+    def __isNotModified(self, rqp, rsp):
+        '''
+        returns true if conditions of rqp say the client holds cached response rsp already
+        If-None-Match: any entity tag matches etag of rsp (weak comparison), If-Modified-Since is ignored then
+        If-Modified-Since: last-modified of rsp is not after it
+        '''
+        ifNoneMatch = rqp.getHeaderInfo('if-none-match')
+        if ifNoneMatch != 'nil':
+            if ifNoneMatch == '*':
+                return True
+            etag = rsp.getHeaderInfo('etag')
+            if etag == 'nil':
+                return False
+            if etag[0:2] == 'W/':
+                etag = etag[2:]
+            for entityTag in ifNoneMatch.split(','):
+                entityTag = entityTag.strip()
+                if entityTag[0:2] == 'W/':
+                    entityTag = entityTag[2:]
+                if entityTag == etag:
+                    return True
+            return False
+
+        lastModified = rsp.getHeaderInfo('last-modified')
+        if lastModified == 'nil':
+            return False
+        try:
+            return not TimeComparator(lastModified) > TimeComparator(rqp.getHeaderInfo('if-modified-since'))
+        except Exception as e: # malformed date
+            return False
+
+    def __isFresh(self, expiry):
+        '''
+        returns true if expiry of cached responses is not reached yet
+        '''
+        if expiry is None or expiry == 'nil':
+            return False
+        return TimeComparator(expiry) > TimeComparator.currentTime()
+
+    def __isWithinStaleWindow(self, expiry, window):
+        '''
+        returns true if current time is before expiry + window seconds
+        '''
+        if expiry is None or expiry == 'nil' or window <= 0:
+            return False
+        return (TimeComparator(expiry) + window) > TimeComparator.currentTime()
+
 
-    def requestToServer(self, rqp):
+    def __requestFromPeer(self, rqp):
         '''
-        connect to server,
+        returns responses of a peer proxy having url of rqp cached (see CachePeers)
+        returns None if no peer has it, or the peer cannot answer from its cache
+        '''
+        peer = CachePeers.selectPeer(rqp)
+        if peer is None:
+            return None
+        peerHandler = SocketHandler(None) # connection of its own, the server connection of this handler is kept
+        try:
+            rsps = peerHandler.requestToServer(CachePeers.createPeerRequest(rqp), peer=peer)
+        except Exception as e:
+            print('SocketHandler:: __requestFromPeer: peer ' + peer[0] + ':' + str(peer[1]) + ' failed: ' + str(e))
+            rsps = []
+        finally:
+            peerHandler.closeConnection()
+            if peerHandler.serverSideSocket is not None:
+                peerHandler.serverSideSocket.close()
+        if rsps == [] or rsps[0].responseCode() not in ['200', '206', '304']: # 504: not cached by peer after all
+            print('SocketHandler:: __requestFromPeer: ' + rqp.getHostName() + rqp.getFilePath() + ' not cached by peer ' + peer[0] + ':' + str(peer[1]))
+            return None
+        print('SocketHandler:: __requestFromPeer: ' + rqp.getHostName() + rqp.getFilePath() + ' from peer ' + peer[0] + ':' + str(peer[1]))
+        return rsps
+
+    def requestToServer(self, rqp, peer=None, spill=False):
+        '''
+        connect to server, or to peer (host, port) if given (see CachePeers),
         receive response from server,
         append as list
         return (response packets list, server side socket)
+        failures of name resolution and connection are remembered for a while (see NegativeCache)
+
+        at most MAX_BUFFER_SIZE bytes of the response are held in memory, the rest is streamed (see __startStreaming):
+            sent to the client right away, isStreamed is set and only the first response packet is returned,
+            with the body spilled to disk as last fragment (SpilledBody) if spill is true and the response may be cached
+            without client socket (background requests), the response is dropped ([]) unless it is spilled
         '''
         rsps = [] # responses to be returned
+        self.isStreamed = False
+
+        tempHost = rqp.getHostName().split(':')
+        if peer is not None:
+            tempHost = [peer[0], str(peer[1])]
+        if len(tempHost) == 2:
+            serverPort = int(tempHost[1])
+        else:
+            serverPort = SocketHandler.HTTP_PORT
+        if NegativeCache.isDNSFailure(tempHost[0]):
+            print('SocketHandler:: requestToServer: host not found recently: ' + tempHost[0])
+            return []
+        if NegativeCache.isConnectFailure(tempHost[0], serverPort):
+            print('SocketHandler:: requestToServer: connection refused recently: ' + rqp.getHostName())
+            return []
 
         try:
-            tempHost = rqp.getHostName().split(':')
             tempServerAddr = gethostbyname(tempHost[0])
         except Exception as e:
             print('SocketHandler:: requestToServer: failed to obtain ip for host server: ' + tempHost[0])
+            NegativeCache.putDNSFailure(tempHost[0], e)
             return []
-        if len(tempHost) == 2:
-            serverPort = int(tempHost[1])
-        else:
-            serverPort = SocketHandler.HTTP_PORT
 
         if self.serverAddr is not None and self.serverAddr != tempServerAddr: # incoming request server address doesn't match previous request
             self.serverSideSocket.close()
@@ -284,12 +588,20 @@ class SocketHandler:
 
         if self.serverSideSocket is None:
             self.serverSideSocket = socket(AF_INET, SOCK_STREAM)
+            if peer is not None: # peer answers from its cache, or not at all
+                self.serverSideSocket.settimeout(CachePeers.TIMEOUT)
             try:
                 self.serverSideSocket.connect((tempServerAddr, serverPort))
                 self.serverAddr = tempServerAddr
             except TimeoutError as e:
                 print('SocketHandler:: requestToServer: server side socket timeout')
                 return []
+            except ConnectionRefusedError as e:
+                print('SocketHandler:: establish HTTP connection to server refused')
+                NegativeCache.putConnectFailure(tempHost[0], serverPort)
+                self.serverSideSocket.close()
+                self.serverSideSocket = None
+                return []
             except Exception as e:
                 print('SocketHandler:: establish HTTP connection to server failed')
                 raise e
@@ -312,46 +624,143 @@ class SocketHandler:
         else:
             expectedLength = int(expectedLength)
 
+        bufferedSize = len(responseRaw)
+        isStreaming = False # response too large for memory, fragments go to client/ spill file instead of rsps
+        spilledBody = None
         if (rsp.isChunked() or expectedLength != receivedLength) or rsp.responseCode() == '206':
             sleepCount = 0
             while responseRaw[-len(b'0\r\n\r\n'):] != b'0\r\n\r\n':
                 try:
                     responseRaw = self.serverSideSocket.recv(SocketHandler.BUFFER_SIZE, MSG_DONTWAIT)
                 except Exception as e: # EAGAIN, no data received
-                    sleep(1)
+                    self.__waitForServer()
                     sleepCount += 1
                     if sleepCount == 3:
                         break
                     continue
                 if responseRaw  == b'': # same as not receiving anything, sleep and continue
-                    sleep(1)
+                    self.__waitForServer()
                     sleepCount += 1
                     if sleepCount == 3:
                         break
                     continue
                 else:
                     sleepCount = 0 # reset sleepCount if new data is received
-                    try:
-                        rsp = ResponsePacket.parsePacket(responseRaw)
-                        rsps.append(rsp)
-                    except TypeError as e:
-                        rsps.append(responseRaw)
+                    if receivedLength != 'nil':
+                        receivedLength += len(responseRaw)
+                    if isStreaming: # PATH STREAM
+                        if self.__socket is not None and not self.__streamToClient(responseRaw) and spilledBody is None: # client gone
+                            self.serverSideSocket.close() # rest of the response is never read, connection cannot be reused
+                            self.serverSideSocket = None
+                            self.serverAddr = None
+                            break
+                        if spilledBody is not None:
+                            spilledBody.write(responseRaw)
+                            if len(spilledBody) > CacheHandler.MAX_CACHEABLE_SIZE:
+                                print('SocketHandler:: requestToServer: response exceeds ' + str(CacheHandler.MAX_CACHEABLE_SIZE) + ' bytes, not cached')
+                                spilledBody.discard()
+                                spilledBody = None
+                                if self.__socket is None:
+                                    return []
+                    else:
+                        try:
+                            rsp = ResponsePacket.parsePacket(responseRaw)
+                            rsps.append(rsp)
+                        except TypeError as e:
+                            rsps.append(responseRaw)
+                        bufferedSize += len(responseRaw)
+                        if bufferedSize > SocketHandler.MAX_BUFFER_SIZE:
+                            spilledBody = self.__startStreaming(rqp, rsps, spill)
+                            if self.__socket is None and spilledBody is None: # nowhere to put the rest
+                                print('SocketHandler:: requestToServer: response exceeds ' + str(SocketHandler.MAX_BUFFER_SIZE) + ' bytes, dropped')
+                                return []
+                            rsps = rsps[:1]
+                            isStreaming = True
+                    if receivedLength != 'nil' and receivedLength >= expectedLength: # whole body received
+                        break
+
+        if spilledBody is not None:
+            spilledBody.close()
+            if receivedLength != 'nil':
+                isComplete = receivedLength == expectedLength
+            else:
+                isComplete = not rsps[0].isChunked() or responseRaw[-len(b'0\r\n\r\n'):] == b'0\r\n\r\n'
+            if isComplete:
+                rsps.append(spilledBody)
+            else: # incomplete body must not be cached
+                print('SocketHandler:: requestToServer: response incomplete, spilled body discarded')
+                spilledBody.discard()
         return rsps
 
-    def __respondToClient(self, rsps):
+    def __startStreaming(self, rqp, rsps, spill):
+        '''
+        rsps became too large to be held in memory (MAX_BUFFER_SIZE):
+        send the buffered fragments to the client, the rest follows as it is received (see requestToServer),
+        copy the body to a spill file if spill is true and the response may be cached (see CacheHandler.canSpill)
+        returns SpilledBody, None if not spilled
+        '''
+        spilledBody = None
+        if spill and CacheHandler.canSpill(rqp, rsps[0]):
+            spilledBody = SpilledBody()
+            for rsp in rsps[1:]:
+                try:
+                    spilledBody.write(rsp.getPacketRaw())
+                except AttributeError as e:
+                    spilledBody.write(rsp)
+            print('SocketHandler:: __startStreaming: spilling body to ' + spilledBody.path)
+        if self.__socket is not None:
+            print('SocketHandler:: __startStreaming: streaming response to client')
+            self.__respondToClient(rsps)
+            self.isStreamed = True
+        return spilledBody
+
+    def __streamToClient(self, responseRaw):
+        '''
+        send fragment of a streamed response to client
+        returns false if the client is gone
+        '''
+        try:
+            self.__socket.sendall(responseRaw)
+            Metrics.increment('proxy_response_bytes_total', {'source' : 'origin'}, len(responseRaw))
+            return True
+        except OSError as e:
+            print('SocketHandler:: __streamToClient: client connection lost')
+            return False
+
+    def __waitForServer(self):
+        '''
+        wait up to one second for data from server, returns early when data arrives
+        '''
+        try:
+            select.select([self.serverSideSocket], [], [], 1)
+        except (OSError, ValueError) as e: # socket closed
+            sleep(1)
+
+    def __respondToClient(self, rsps, rqp=None, source='origin'):
         '''
         send response to client
+        raw payloads can be bytes or memoryview (large cached files, see CacheHandler.getMappedFile)
+        if rqp is given, the response may be compressed for the client (see ResponseCompressor)
+        bytes sent are counted in metrics by source: 'origin' (server or peer), 'cache' or 'proxy' (answered by the proxy itself)
         '''
+        if rqp is not None:
+            compressedResponses = ResponseCompressor.respond(rqp, rsps)
+            if compressedResponses is not None:
+                rsps = compressedResponses
+        numBytes = 0
         for rsp in rsps:
             try:
-                self.__socket.send(rsp.getPacketRaw())
+                responseRaw = rsp.getPacketRaw()
+                self.__socket.sendall(responseRaw) # send() may send only part of a large packet
+                numBytes += len(responseRaw)
             except BrokenPipeError as e:
                 # print('exception: SocketHandler:: __respondToClient: BrokenPipeError')
                 if self.serverSideSocket is not None:
                     self.serverSideSocket.close()
             except AttributeError as e:
                 try:
-                    self.__socket.send(rsp)
+                    self.__socket.sendall(rsp) # raw payload can be larger than socket buffer
+                    numBytes += len(rsp)
                 except BrokenPipeError as e:
                     # print('exception: SocketHandler:: __respondToClient: AttributeError: BrokenPipeError')
                     if self.serverSideSocket is not None:
@@ -365,6 +774,18 @@ class SocketHandler:
             except Exception as e:
                 # print('exception: SocketHandler:: __respondToClient: Exception')
                 raise e
+        Metrics.increment('proxy_response_bytes_total', {'source' : source}, numBytes)
+
+    def __respondFromCache(self, rqp, rsps):
+        '''
+        send cached responses to client,
+        if rqp has Range, send only the requested ranges (see RangeHandler)
+        '''
+        rangeResponses = RangeHandler.respond(rqp, rsps)
+        if rangeResponses is not None:
+            print('SocketHandler:: __respondFromCache: answered range from cache: ' + rqp.getHeaderInfo('range'))
+            rsps = rangeResponses
+        self.__respondToClient(rsps, rqp, source='cache')
 
     def establishHTTPSConnection(self, rqp):
         '''
@@ -439,9 +860,11 @@ class SocketHandler:
             except Exception as e: #EAGAIN
                 raise e
 
-    def onBlackList(self, rqp):
+    @staticmethod
+    def onBlackList(rqp):
         '''
         returns true if the request website is on access control (blocked by me)
+        static, background requests (see Prefetcher, RevalidationThread, ExpirySweeper) are checked too
         '''
         if SocketHandler.BANNED_SITES is None: # create banned sites if no file found
             try:
@@ -543,3 +966,124 @@ class TimerThread(threading.Thread):
 
         else: # manual stop running
             print('Timer cancelled')
+
+
+
+
+
+#  ██  ██      ██████  ███████ ██    ██  █████  ██      ██ ██████   █████  ████████ ██  ██████  ███    ██     ████████ ██   ██ ██████  ███████  █████  ██████
+# ████████     ██   ██ ██      ██    ██ ██   ██ ██      ██ ██   ██ ██   ██    ██    ██ ██    ██ ████   ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██████  █████   ██    ██ ███████ ██      ██ ██   ██ ███████    ██    ██ ██    ██ ██ ██  ██        ██    ███████ ██████  █████   ███████ ██   ██
+# ████████     ██   ██ ██       ██  ██  ██   ██ ██      ██ ██   ██ ██   ██    ██    ██ ██    ██ ██  ██ ██        ██    ██   ██ ██   ██ ██      ██   ██ ██   ██
+#  ██  ██      ██   ██ ███████   ████   ██   ██ ███████ ██ ██████  ██   ██    ██    ██  ██████  ██   ████        ██    ██   ██ ██   ██ ███████ ██   ██ ██████
+
+
+
+
+import threading
+from RequestPacket import RequestPacket
+
+class RevalidationThread(threading.Thread):
+    '''
+    refresh an expired cache entry in background, while the stale copy is served (stale-while-revalidate),
+    or cache the whole response of a url whose Range was answered by the server (see SocketHandler __fillForRange)
+    at most one thread per cache key
+
+    the server is sent a GET of its own (see createRequest), conditional if the entry has validators,
+    so a Range or a condition of the client's request never ends up in the cache
+    '''
+
+    revalidating = set() # cache keys being refreshed
+    revalidatingLock = threading.Semaphore()
+
+    @staticmethod
+    def revalidate(rqp, cacheKey):
+        '''
+        start refreshing cacheKey, unless it is already being refreshed
+        '''
+        RevalidationThread.revalidatingLock.acquire()
+        if cacheKey in RevalidationThread.revalidating:
+            RevalidationThread.revalidatingLock.release()
+            return
+        RevalidationThread.revalidating.add(cacheKey)
+        RevalidationThread.revalidatingLock.release()
+
+        revalidationThread = RevalidationThread(rqp, cacheKey)
+        revalidationThread.start()
+
+    @staticmethod
+    def createRequest(rqp):
+        '''
+        returns GET request for the url of rqp, with Host, Accept-Encoding and the request headers selecting the cached variant (Vary)
+        Range, conditions, credentials and every other header of rqp are left out
+        returns None if rqp cannot be copied (eg not ascii)
+        '''
+        urlEntry = CacheHandler.getIndex().readEntry(CacheHandler(rqp).getUrlKey())
+        keptFields = ['host', 'accept-encoding']
+        if urlEntry is not None:
+            keptFields += urlEntry.get('vary', [])
+        requestRaw = 'GET http://' + rqp.getHostName() + rqp.getFilePath() + ' HTTP/1.1\r\n'
+        for fieldName in keptFields:
+            value = rqp.getHeaderInfo(fieldName)
+            if value != 'nil':
+                requestRaw += fieldName.title() + ': ' + value + '\r\n'
+        requestRaw += 'Connection: close\r\n\r\n'
+        try:
+            return RequestPacket.parsePacket(requestRaw.encode('ascii'))
+        except UnicodeError as e:
+            return None
+
+    def __init__(self, rqp, cacheKey):
+        '''
+        revalidating:               @static
+                                    cache keys being refreshed
+
+        revalidatingLock:           @static
+
+        __rqp:                      request packet of the client which got the stale copy
+
+        __cacheKey:
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__rqp = rqp
+        self.__cacheKey = cacheKey
+
+    def run(self):
+        '''
+        request server with a socket handler of its own (no client socket),
+        200: cache (see CacheWriter), 304: refresh cached header and expiry, 404/ 410: delete cache, else: keep the stale copy
+        '''
+        socketHandler = SocketHandler(None)
+        rsps = None
+        try:
+            rqp = RevalidationThread.createRequest(self.__rqp)
+            if rqp is None or SocketHandler.onBlackList(rqp): # banned after caching
+                return
+            fetcher = CacheHandler(rqp)
+            cachedResponses, expiry = fetcher.fetchResponses(countHit=False)
+            if cachedResponses is not None:
+                SocketHandler.setValidators(rqp, fetcher.fetchedEntry, cachedResponses[0])
+            rsps = socketHandler.requestToServer(rqp, spill=True)
+            if rsps == []:
+                return
+            if rsps[0].responseCode() == '200':
+                CacheWriter.submit('ADD', rqp, rsps)
+                rsps = None # spilled body is owned by the cache writer now
+                print('RevalidationThread:: refreshed ' + self.__cacheKey)
+            elif rsps[0].responseCode() == '304' and cachedResponses is not None:
+                fetcher.refreshResponses(cachedResponses, rsps[0])
+                print('RevalidationThread:: not modified ' + self.__cacheKey)
+            elif rsps[0].responseCode() == '404' or rsps[0].responseCode() == '410':
+                CacheWriter.submit('DEL', rqp, None)
+                NegativeCache.putResponses(rqp, rsps)
+        except Exception as e:
+            print('RevalidationThread:: failed to refresh ' + self.__cacheKey + ': ' + str(e))
+        finally:
+            SpilledBody.discardAll(rsps) # not moved into the cache
+            socketHandler.closeConnection()
+            if socketHandler.serverSideSocket is not None:
+                socketHandler.serverSideSocket.close()
+            RevalidationThread.revalidatingLock.acquire()
+            RevalidationThread.revalidating.discard(self.__cacheKey)
+            RevalidationThread.revalidatingLock.release()
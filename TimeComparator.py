@@ -1,3 +1,4 @@
+import calendar
 import datetime
 
 class TimeComparator:
@@ -31,6 +32,12 @@ class TimeComparator:
     def toString(self):
         return self.__time.strftime("%a, %d %b %Y %H:%M:%S GMT")
 
+    def toSeconds(self):
+        '''
+        returns seconds since epoch, time is treated as GMT
+        '''
+        return calendar.timegm(self.__time.timetuple())
+
     def __gt__(self, other):
         return self.__time > other.__time
 
@@ -3,16 +3,24 @@
 # this script deletes cache related files and directories
 
 echo "clearing cache"
-cache_table="cache_lookup_table.json"
+cache_table="cache_lookup_table.jsonl"
+cache_table_legacy="cache_lookup_table.json"
+cache_journal="cache_lookup_table.journal"
+cache_journal_compacting="cache_lookup_table.journal.compacting"
+cache_database="cache_lookup_table.sqlite3"
 cache_responses="cache_responses/"
+cache_spill="cache_spill/"
 
-if [ -a $cache_table ]
-then
-	rm $cache_table
-	echo "deleted $cache_table"
-else
-	echo "$cache_table does not exist"
-fi
+for f in $cache_table $cache_table_legacy $cache_journal $cache_journal_compacting $cache_database ${cache_database}-wal ${cache_database}-shm
+do
+	if [ -a $f ]
+	then
+		rm $f
+		echo "deleted $f"
+	else
+		echo "$f does not exist"
+	fi
+done
 
 if [ -d $cache_responses ]
 then
@@ -21,3 +29,9 @@ then
 else
 	echo "$cache_responses does not exist"
 fi
+
+if [ -d $cache_spill ]
+then
+	rm -rf $cache_spill
+	echo "deleted $cache_spill"
+fi
@@ -0,0 +1,332 @@
+from CacheHandler import CacheHandler
+from CacheIndex import CacheIndex
+from CacheShards import CacheShards
+from AdminHandler import AdminHandler
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+class CacheMaintainer:
+    '''
+    reconcile the cache index with the files in cache_responses/ and in the cache shards (see CacheShards)
+        remove orphan files (not referenced by the index) and temporary files of interrupted writes
+        drop encodings whose files are missing, delete entries left without files (dangling)
+        remove empty directories
+        report the space reclaimed
+
+    directories are scanned in parallel, one task per top-level (host) directory of each cache directory,
+    a file belongs to an entry only if it is in the shard recorded in the entry
+
+    offline (proxy not running): the index files are fixed and compacted directly
+    live (proxy running, admin=host:port): entries are listed and deleted through the admin interface (see AdminHandler),
+        the proxy keeps owning the index, files and directories modified within gracePeriod seconds are never touched,
+        they may belong to cache writes in progress
+    '''
+
+    NUM_WORKERS = 8
+    GRACE_PERIOD = 60 # seconds, default for live runs, offline runs use 0
+    PAGE_SIZE = 1000 # entries per admin request
+    MAX_PURGE_LENGTH = 4000 # characters of keys per admin purge request
+
+    def __init__(self, origin, admin=None, gracePeriod=None, numWorkers=None, isDryRun=False):
+        '''
+        origin:             directory holding the index files and cache_responses/
+
+        cacheRoots:         list of (shard, directory) scanned, shard None for cache_responses/
+
+        admin:              (host, port) of the admin interface of the running proxy, None if the proxy is not running
+
+        gracePeriod:        files and directories modified within this many seconds are kept
+
+        numWorkers:         number of directories scanned in parallel
+
+        isDryRun:           report only, change nothing
+
+        stats:              counters reported at the end
+
+        statsLock:          guards stats, updated by scanning threads
+        '''
+        self.origin = origin
+        self.cacheRoots = [(None, os.path.join(origin, CacheHandler.cacheFileDirectory))]
+        for shard in CacheShards.getDirectories():
+            self.cacheRoots.append((shard, shard))
+        self.admin = admin
+        if gracePeriod is None:
+            gracePeriod = 0 if admin is None else CacheMaintainer.GRACE_PERIOD
+        self.gracePeriod = gracePeriod
+        self.numWorkers = CacheMaintainer.NUM_WORKERS if numWorkers is None else numWorkers
+        self.isDryRun = isDryRun
+        self.startTime = time.time()
+        self.stats = {'files' : 0, 'orphanFiles' : 0, 'tempFiles' : 0, 'directories' : 0,
+            'entries' : 0, 'fixedEntries' : 0, 'deletedEntries' : 0, 'bytes' : 0}
+        self.statsLock = threading.Semaphore()
+
+    def run(self):
+        '''
+        returns stats
+        '''
+        entries = self.__loadEntries()
+        self.stats['entries'] = len(entries)
+        print('CacheMaintainer:: run: ' + str(len(entries)) + ' entries in index, ' + ('live' if self.admin is not None else 'offline')
+            + ', grace period ' + str(self.gracePeriod) + 's' + (', dry run' if self.isDryRun else ''))
+
+        found = {} # (cacheFileNameFH, encoding) -> set of file indices found
+        tasks = [] # (cacheRoot, directory)
+        for cacheRoot in self.cacheRoots:
+            if os.path.isdir(cacheRoot[1]):
+                for d in os.listdir(cacheRoot[1]):
+                    if os.path.isdir(os.path.join(cacheRoot[1], d)):
+                        tasks.append((cacheRoot, os.path.join(cacheRoot[1], d)))
+        with ThreadPoolExecutor(max_workers=self.numWorkers) as executor:
+            results = list(executor.map(lambda task: self.__scanTree(task[0], task[1], entries), tasks))
+        for cacheRoot in self.cacheRoots:
+            if os.path.isdir(cacheRoot[1]):
+                results.append(self.__scanFiles(cacheRoot, cacheRoot[1], entries)) # files of host root urls
+        for result in results:
+            found.update(result)
+
+        brokenEntries = self.__findBrokenEntries(entries, found)
+        if self.admin is None:
+            self.__fixOffline(brokenEntries, found)
+        else:
+            self.__fixLive(brokenEntries, entries)
+        return self.stats
+
+    def __loadEntries(self):
+        '''
+        returns cacheFileNameFH -> entry, entries without files left out
+        '''
+        entries = {}
+        if self.admin is None:
+            CacheHandler.origin = self.origin
+            for entry in CacheHandler.getIndex().getEntries():
+                if not CacheIndex.isEmptyEntry(entry):
+                    entries[entry['cacheFileNameFH']] = entry
+            return entries
+
+        after = None
+        while True:
+            target = '/entries?limit=' + str(CacheMaintainer.PAGE_SIZE)
+            if after is not None:
+                target += '&after=' + quote(after, safe='')
+            page = self.__requestAdmin('GET', target)
+            for entry in page['entries']:
+                entries[entry['cacheFileNameFH']] = entry
+            after = page['next']
+            if after is None:
+                return entries
+
+    def __scanTree(self, cacheRoot, directory, entries):
+        '''
+        scan directory (in cacheRoot) and its subdirectories, remove directories left empty
+        returns (cacheFileNameFH, encoding) -> set of file indices found
+        '''
+        isOld = self.startTime - os.stat(directory).st_mtime > self.gracePeriod # before removing anything from it
+        found = {}
+        for child in os.scandir(directory):
+            if child.is_dir(follow_symlinks=False):
+                found.update(self.__scanTree(cacheRoot, child.path, entries))
+        found.update(self.__scanFiles(cacheRoot, directory, entries))
+        if isOld:
+            self.__removeIfEmpty(directory)
+        return found
+
+    def __scanFiles(self, cacheRoot, directory, entries):
+        '''
+        check files directly in directory (in cacheRoot) against entries, remove orphan and temporary files
+        returns (cacheFileNameFH, encoding) -> set of file indices found
+        '''
+        found = {}
+        for child in os.scandir(directory):
+            if not child.is_file(follow_symlinks=False):
+                continue
+            self.__count('files', 1)
+            try:
+                stat = child.stat(follow_symlinks=False)
+            except FileNotFoundError as e: # removed meanwhile
+                continue
+            isOld = self.startTime - stat.st_mtime > self.gracePeriod
+
+            if child.name.endswith('.tmp'): # interrupted write, see CacheHandler.writeCacheFile
+                if isOld:
+                    self.__removeFile(child.path, stat.st_size, 'tempFiles')
+                continue
+
+            relativePath = os.path.relpath(child.path, cacheRoot[1]).replace(os.sep, '/')
+            nameSplitted = relativePath.rsplit(', ', 2) # '${FH}, ${encoding}, ${order}'
+            if len(nameSplitted) == 3 and nameSplitted[2].isdigit():
+                cacheFileNameFH, encoding, idx = nameSplitted[0], nameSplitted[1], int(nameSplitted[2])
+                entry = entries.get(cacheFileNameFH)
+                if entry is not None and entry.get('shard') == cacheRoot[0] and encoding not in CacheIndex.METADATA_KEYS and 1 <= idx <= int(entry.get(encoding, 0)):
+                    found.setdefault((cacheFileNameFH, encoding), set()).add(idx)
+                    continue
+            if isOld:
+                self.__removeFile(child.path, stat.st_size, 'orphanFiles')
+        return found
+
+    def __removeIfEmpty(self, directory):
+        try:
+            if os.listdir(directory) != []:
+                return
+            if not self.isDryRun:
+                os.rmdir(directory)
+            self.__count('directories', 1)
+        except OSError as e: # not empty anymore, or removed meanwhile
+            pass
+
+    def __removeFile(self, path, size, kind):
+        try:
+            if not self.isDryRun:
+                os.remove(path)
+            self.__count(kind, 1)
+            self.__count('bytes', size)
+        except FileNotFoundError as e:
+            pass
+
+    def __findBrokenEntries(self, entries, found):
+        '''
+        returns cacheFileNameFH -> list of encodings with missing files
+        entries of urls with Vary without any variant left are broken too (empty list)
+        '''
+        brokenEntries = {}
+        for cacheFileNameFH, entry in entries.items():
+            for encoding in entry:
+                if encoding in CacheIndex.METADATA_KEYS or int(entry[encoding]) == 0:
+                    continue
+                if found.get((cacheFileNameFH, encoding), set()) != set(range(1, int(entry[encoding]) + 1)):
+                    brokenEntries.setdefault(cacheFileNameFH, []).append(encoding)
+
+        variantUrls = set() # urls with a variant left after the fixes
+        for cacheFileNameFH, entry in entries.items():
+            if '#' in cacheFileNameFH and CacheIndex.countFiles(entry) > CacheMaintainer.__countBrokenFiles(entry, brokenEntries.get(cacheFileNameFH, [])):
+                variantUrls.add(cacheFileNameFH.split('#')[0])
+        for cacheFileNameFH, entry in entries.items():
+            if entry.get('vary', []) != [] and cacheFileNameFH not in variantUrls:
+                brokenEntries[cacheFileNameFH] = []
+        return brokenEntries
+
+    @staticmethod
+    def __countBrokenFiles(entry, encodings):
+        numFiles = 0
+        for encoding in encodings:
+            numFiles += int(entry[encoding])
+        return numFiles
+
+    def __fixOffline(self, brokenEntries, found):
+        '''
+        drop broken encodings from their entries, delete entries left without files, compact the index
+        '''
+        index = CacheHandler.getIndex()
+        for cacheFileNameFH, encodings in brokenEntries.items():
+            entry = dict(index.getEntry(cacheFileNameFH))
+            for encoding in encodings: # remaining files of the encoding are useless
+                for idx in found.get((cacheFileNameFH, encoding), set()):
+                    path = CacheHandler.getCacheFilePath(cacheFileNameFH, encoding, idx, entry.get('shard'))
+                    self.__removeFile(path, os.path.getsize(path), 'orphanFiles')
+                entry[encoding] = 0
+            if encodings == []: # url with Vary, no variant left
+                entry['vary'] = []
+            if CacheIndex.isEmptyEntry(entry):
+                self.stats['deletedEntries'] += 1
+                method = 'DEL'
+            else:
+                self.stats['fixedEntries'] += 1
+                method = 'ADD'
+            if not self.isDryRun:
+                CacheHandler.lookupTableLock.acquire()
+                index.putEntry(method, entry)
+                CacheHandler.lookupTableLock.release()
+        if not self.isDryRun:
+            CacheHandler.writeLookupTableToFile() # drops entries without files, writes snapshot
+            index.close()
+
+    def __fixLive(self, brokenEntries, entries):
+        '''
+        delete broken entries through the admin interface, the proxy fetches them again when requested
+        an entry changed since it was listed is left alone
+        '''
+        purgeKeys = []
+        for cacheFileNameFH in sorted(brokenEntries):
+            page = self.__requestAdmin('GET', '/entries?limit=1&prefix=' + quote(cacheFileNameFH, safe=''))
+            if page['entries'] == [] or page['entries'][0] != entries[cacheFileNameFH]:
+                continue # deleted or replaced meanwhile
+            purgeKeys.append(cacheFileNameFH)
+        if self.isDryRun:
+            self.stats['deletedEntries'] = len(purgeKeys)
+            return
+
+        batch = []
+        batchLength = 0
+        for cacheFileNameFH in purgeKeys + [None]:
+            if cacheFileNameFH is not None:
+                key = quote(cacheFileNameFH, safe='')
+                batch.append(key)
+                batchLength += len(key)
+            if batch != [] and (cacheFileNameFH is None or batchLength >= CacheMaintainer.MAX_PURGE_LENGTH):
+                result = self.__requestAdmin('POST', '/purge?key=' + '&key='.join(batch))
+                self.__count('deletedEntries', result['purged'])
+                self.__count('bytes', result['bytes'])
+                batch = []
+                batchLength = 0
+
+    def __requestAdmin(self, method, target):
+        '''
+        returns json response of admin request, works on proxy port and admin port alike
+        '''
+        connection = http.client.HTTPConnection(self.admin[0], self.admin[1], timeout=30)
+        try:
+            connection.request(method, 'http://' + AdminHandler.ADMIN_HOST + target, headers={'Host' : AdminHandler.ADMIN_HOST, 'Connection' : 'close', AdminHandler.CSRF_HEADER[0] : AdminHandler.CSRF_HEADER[1]})
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise Exception('CacheMaintainer:: __requestAdmin: ' + method + ' ' + target + ' failed: ' + str(response.status) + ' ' + body.decode('utf-8', 'replace'))
+        return json.loads(body)
+
+    def __count(self, name, value):
+        self.statsLock.acquire()
+        self.stats[name] += value
+        self.statsLock.release()
+
+
+def main():
+    '''
+    python maintain_cache.py [cache_index=json|sqlite] [cache_shards=dir[:weight[:maxSize]],...] [admin=host:port] [grace=seconds] [workers=numThread] [dry_run=true]
+    run in the project root, like proxy_main.py, with the cache_shards of the proxy
+    '''
+    admin = None
+    gracePeriod = None
+    numWorkers = None
+    isDryRun = False
+    for option in sys.argv[1:]:
+        optionName, val = option.split('=')
+        if optionName == 'cache_index':
+            CacheHandler.INDEX_BACKEND = val
+        elif optionName == 'cache_shards':
+            CacheShards.configure(CacheShards.parse(val))
+        elif optionName == 'admin':
+            host, port = val.rsplit(':', 1)
+            admin = (host, int(port))
+        elif optionName == 'grace':
+            gracePeriod = int(val)
+        elif optionName == 'workers':
+            numWorkers = int(val)
+        elif optionName == 'dry_run':
+            isDryRun = val.lower() == 'true'
+
+    maintainer = CacheMaintainer(os.getcwd(), admin=admin, gracePeriod=gracePeriod, numWorkers=numWorkers, isDryRun=isDryRun)
+    stats = maintainer.run()
+    print('Main:: ' + str(stats['files']) + ' files checked, ' + str(stats['orphanFiles']) + ' orphan files and ' + str(stats['tempFiles'])
+        + ' temporary files removed, ' + str(stats['directories']) + ' empty directories removed')
+    print('Main:: ' + str(stats['entries']) + ' entries checked, ' + str(stats['fixedEntries']) + ' fixed, ' + str(stats['deletedEntries']) + ' deleted')
+    print('Main:: ' + str(stats['bytes']) + ' bytes reclaimed' + (' (dry run, nothing changed)' if isDryRun else ''))
+
+
+if __name__ == '__main__':
+    main()
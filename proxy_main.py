@@ -1,5 +1,14 @@
 from Proxy import Proxy
-from CacheHandler import CacheHandler
+from CacheHandler import CacheHandler, CacheWriter
+from SocketHandler import SocketHandler
+from ResponseCompressor import ResponseCompressor
+from AdminHandler import AdminHandler
+from NegativeCache import NegativeCache
+from CacheShards import CacheShards
+from CacheKey import CacheKey
+from Prefetcher import Prefetcher
+from CachePeers import CachePeers
+from ExpirySweeper import ExpirySweeper
 import os
 import sys
 
@@ -12,10 +21,60 @@ def main():
             max_connection = int(val)
         elif optionName == 'port':
             port = int(val)
+        elif optionName == 'cache_index':
+            CacheHandler.INDEX_BACKEND = val
+        elif optionName == 'stale_grace':
+            SocketHandler.STALE_GRACE_PERIOD = int(val)
+        elif optionName == 'cache_writers':
+            CacheWriter.NUM_WRITERS = int(val)
+        elif optionName == 'cache_queue':
+            CacheWriter.MAX_QUEUE_SIZE = int(val)
+        elif optionName == 'cache_compression':
+            CacheHandler.AT_REST_ENCODING = None if val == 'off' else val
+        elif optionName == 'cache_compression_level':
+            CacheHandler.AT_REST_LEVEL = int(val)
+        elif optionName == 'cache_shards':
+            CacheShards.configure(CacheShards.parse(val))
+        elif optionName == 'max_cacheable_size':
+            CacheHandler.MAX_CACHEABLE_SIZE = CacheShards.parseSize(val)
+        elif optionName == 'max_buffer_size':
+            SocketHandler.MAX_BUFFER_SIZE = CacheShards.parseSize(val)
+        elif optionName == 'cache_key_normalize':
+            CacheKey.NORMALIZE = val == 'on'
+        elif optionName == 'cache_key_ignore':
+            CacheKey.IGNORED_PARAMETERS = CacheKey.parse(val)
+        elif optionName == 'compression':
+            ResponseCompressor.CODINGS = [] if val == 'off' else val.split(',')
+        elif optionName == 'compression_level':
+            ResponseCompressor.LEVEL = int(val)
+        elif optionName == 'prefetch':
+            Prefetcher.ENABLED = val == 'on'
+        elif optionName == 'prefetch_rate':
+            Prefetcher.RATE = float(val)
+        elif optionName == 'peers':
+            CachePeers.PEERS = CachePeers.parse(val)
+        elif optionName == 'digest_interval':
+            CachePeers.DIGEST_INTERVAL = int(val)
+        elif optionName == 'expiry_sweep':
+            ExpirySweeper.INTERVAL = int(val)
+        elif optionName == 'prerevalidate':
+            ExpirySweeper.PREREVALIDATE_HITS = int(val)
+        elif optionName == 'prerevalidate_lead':
+            ExpirySweeper.LEAD_TIME = int(val)
+        elif optionName == 'admin_port':
+            AdminHandler.ADMIN_PORT = int(val)
+        elif optionName == 'metrics_port':
+            AdminHandler.METRICS_PORT = int(val)
+        elif optionName == 'negative_ttl':
+            NegativeCache.NOT_FOUND_TTL = int(val)
+        elif optionName == 'dns_negative_ttl':
+            NegativeCache.DNS_FAILURE_TTL = int(val)
+        elif optionName == 'connect_negative_ttl':
+            NegativeCache.CONNECT_FAILURE_TTL = int(val)
 
+    CacheHandler.origin = os.getcwd()
     proxy = Proxy(max_connection=max_connection, port=port)
     print('Main:: proxy program starts')
-    CacheHandler.origin = os.getcwd()
     proxy.listenConnection()
     print('Main:: proxy program ends')
 
@@ -0,0 +1,50 @@
+import unittest
+from RequestPacket import RequestPacket
+from AdminHandler import AdminHandler
+
+def createHeaders(headerFields):
+    rqp = RequestPacket()
+    rqp.setHeaderSplitted(['Host: ' + AdminHandler.ADMIN_HOST] + headerFields)
+    return rqp
+
+class IsSameSiteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adminPort = AdminHandler.ADMIN_PORT
+        AdminHandler.ADMIN_PORT = 16301
+
+    def tearDown(self):
+        AdminHandler.ADMIN_PORT = self.adminPort
+
+    def testNoOriginOrReferer(self):
+        self.assertTrue(AdminHandler.isSameSite(createHeaders([])))
+
+    def testAdminHost(self):
+        self.assertTrue(AdminHandler.isSameSite(createHeaders(['Origin: http://proxy.admin'])))
+        self.assertTrue(AdminHandler.isSameSite(createHeaders(['Referer: http://proxy.admin/entries?limit=10'])))
+
+    def testAdminPort(self):
+        self.assertTrue(AdminHandler.isSameSite(createHeaders(['Origin: http://127.0.0.1:16301'])))
+        self.assertTrue(AdminHandler.isSameSite(createHeaders(['Origin: http://localhost:16301'])))
+
+    def testOtherSite(self):
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: http://www.example.com'])))
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Referer: http://www.example.com/page.html'])))
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: http://proxy.admin.example.com'])))
+
+    def testOtherLoopbackPort(self):
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: http://127.0.0.1:8080'])))
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: http://localhost'])))
+
+    def testOriginNull(self):
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: null'])))
+
+    def testEitherFieldFromOtherSite(self):
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: http://proxy.admin', 'Referer: http://www.example.com/'])))
+
+    def testWithoutAdminPortOnlyAdminHost(self):
+        AdminHandler.ADMIN_PORT = None
+        self.assertFalse(AdminHandler.isSameSite(createHeaders(['Origin: http://127.0.0.1:16301'])))
+
+if __name__ == '__main__':
+    unittest.main()
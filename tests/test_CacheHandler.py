@@ -0,0 +1,122 @@
+import unittest
+from RequestPacket import RequestPacket
+from ResponsePacket import ResponsePacket
+from CacheHandler import CacheHandler
+
+def createRequest(headerFields, url='http://www.example.com/page'):
+    requestRaw = 'GET ' + url + ' HTTP/1.1\r\nHost: www.example.com\r\n'
+    for headerField in headerFields:
+        requestRaw += headerField + '\r\n'
+    return RequestPacket.parsePacket((requestRaw + '\r\n').encode('ascii'))
+
+def createResponse(headerFields):
+    responseRaw = 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n'
+    for headerField in headerFields:
+        responseRaw += headerField + '\r\n'
+    return ResponsePacket.parsePacket((responseRaw + '\r\n').encode('ascii'))
+
+def createEntry(encodings):
+    entry = {'cacheFileNameFH' : 'www.example.com/page', 'expiry' : 'nil', 'gzip' : 0, 'compress' : 0, 'deflate' : 0}
+    for encoding in encodings:
+        entry[encoding] = 2
+    return entry
+
+def negotiate(acceptEncoding, encodings):
+    headerFields = [] if acceptEncoding is None else ['Accept-Encoding: ' + acceptEncoding]
+    return CacheHandler(createRequest(headerFields))._CacheHandler__negotiateEncoding(createEntry(encodings))
+
+def getResponseKey(requestHeaderFields, vary):
+    return CacheHandler(createRequest(requestHeaderFields), [createResponse(['Vary: ' + vary])]).getResponseKey()
+
+class NegotiateEncodingTest(unittest.TestCase):
+
+    def testNoAcceptEncodingPrefersIdentity(self):
+        self.assertEqual(negotiate(None, ['gzip', 'nil']), 'nil')
+
+    def testNoAcceptEncodingAcceptsAnyCoding(self):
+        self.assertEqual(negotiate(None, ['gzip']), 'gzip')
+
+    def testQZeroExcludesCoding(self):
+        self.assertEqual(negotiate('gzip;q=0', ['gzip', 'nil']), 'nil')
+        self.assertIsNone(negotiate('gzip;q=0', ['gzip']))
+
+    def testStarQZeroExcludesIdentity(self):
+        self.assertIsNone(negotiate('*;q=0', ['gzip', 'nil']))
+        self.assertIsNone(negotiate('br, *;q=0', ['gzip', 'nil']))
+
+    def testStarQZeroWithExplicitIdentity(self):
+        self.assertEqual(negotiate('identity, *;q=0', ['gzip', 'nil']), 'nil')
+        self.assertEqual(negotiate('gzip, *;q=0', ['gzip', 'nil']), 'gzip')
+
+    def testIdentityQZero(self):
+        self.assertIsNone(negotiate('identity;q=0', ['nil']))
+        self.assertEqual(negotiate('gzip, identity;q=0', ['gzip', 'nil']), 'gzip')
+
+    def testHighestQValueWins(self):
+        self.assertEqual(negotiate('gzip;q=0.5, br', ['gzip', 'br']), 'br')
+        self.assertEqual(negotiate('gzip;q=0.5, br;q=0.4', ['gzip', 'br']), 'gzip')
+
+    def testExplicitCodingBeforeStar(self):
+        self.assertEqual(negotiate('*, br', ['gzip', 'br']), 'br')
+
+    def testListedOrderBreaksTies(self):
+        self.assertEqual(negotiate('br, gzip', ['gzip', 'br']), 'br')
+        self.assertEqual(negotiate('gzip, br', ['gzip', 'br']), 'gzip')
+
+    def testEncodingWithoutFilesIsNotSelected(self):
+        entry = createEntry(['nil'])
+        entry['gzip'] = 0
+        self.assertEqual(CacheHandler(createRequest(['Accept-Encoding: gzip']))._CacheHandler__negotiateEncoding(entry), 'nil')
+
+    def testMetadataIsNotAnEncoding(self):
+        entry = createEntry(['nil'])
+        entry.update({'etag' : '"v1"', 'vary' : [], 'shard' : None, 'atRest' : None})
+        self.assertEqual(CacheHandler(createRequest(['Accept-Encoding: *']))._CacheHandler__negotiateEncoding(entry), 'nil')
+
+class VariantKeyTest(unittest.TestCase):
+
+    def testVaryHeaderValuesSelectDifferentVariants(self):
+        english = getResponseKey(['Accept-Language: en'], 'Accept-Language')
+        french = getResponseKey(['Accept-Language: fr'], 'Accept-Language')
+        self.assertTrue(english.startswith('www.example.com/page#'))
+        self.assertTrue(french.startswith('www.example.com/page#'))
+        self.assertNotEqual(english, french)
+
+    def testAbsentVaryHeaderIsAVariantOfItsOwn(self):
+        self.assertNotEqual(getResponseKey([], 'Accept-Language'), getResponseKey(['Accept-Language: en'], 'Accept-Language'))
+
+    def testOtherHeadersShareTheVariant(self):
+        first = getResponseKey(['Accept-Language: en', 'User-Agent: a', 'Cookie: id=1'], 'Accept-Language')
+        second = getResponseKey(['Accept-Language: en', 'User-Agent: b', 'Cookie: id=2'], 'Accept-Language')
+        self.assertEqual(first, second)
+
+    def testVaryOrderAndCaseDoNotMatter(self):
+        first = getResponseKey(['Accept-Language: en', 'X-Tenant: a'], 'Accept-Language, X-Tenant')
+        second = getResponseKey(['Accept-Language: en', 'X-Tenant: a'], 'x-tenant,accept-language')
+        self.assertEqual(first, second)
+
+    def testEveryVaryHeaderSelectsTheVariant(self):
+        first = getResponseKey(['Accept-Language: en', 'X-Tenant: a'], 'Accept-Language, X-Tenant')
+        second = getResponseKey(['Accept-Language: en', 'X-Tenant: b'], 'Accept-Language, X-Tenant')
+        self.assertNotEqual(first, second)
+
+    def testAcceptEncodingOnlyKeepsTheUrlKey(self):
+        self.assertEqual(getResponseKey(['Accept-Encoding: gzip'], 'Accept-Encoding'), 'www.example.com/page')
+
+    def testNoVaryKeepsTheUrlKey(self):
+        rsp = createResponse([])
+        self.assertEqual(CacheHandler(createRequest(['Accept-Language: en']), [rsp]).getResponseKey(), 'www.example.com/page')
+
+    def testVaryStarIsNotStored(self):
+        self.assertIsNone(getResponseKey(['Accept-Language: en'], '*'))
+        self.assertIsNone(getResponseKey(['Accept-Language: en'], 'Accept-Language, *'))
+
+    def testVariantKeysOfDifferentUrlsDiffer(self):
+        rsp = createResponse(['Vary: Accept-Language'])
+        first = CacheHandler(createRequest(['Accept-Language: en'], url='http://www.example.com/a'), [rsp]).getResponseKey()
+        second = CacheHandler(createRequest(['Accept-Language: en'], url='http://www.example.com/b'), [rsp]).getResponseKey()
+        self.assertTrue(first.startswith('www.example.com/a#'))
+        self.assertTrue(second.startswith('www.example.com/b#'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from CacheIndex import JSONCacheIndex, SQLiteCacheIndex
+from CacheJournal import CacheJournal
+
+def createEntry(cacheFileNameFH, numFiles=2):
+    return {'cacheFileNameFH' : cacheFileNameFH, 'expiry' : 'nil', 'gzip' : 0, 'nil' : numFiles}
+
+class SQLiteCacheIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = SQLiteCacheIndex(self.directory)
+        self.index.load()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def runInThread(self, function):
+        thread = threading.Thread(target=function)
+        thread.start()
+        thread.join()
+
+    def testEntriesAreSharedBetweenThreads(self):
+        self.runInThread(lambda: self.index.putEntry('ADD', createEntry('www.example.com/a')))
+        self.assertEqual(self.index.getEntry('www.example.com/a'), createEntry('www.example.com/a'))
+
+    def testConnectionsOfExitedThreadsAreClosed(self):
+        connections = {}
+        def openConnection():
+            connections[threading.current_thread()] = self.index._SQLiteCacheIndex__getConnection()
+        for i in range(3):
+            self.runInThread(openConnection)
+        self.runInThread(lambda: self.index.getEntry('www.example.com/a')) # next connection opened
+        for thread in connections:
+            self.assertNotIn(thread, self.index.connections)
+        for connection in connections.values():
+            self.assertRaises(sqlite3.ProgrammingError, connection.execute, 'SELECT 1')
+
+    def testCloseClosesConnectionsOfEveryThread(self):
+        opened = threading.Event()
+        closed = threading.Event()
+        results = []
+
+        def useIndex():
+            self.index.getEntry('www.example.com/a')
+            opened.set()
+            closed.wait()
+            connection = self.index.local.connection
+            try:
+                connection.execute('SELECT 1')
+                results.append('open')
+            except sqlite3.ProgrammingError as e:
+                results.append('closed')
+            self.index.putEntry('ADD', createEntry('www.example.com/b')) # a new connection is opened
+            results.append(self.index.local.connection is not connection)
+
+        thread = threading.Thread(target=useIndex)
+        thread.start()
+        opened.wait()
+        self.index.getEntry('www.example.com/a')
+        self.index.close()
+        self.assertEqual(self.index.connections, {})
+        closed.set()
+        thread.join()
+
+        self.assertEqual(results, ['closed', True])
+        self.assertEqual(self.index.getEntry('www.example.com/b'), createEntry('www.example.com/b'))
+
+class JSONCacheIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        CacheJournal.journalFile = None
+        CacheJournal.numRecords = 0
+        self.index = JSONCacheIndex(self.directory)
+        self.index.load()
+
+    def tearDown(self):
+        self.index.close()
+        CacheJournal.origin = ''
+        CacheJournal.numRecords = 0
+        shutil.rmtree(self.directory)
+
+    def testPurgeCopiesOnlyTablesWithEmptyEntries(self):
+        for i in range(2000):
+            self.index.putEntry('ADD', createEntry('www.example.com/' + str(i)))
+        self.index.putEntry('DEL', createEntry('www.example.com/7', numFiles=0))
+        self.index.putEntry('DEL', createEntry('www.example.com/8', numFiles=0))
+        self.index.publish()
+        tables = self.index.tables
+        emptyShards = set(self.index.emptyShards)
+        self.assertTrue(0 < len(emptyShards) <= 2)
+
+        self.index.purge()
+        for shard in range(JSONCacheIndex.NUM_SHARDS):
+            if shard in emptyShards:
+                self.assertIsNot(self.index.tables[shard], tables[shard])
+            else:
+                self.assertIs(self.index.tables[shard], tables[shard])
+        self.assertIsNone(self.index.getEntry('www.example.com/7'))
+        self.assertIsNone(self.index.getEntry('www.example.com/8'))
+        self.assertEqual(self.index.getEntry('www.example.com/9'), createEntry('www.example.com/9'))
+        self.assertEqual(self.index.numEntries, 1998)
+        self.assertEqual(self.index.emptyShards, set())
+
+        tables = self.index.tables
+        self.index.purge() # nothing left to purge
+        self.assertIs(self.index.tables, tables)
+
+    def testPurgeAfterLoad(self):
+        self.index.putEntry('ADD', createEntry('www.example.com/a'))
+        self.index.putEntry('ADD', createEntry('www.example.com/b', numFiles=0))
+        self.index.close()
+        self.index = JSONCacheIndex(self.directory)
+        self.index.load()
+        self.index.purge()
+        self.assertEqual([entry['cacheFileNameFH'] for entry in self.index.getEntries()], ['www.example.com/a'])
+        self.assertEqual(self.index.numEntries, 1)
+
+if __name__ == '__main__':
+    unittest.main()
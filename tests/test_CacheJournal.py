@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from CacheJournal import CacheJournal
+
+def createEntry(cacheFileNameFH, numFiles=2, expiry='nil'):
+    return {'cacheFileNameFH' : cacheFileNameFH, 'expiry' : expiry, 'gzip' : 0, 'nil' : numFiles}
+
+def record(method, entry):
+    return json.dumps({'method' : method, 'entry' : entry}) + '\n'
+
+class CacheJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        CacheJournal.origin = self.directory
+        CacheJournal.journalFile = None
+        CacheJournal.numRecords = 0
+
+    def tearDown(self):
+        CacheJournal.close()
+        CacheJournal.origin = ''
+        CacheJournal.numRecords = 0
+        shutil.rmtree(self.directory)
+
+    def path(self, fileName):
+        return os.path.join(self.directory, fileName)
+
+    def write(self, fileName, content):
+        with open(self.path(fileName), 'w') as file:
+            file.write(content)
+
+    def testNothingStored(self):
+        self.assertEqual(CacheJournal.load(), [])
+
+    def testReplayAfterCrash(self):
+        '''
+        crash during compaction: snapshot, journal being compacted and journal with a torn last line are left
+        '''
+        self.write(CacheJournal.SNAPSHOT_FILE, json.dumps(createEntry('a')) + '\n' + json.dumps(createEntry('b')) + '\n')
+        self.write(CacheJournal.COMPACTING_FILE, record('ADD', createEntry('c')) + record('DEL', createEntry('a', numFiles=0)))
+        self.write(CacheJournal.JOURNAL_FILE, record('ADD', createEntry('b', numFiles=3, expiry='Mon, 01 Jan 2024 00:00:00 GMT')) + record('ADD', createEntry('d'))[:20])
+
+        table = CacheJournal.load()
+        self.assertEqual(table, [
+            createEntry('a', numFiles=0),
+            createEntry('b', numFiles=3, expiry='Mon, 01 Jan 2024 00:00:00 GMT'),
+            createEntry('c'),
+        ])
+        self.assertEqual(CacheJournal.numRecords, 3) # torn record is not counted
+
+    def testCorruptedSnapshotLineIsSkipped(self):
+        self.write(CacheJournal.SNAPSHOT_FILE, json.dumps(createEntry('a')) + '\n{"cacheFile\n' + json.dumps(createEntry('b')) + '\n')
+        self.assertEqual([entry['cacheFileNameFH'] for entry in CacheJournal.load()], ['a', 'b'])
+
+    def testAppendedRecordsAreReplayed(self):
+        CacheJournal.append('ADD', createEntry('a'))
+        CacheJournal.append('ADD', createEntry('b'))
+        CacheJournal.append('DEL', createEntry('a', numFiles=0))
+        CacheJournal.close()
+        self.assertEqual(CacheJournal.load(), [createEntry('a', numFiles=0), createEntry('b')])
+
+    def testCompaction(self):
+        CacheJournal.append('ADD', createEntry('a'))
+        CacheJournal.append('ADD', createEntry('b'))
+        CacheJournal.rotate() # records written from now on go to a new journal
+        self.assertEqual(CacheJournal.numRecords, 0)
+        self.assertTrue(os.path.exists(self.path(CacheJournal.COMPACTING_FILE)))
+        CacheJournal.append('ADD', createEntry('c'))
+
+        CacheJournal.writeSnapshot([createEntry('a'), createEntry('b')])
+        CacheJournal.finishCompaction()
+        CacheJournal.close()
+        self.assertFalse(os.path.exists(self.path(CacheJournal.COMPACTING_FILE)))
+        self.assertFalse(os.path.exists(self.path(CacheJournal.SNAPSHOT_FILE + '.tmp')))
+        self.assertEqual(CacheJournal.load(), [createEntry('a'), createEntry('b'), createEntry('c')])
+        self.assertEqual(CacheJournal.numRecords, 1)
+
+    def testRotateKeepsRecordsOfFailedCompaction(self):
+        self.write(CacheJournal.COMPACTING_FILE, record('ADD', createEntry('a')))
+        CacheJournal.append('ADD', createEntry('b'))
+        CacheJournal.rotate()
+        self.assertFalse(os.path.exists(self.path(CacheJournal.JOURNAL_FILE)))
+        self.assertEqual(CacheJournal.load(), [createEntry('a'), createEntry('b')])
+
+    def testLegacySnapshotIsLoadedThenDeleted(self):
+        self.write(CacheJournal.LEGACY_SNAPSHOT_FILE, json.dumps([createEntry('a'), createEntry('b')], indent=4))
+        table = CacheJournal.load()
+        self.assertEqual(table, [createEntry('a'), createEntry('b')])
+
+        CacheJournal.writeSnapshot(table)
+        self.assertFalse(os.path.exists(self.path(CacheJournal.LEGACY_SNAPSHOT_FILE)))
+        with open(self.path(CacheJournal.SNAPSHOT_FILE), 'r') as snapshot:
+            self.assertEqual([json.loads(line) for line in snapshot], table)
+        self.assertEqual(CacheJournal.load(), table)
+
+    def testLegacySnapshotOfJsonLines(self):
+        self.write(CacheJournal.LEGACY_SNAPSHOT_FILE, json.dumps(createEntry('a')) + '\n')
+        self.assertEqual(CacheJournal.load(), [createEntry('a')])
+
+    def testSnapshotPreferredOverLegacySnapshot(self):
+        self.write(CacheJournal.LEGACY_SNAPSHOT_FILE, json.dumps([createEntry('old')]))
+        self.write(CacheJournal.SNAPSHOT_FILE, json.dumps(createEntry('new')) + '\n')
+        self.assertEqual(CacheJournal.load(), [createEntry('new')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from CacheKey import CacheKey
+
+class NormalizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.normalize = CacheKey.NORMALIZE
+        self.ignoredParameters = CacheKey.IGNORED_PARAMETERS
+
+    def tearDown(self):
+        CacheKey.NORMALIZE = self.normalize
+        CacheKey.IGNORED_PARAMETERS = self.ignoredParameters
+
+    def testHostIsLowerCased(self):
+        self.assertEqual(CacheKey.normalize('WWW.Example.COM', '/Path'), ('www.example.com', '/Path'))
+
+    def testDefaultPortIsRemoved(self):
+        self.assertEqual(CacheKey.normalize('www.example.com:80', '/'), ('www.example.com', '/'))
+        self.assertEqual(CacheKey.normalize('www.example.com:8080', '/'), ('www.example.com:8080', '/'))
+
+    def testPathIsKeptAsIs(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/A%2Fb/C.html'), ('www.example.com', '/A%2Fb/C.html'))
+
+    def testParametersAreSortedByName(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?b=2&a=1&c=3')[1], '/p?a=1&b=2&c=3')
+
+    def testRepeatedParametersKeepTheirOrder(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?b=2&a=1&b=1')[1], '/p?a=1&b=2&b=1')
+        self.assertNotEqual(CacheKey.normalize('www.example.com', '/p?b=2&b=1'), CacheKey.normalize('www.example.com', '/p?b=1&b=2'))
+
+    def testEmptyValuesAreKept(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?b=&a')[1], '/p?a&b=')
+        self.assertNotEqual(CacheKey.normalize('www.example.com', '/p?a='), CacheKey.normalize('www.example.com', '/p'))
+
+    def testEmptyParametersAreDropped(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?&b=1&&a=2&')[1], '/p?a=2&b=1')
+
+    def testBareQuestionMark(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?'), ('www.example.com', '/p'))
+        self.assertEqual(CacheKey.buildCacheKey('www.example.com', '/?'), 'www.example.com')
+
+    def testFragmentIsRemoved(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p#top')[1], '/p')
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?b=1&a=2#top')[1], '/p?a=2&b=1')
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p#top?a=1')[1], '/p')
+
+    def testFragmentIsRemovedWithoutNormalization(self):
+        CacheKey.NORMALIZE = False
+        self.assertEqual(CacheKey.normalize('WWW.Example.com:80', '/p?b=1&a=2#top'), ('WWW.Example.com:80', '/p?b=1&a=2'))
+
+    def testIgnoredParametersAreDropped(self):
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?utm_source=x&id=1&fbclid=y')[1], '/p?id=1')
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?UTM_Campaign=x&GCLID=y')[1], '/p')
+
+    def testIgnorePatterns(self):
+        CacheKey.IGNORED_PARAMETERS = CacheKey.parse('session*, ref')
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?sessionid=1&ref=2&referrer=3&utm_source=4')[1], '/p?referrer=3&utm_source=4')
+
+    def testIgnoreNone(self):
+        CacheKey.IGNORED_PARAMETERS = CacheKey.parse('none')
+        self.assertEqual(CacheKey.IGNORED_PARAMETERS, [])
+        self.assertEqual(CacheKey.normalize('www.example.com', '/p?utm_source=x&id=1')[1], '/p?id=1&utm_source=x')
+
+    def testParse(self):
+        self.assertEqual(CacheKey.parse(' utm_*, ,fbclid ,'), ['utm_*', 'fbclid'])
+
+    def testNormalizationOff(self):
+        CacheKey.NORMALIZE = False
+        self.assertEqual(CacheKey.normalize('WWW.Example.com:80', '/p?utm_source=x&b=1&a=2'), ('WWW.Example.com:80', '/p?utm_source=x&b=1&a=2'))
+
+    def testBuildCacheKey(self):
+        self.assertEqual(CacheKey.buildCacheKey('WWW.Example.com:80', '/'), 'www.example.com')
+        self.assertEqual(CacheKey.buildCacheKey('WWW.Example.com:80', '/a?b=1&a=2'), 'www.example.com/a?a=2&b=1')
+        self.assertEqual(CacheKey.buildUrl('WWW.Example.com:80', '/'), 'www.example.com/')
+
+if __name__ == '__main__':
+    unittest.main()
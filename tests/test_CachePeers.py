@@ -0,0 +1,87 @@
+import struct
+import unittest
+from RequestPacket import RequestPacket
+from CachePeers import CachePeers, CacheDigest
+
+def createKeys(numKeys, prefix='www.example.com/'):
+    return [prefix + 'page' + str(i) + '?id=' + str(i * 7) for i in range(numKeys)]
+
+class CacheDigestTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        keys = createKeys(5000)
+        digest = CacheDigest(len(keys), 0.01)
+        for key in keys:
+            digest.add(key)
+
+        parsed = CacheDigest.fromBytes(digest.toBytes())
+        self.assertEqual((parsed.numKeys, parsed.numHashes, parsed.numBits), (digest.numKeys, digest.numHashes, digest.numBits))
+        self.assertEqual(parsed.bits, digest.bits)
+        for key in keys:
+            self.assertTrue(parsed.contains(key), key)
+        self.assertEqual(parsed.toBytes(), digest.toBytes())
+
+    def testFalsePositiveRate(self):
+        keys = createKeys(5000)
+        digest = CacheDigest(len(keys), 0.01)
+        for key in keys:
+            digest.add(key)
+        parsed = CacheDigest.fromBytes(digest.toBytes())
+        falsePositives = sum(1 for key in createKeys(5000, prefix='other.example.com/') if parsed.contains(key))
+        self.assertLess(falsePositives, 5000 * 0.03)
+
+    def testEmptyDigest(self):
+        parsed = CacheDigest.fromBytes(CacheDigest(0).toBytes())
+        self.assertEqual(parsed.numBits, CacheDigest.MIN_BITS)
+        self.assertFalse(parsed.contains('www.example.com/'))
+
+    def testNonAsciiKey(self):
+        digest = CacheDigest(1)
+        digest.add('www.example.com/café')
+        self.assertTrue(CacheDigest.fromBytes(digest.toBytes()).contains('www.example.com/café'))
+
+    def testWireFormat(self):
+        digest = CacheDigest(10, numHashes=3, numBits=2048)
+        data = digest.toBytes()
+        self.assertEqual(data[:24], b'PCD1' + struct.pack('!IQQ', 3, 2048, 10))
+        self.assertEqual(len(data), 24 + 256)
+
+    def testOtherFormatIsRejected(self):
+        data = CacheDigest(10).toBytes()
+        for invalid in [
+            b'',
+            data[:10], # truncated header
+            data[:-1], # truncated bits
+            data + b'\x00', # extra bytes
+            b'PCD2' + data[4:], # other version
+            b'<html>not found</html>' + data,
+            data[:4] + struct.pack('!IQQ', 0, 2048, 10) + data[24:], # no hash functions
+            data[:4] + struct.pack('!IQQ', 3, 0, 10), # no bits
+        ]:
+            self.assertRaises(ValueError, CacheDigest.fromBytes, invalid)
+
+class SelectPeerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peerDigests = CachePeers.peerDigests
+
+    def tearDown(self):
+        CachePeers.peerDigests = self.peerDigests
+
+    def createRequest(self, url, headerFields=[]):
+        return RequestPacket.parsePacket(('GET ' + url + ' HTTP/1.1\r\nHost: www.example.com\r\n' + ''.join(field + '\r\n' for field in headerFields) + '\r\n').encode())
+
+    def testPeerHavingTheUrl(self):
+        digest = CacheDigest(1)
+        digest.add('www.example.com/a')
+        CachePeers.peerDigests = {('peer1', 8080) : CacheDigest(1), ('peer2', 8080) : CacheDigest.fromBytes(digest.toBytes())}
+        self.assertEqual(CachePeers.selectPeer(self.createRequest('http://www.example.com/a')), ('peer2', 8080))
+        self.assertIsNone(CachePeers.selectPeer(self.createRequest('http://www.example.com/b')))
+        self.assertIsNone(CachePeers.selectPeer(self.createRequest('http://www.example.com/a', ['Cache-Control: no-cache'])))
+
+    def testNoPeerDigests(self):
+        CachePeers.peerDigests = {}
+        self.assertIsNone(CachePeers.selectPeer(self.createRequest('http://www.example.com/a')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import threading
+import unittest
+from ExpirySweeper import ExpirySweeper
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = ExpirySweeper.metrics
+        ExpirySweeper.metrics = dict.fromkeys(self.metrics, 0)
+
+    def tearDown(self):
+        ExpirySweeper.metrics = self.metrics
+
+    def testConcurrentCounting(self):
+        def count():
+            for i in range(10000):
+                ExpirySweeper.count('dropped')
+                ExpirySweeper.count('droppedBytes', 10)
+        def read():
+            for i in range(1000):
+                metrics = ExpirySweeper.getMetrics()
+                self.assertEqual(metrics['droppedBytes'] % 10, 0)
+        threads = [threading.Thread(target=count) for i in range(4)] + [threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(ExpirySweeper.getMetrics()['dropped'], 40000)
+        self.assertEqual(ExpirySweeper.getMetrics()['droppedBytes'], 400000)
+
+    def testGetMetricsReturnsCopy(self):
+        metrics = ExpirySweeper.getMetrics()
+        metrics['sweeps'] += 1
+        self.assertEqual(ExpirySweeper.getMetrics()['sweeps'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
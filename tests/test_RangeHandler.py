@@ -0,0 +1,141 @@
+import unittest
+from RequestPacket import RequestPacket
+from ResponsePacket import ResponsePacket
+from RangeHandler import RangeHandler
+
+BODY = bytes(range(256)) * 4 # 1024 bytes, every offset distinguishable modulo 256
+
+def createRequest(headerFields):
+    requestRaw = 'GET http://www.example.com/file HTTP/1.1\r\nHost: www.example.com\r\n'
+    for headerField in headerFields:
+        requestRaw += headerField + '\r\n'
+    return RequestPacket.parsePacket((requestRaw + '\r\n').encode('ascii'))
+
+def createResponses(body=BODY, headerFields=()):
+    responseRaw = 'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: ' + str(len(body)) + '\r\n'
+    for headerField in headerFields:
+        responseRaw += headerField + '\r\n'
+    return [ResponsePacket.parsePacket(responseRaw.encode('ascii') + b'\r\n' + body)]
+
+def joinBody(rsps):
+    return b''.join(bytes(piece) for piece in rsps[1:])
+
+class ParseRangeTest(unittest.TestCase):
+
+    def testSingleRange(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=0-99', 1024), [(0, 99)])
+
+    def testSuffixRange(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=-500', 1024), [(524, 1023)])
+
+    def testSuffixRangeLongerThanBody(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=-5000', 1024), [(0, 1023)])
+
+    def testOpenEndedRange(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=100-', 1024), [(100, 1023)])
+
+    def testLastPositionClampedToLength(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=1000-2000', 1024), [(1000, 1023)])
+
+    def testMultipleAndOverlappingRangesKeepRequestedOrder(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=500-599, 0-99, 50-149', 1024), [(500, 599), (0, 99), (50, 149)])
+
+    def testUnsatisfiableRanges(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=1024-', 1024), [])
+        self.assertEqual(RangeHandler.parseRange('bytes=2000-3000, -0', 1024), [])
+
+    def testUnsatisfiableRangeIsDroppedFromSatisfiableOnes(self):
+        self.assertEqual(RangeHandler.parseRange('bytes=2000-3000, 0-9', 1024), [(0, 9)])
+
+    def testInvalidRangesAreIgnored(self):
+        self.assertIsNone(RangeHandler.parseRange('items=0-9', 1024))
+        self.assertIsNone(RangeHandler.parseRange('bytes=9-0', 1024))
+        self.assertIsNone(RangeHandler.parseRange('bytes=abc-', 1024))
+        self.assertIsNone(RangeHandler.parseRange('bytes=5', 1024))
+
+    def testTooManyRangesAreIgnored(self):
+        rangeHeader = 'bytes=' + ','.join(str(i) + '-' + str(i) for i in range(RangeHandler.MAX_RANGES + 1))
+        self.assertIsNone(RangeHandler.parseRange(rangeHeader, 1024))
+
+class RespondTest(unittest.TestCase):
+
+    def testWithoutRangeNothingChanges(self):
+        self.assertIsNone(RangeHandler.respond(createRequest([]), createResponses()))
+
+    def testSuffixRange(self):
+        rsps = RangeHandler.respond(createRequest(['Range: bytes=-500']), createResponses())
+        self.assertEqual(rsps[0].responseCode(), '206')
+        self.assertEqual(rsps[0].getHeaderInfo('content-range'), 'bytes 524-1023/1024')
+        self.assertEqual(rsps[0].getHeaderInfo('content-length'), '500')
+        self.assertEqual(joinBody(rsps), BODY[524:])
+
+    def testOpenEndedRange(self):
+        rsps = RangeHandler.respond(createRequest(['Range: bytes=100-']), createResponses())
+        self.assertEqual(rsps[0].getHeaderInfo('content-range'), 'bytes 100-1023/1024')
+        self.assertEqual(joinBody(rsps), BODY[100:])
+
+    def testRangeAcrossPieces(self):
+        rsps = createResponses()
+        rsps = [ResponsePacket.parsePacket(rsps[0].getPacketRaw()[:-len(BODY)] + BODY[:300]), memoryview(BODY[300:])]
+        rsps = RangeHandler.respond(createRequest(['Range: bytes=250-349']), rsps)
+        self.assertEqual(joinBody(rsps), BODY[250:350])
+
+    def testMultipleOverlappingRanges(self):
+        rsps = RangeHandler.respond(createRequest(['Range: bytes=0-9, 5-14, -3']), createResponses())
+        header = rsps[0]
+        self.assertEqual(header.responseCode(), '206')
+        self.assertEqual(header.getHeaderInfo('content-range'), 'nil')
+        contentType = header.getHeaderInfo('content-type')
+        self.assertTrue(contentType.startswith('multipart/byteranges; boundary='))
+        boundary = contentType[len('multipart/byteranges; boundary='):]
+
+        body = b''.join(bytes(part) for part in rsps[1:])
+        self.assertEqual(header.getHeaderInfo('content-length'), str(len(body)))
+        expected = b''
+        for start, end in [(0, 9), (5, 14), (1021, 1023)]:
+            expected += b'--' + boundary.encode('ascii') + b'\r\n'
+            expected += b'Content-Type: application/octet-stream\r\n'
+            expected += b'Content-Range: bytes ' + str(start).encode('ascii') + b'-' + str(end).encode('ascii') + b'/1024\r\n\r\n'
+            expected += BODY[start:end + 1] + b'\r\n'
+        expected += b'--' + boundary.encode('ascii') + b'--\r\n'
+        self.assertEqual(body, expected)
+
+    def testMultipartBoundaryChangesPerResponse(self):
+        rqp = createRequest(['Range: bytes=0-0, 2-2'])
+        first = RangeHandler.respond(rqp, createResponses())[0].getHeaderInfo('content-type')
+        second = RangeHandler.respond(rqp, createResponses())[0].getHeaderInfo('content-type')
+        self.assertNotEqual(first, second)
+
+    def testUnsatisfiableRange(self):
+        rsps = RangeHandler.respond(createRequest(['Range: bytes=2000-']), createResponses())
+        self.assertEqual(len(rsps), 1)
+        self.assertEqual(rsps[0].responseCode(), '416')
+        self.assertEqual(rsps[0].getHeaderInfo('content-range'), 'bytes */1024')
+        self.assertEqual(rsps[0].getHeaderInfo('content-length'), '0')
+
+    def testIfRangeMatchingETag(self):
+        rqp = createRequest(['Range: bytes=0-9', 'If-Range: "v1"'])
+        rsps = RangeHandler.respond(rqp, createResponses(headerFields=['ETag: "v1"']))
+        self.assertEqual(rsps[0].responseCode(), '206')
+
+    def testIfRangeMismatchFallsBackToFullResponse(self):
+        rqp = createRequest(['Range: bytes=0-9', 'If-Range: "v0"'])
+        self.assertIsNone(RangeHandler.respond(rqp, createResponses(headerFields=['ETag: "v1"'])))
+
+    def testIfRangeWeakETagFallsBackToFullResponse(self):
+        rqp = createRequest(['Range: bytes=0-9', 'If-Range: W/"v1"'])
+        self.assertIsNone(RangeHandler.respond(rqp, createResponses(headerFields=['ETag: W/"v1"'])))
+
+    def testIfRangeDate(self):
+        lastModified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        rsps = createResponses(headerFields=['Last-Modified: ' + lastModified])
+        self.assertEqual(RangeHandler.respond(createRequest(['Range: bytes=0-9', 'If-Range: ' + lastModified]), rsps)[0].responseCode(), '206')
+        self.assertIsNone(RangeHandler.respond(createRequest(['Range: bytes=0-9', 'If-Range: Tue, 02 Jan 2024 00:00:00 GMT']), rsps))
+
+    def testIncompleteBodyFallsBackToFullResponse(self):
+        rsps = createResponses(headerFields=[])
+        truncated = ResponsePacket.parsePacket(rsps[0].getPacketRaw()[:-10])
+        self.assertIsNone(RangeHandler.respond(createRequest(['Range: bytes=0-9']), [truncated]))
+
+if __name__ == '__main__':
+    unittest.main()
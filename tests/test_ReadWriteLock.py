@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+from ReadWriteLock import ReadWriteLock
+
+TIMEOUT = 5 # seconds, a thread not done by then is blocked for good
+BLOCKED_WAIT = 0.2 # seconds a blocked thread is given to (wrongly) proceed
+
+def waitFor(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not reached in ' + str(TIMEOUT) + ' seconds')
+        time.sleep(0.01)
+
+class ReadWriteLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = ReadWriteLock()
+        self.order = []
+        self.orderLock = threading.Lock()
+
+    def record(self, event):
+        with self.orderLock:
+            self.order.append(event)
+
+    def start(self, function):
+        thread = threading.Thread(target=function, daemon=True)
+        thread.start()
+        return thread
+
+    def numWaitingWriters(self):
+        return self.lock._ReadWriteLock__numWaitingWriters
+
+    def testReadersShareTheLock(self):
+        self.lock.acquireRead()
+        acquired = threading.Event()
+        def read():
+            self.lock.acquireRead()
+            acquired.set()
+            self.lock.releaseRead()
+        thread = self.start(read)
+        self.assertTrue(acquired.wait(TIMEOUT))
+        thread.join(TIMEOUT)
+        self.lock.releaseRead()
+
+    def testWriterExcludesReadersAndWriters(self):
+        self.lock.acquire()
+        acquired = threading.Event()
+        def read():
+            self.lock.acquireRead()
+            acquired.set()
+            self.lock.releaseRead()
+        def write():
+            self.lock.acquire()
+            acquired.set()
+            self.lock.release()
+        for function in [read, write]:
+            thread = self.start(function)
+            self.assertFalse(acquired.wait(BLOCKED_WAIT))
+            self.lock.release()
+            self.assertTrue(acquired.wait(TIMEOUT))
+            thread.join(TIMEOUT)
+            acquired.clear()
+            self.lock.acquire()
+        self.lock.release()
+
+    def testWaitingWriterBlocksNewReaders(self):
+        self.lock.acquireRead() # reader holding the lock before the writer arrives
+
+        def write():
+            self.lock.acquire()
+            self.record('writer acquired')
+            self.lock.release()
+        def read():
+            self.lock.acquireRead()
+            self.record('new reader acquired')
+            self.lock.releaseRead()
+
+        writer = self.start(write)
+        waitFor(lambda: self.numWaitingWriters() == 1)
+        reader = self.start(read)
+        time.sleep(BLOCKED_WAIT)
+        self.assertEqual(self.order, []) # new reader queues behind the waiting writer
+
+        self.record('holding reader finished') # reader holding the lock is not blocked
+        self.lock.releaseRead()
+        writer.join(TIMEOUT)
+        reader.join(TIMEOUT)
+        self.assertFalse(writer.is_alive() or reader.is_alive())
+        self.assertEqual(self.order, ['holding reader finished', 'writer acquired', 'new reader acquired'])
+
+    def testAllHoldingReadersFinishBeforeTheWriter(self):
+        released = [threading.Event() for i in range(3)]
+        def read(i):
+            self.lock.acquireRead()
+            self.record('reader acquired')
+            released[i].wait(TIMEOUT)
+            self.record('reader finished')
+            self.lock.releaseRead()
+        readers = [self.start(lambda i=i: read(i)) for i in range(3)]
+        waitFor(lambda: self.order.count('reader acquired') == 3)
+
+        def write():
+            self.lock.acquire()
+            self.record('writer acquired')
+            self.lock.release()
+        writer = self.start(write)
+        waitFor(lambda: self.numWaitingWriters() == 1)
+        for event in released:
+            time.sleep(0.05)
+            self.assertNotIn('writer acquired', self.order)
+            event.set()
+        writer.join(TIMEOUT)
+        for reader in readers:
+            reader.join(TIMEOUT)
+        self.assertEqual(self.order[-1], 'writer acquired')
+        self.assertEqual(self.order.count('reader finished'), 3)
+
+if __name__ == '__main__':
+    unittest.main()